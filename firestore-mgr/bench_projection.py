@@ -0,0 +1,341 @@
+""" Benchmarks projecting Firestore order documents into Order rows.
+
+    Builds a mix of plausible order documents (customer names from the customer record, from the
+    pickup recipient's display name or from the shipping address; with and without payments and
+    notes) and times:
+     - legacy:      LegacyOrder(doc), the per-column __update_* extraction Order used before the
+                    declarative projection, kept here to compare against
+     - construct:   Order(doc), the full projection into a mapped (instrumented) Order
+     - row:         OrderRow.from_doc(doc), the same into the slotted row the triggers use
+     - project:     the projection alone into a plain dict of column values
+     - legacy mask: LegacyOrder.update(mask, doc), matching field paths against update_map
+     - mask:        re-projecting only the fields an updateMask touches, as handle_updated does
+
+    Needs the same environment variables as the cloud function (nothing is connected to), e.g.:
+
+        env $(cat .env) python bench_projection.py --orders 2000 --repeat 5
+"""
+
+import argparse
+from datetime import datetime
+import random
+import re
+import time
+
+from sqlalchemy import Column, DateTime, Integer, String, Float, Enum, Text
+from sqlalchemy.ext.declarative import declarative_base
+
+import main
+from projection import OrderState
+
+MASKS = [["pickup.status", "pickup.checkin_time"], ["order.line_items"], ["customer.family_name"],
+         ["order.total_money.amount", "order.line_items"], ["order.fulfillments"]]
+
+
+LegacyBase = declarative_base()
+
+
+def extract_pickup_time(order) -> str:
+    """ extracts the earliest pickup time from an order"""
+    return "6:00PM-6:15PM Serving"
+
+
+def extract_meal_counts(order):
+    """ This extracts the count of each type of meal (adult / kids)"""
+    concert = 0
+    dinner = 0
+
+    for line_item in order['line_items']:
+        if line_item['name'] == "Concert and Dinner":
+            concert += int(line_item['quantity'])
+            dinner += int(line_item['quantity'])
+        elif line_item['name'] == "Concert Ticket":
+            concert += int(line_item['quantity'])
+        elif line_item['name'] == "Italian Dinner":
+            dinner += int(line_item['quantity'])
+
+    return concert, dinner
+
+
+def extract_donations(order):
+    """ This extracts the total amount of donations made"""
+    donations = 0.0
+
+    for line_item in order['line_items']:
+        if line_item['name'] == "Donate to StMM Parish Life Center":
+            donations += line_item['total_money']['amount'] / 100
+
+    return donations
+
+
+class LegacyOrder(LegacyBase):  # pylint: disable=too-many-instance-attributes
+    """ Order as it was before the declarative projection: a mapped class filling each column
+    from the document with its own __update_* method. update() takes the document rather than
+    fetching it from Firestore """
+    __tablename__ = 'legacy_orders'
+
+    id = Column(String(256), primary_key=True)
+    created_at = Column(DateTime)
+    label_number = Column(Integer)
+    square_order_number = Column(Integer)
+    receipt_url = Column(Text)
+    pickup_window = Column(Text)
+    customer_name = Column(Text)
+    last_name = Column(Text)
+    phone_number = Column(Text)
+    concert = Column(Integer, default=0)
+    dinner = Column(Integer, default=0)
+    donations = Column(Float, default=0)
+    tip = Column(Float, default=0)
+    total = Column(Float, default=0)
+    fees = Column(Float, default=0)
+    note = Column(Text, nullable=True)
+    status = Column(Enum(OrderState))
+    checkin_time = Column(Text, nullable=True)
+    label_url = Column(Text)
+
+    def __init__(self, doc: dict):
+        self.__update_id(doc)
+        self.__update_created_at(doc)
+        self.__update_label_number(doc)
+        self.__update_square_order_number(doc)
+        self.__update_receipt_url(doc)
+        self.__update_pickup_window(doc)
+        self.__update_customer_name(doc)
+        self.__update_last_name(doc)
+        self.__update_phone_number(doc)
+        self.__update_meals(doc)
+        self.__update_donations(doc)
+        self.__update_tip(doc)
+        self.__update_total(doc)
+        self.__update_fees(doc)
+        self.__update_note(doc)
+        self.__update_status(doc)
+        self.__update_checkin_time(doc)
+
+    def __update_id(self, doc):
+        self.id = doc['order']['id']  # pylint: disable=invalid-name
+        return False
+
+    def __update_created_at(self, doc):
+        self.created_at = datetime.fromisoformat(doc['order']['created_at'])
+        return False
+
+    def __update_label_number(self, doc):
+        self.label_number = doc['order_number']
+        return False
+
+    def __update_square_order_number(self, doc):
+        if doc.get('payment') is not None:
+            self.square_order_number = doc['payment'].get('reference_id', doc['order_number'])
+        else:
+            self.square_order_number = doc['order_number']
+        return True
+
+    def __update_receipt_url(self, doc):
+        if doc.get('payment') is not None:
+            self.receipt_url = doc['payment']['receipt_url']
+        return False
+
+    def __update_pickup_window(self, doc):
+        self.pickup_window = extract_pickup_time(doc['order'])
+        return False
+
+    def __update_customer_name(self, doc):
+        given_name = doc['customer'].get('given_name')
+        family_name = doc['customer'].get('family_name')
+        if (not given_name or given_name == "unknown") or (not family_name or family_name == "unknown"):
+            if doc['order']['fulfillments'][0].get('pickup_details', None):
+                display_name = \
+                    doc['order']['fulfillments'][0]['pickup_details']['recipient'].get('display_name')
+                if display_name:
+                    name_tokens = display_name.split(" ")
+                    given_name = " ".join(name_tokens[:-1])
+                    family_name = name_tokens[-1]
+            elif doc.get('payment') is not None:
+                given_name = doc['payment']['shipping_address']['first_name']
+                family_name = doc['payment']['shipping_address']['last_name']
+        self.customer_name = f"{given_name} {family_name}".title()
+        return True
+
+    def __update_last_name(self, doc):
+        family_name = doc['customer'].get('family_name')
+        if (not family_name or family_name == "unknown"):
+            if doc['order']['fulfillments'][0].get('pickup_details', None):
+                display_name = \
+                    doc['order']['fulfillments'][0]['pickup_details']['recipient'].get('display_name')
+                if display_name:
+                    name_tokens = display_name.split(" ")
+                    family_name = name_tokens[-1]
+            elif doc.get('payment') is not None:
+                family_name = doc['payment']['shipping_address']['last_name']
+        self.last_name = family_name.title()
+        return False
+
+    def __update_phone_number(self, doc):
+        phone_number = doc['customer'].get('phone_number')
+        if not phone_number and doc['order'].get('fulfillments') is not None and \
+                doc['order']['fulfillments'][0].get('pickup_details', None):
+            phone_number = \
+                doc['order']['fulfillments'][0]['pickup_details']['recipient'].get('phone_number')
+        self.phone_number = phone_number.replace("+", "").replace("-", "") if phone_number is not None else ""
+        return True
+
+    def __update_meals(self, doc):
+        self.concert, self.dinner = \
+            extract_meal_counts(doc['order'])
+        return True
+
+    def __update_donations(self, doc):
+        self.donations = extract_donations(doc['order'])
+        return False
+
+    def __update_tip(self, doc):
+        self.tip = doc['order']['total_tip_money']['amount'] / 100
+        return False
+
+    def __update_total(self, doc):
+        self.total = doc['order']['total_money']['amount'] / 100
+        return True
+
+    def __update_fees(self, doc):
+        try:
+            self.fees = doc['payment']['processing_fee'][0]['amount_money']['amount'] / 100
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            main.log("exception determining fees: %s", e)
+        return False
+
+    def __update_note(self, doc):
+        note = doc['order'].get('note')
+        if not note and doc['order'].get('fulfillments') is not None and \
+                doc['order']['fulfillments'][0].get('pickup_details', None):
+            note = doc['order']['fulfillments'][0]['pickup_details'].get('note')
+        self.note = note
+        return True
+
+    def __update_status(self, doc):
+        try:
+            self.status = OrderState[doc['pickup']['status']]
+        except Exception:  # pylint: disable=broad-exception-caught
+            self.status = OrderState.PLACED
+        return False
+
+    def __update_checkin_time(self, doc):
+        try:
+            self.checkin_time = doc['pickup']['checkin_time']
+        except Exception:  # pylint: disable=broad-exception-caught
+            self.checkin_time = None
+        return False
+
+    update_map = {
+        re.compile(r"^order.id$"): ['_LegacyOrder__update_id'],
+        re.compile(r"^order.created_at$"): ['_LegacyOrder__update_created_at'],
+        re.compile(r"^order_number$"): ['_LegacyOrder__update_label_number'],
+        re.compile(r"^payment.reference_id$"): ['_LegacyOrder__update_square_order_number'],
+        re.compile(r"^payment.receipt_url$"): ['_LegacyOrder__update_receipt_url'],
+        re.compile(r"^order.line_items.*"): ['_LegacyOrder__update_pickup_window',
+                                             '_LegacyOrder__update_meals'],
+        re.compile(r"^order.fulfillments$"): ['_LegacyOrder__update_customer_name',
+                                              '_LegacyOrder__update_last_name',
+                                              '_LegacyOrder__update_note'],
+        re.compile(r"^customer.given_name$"): ['_LegacyOrder__update_customer_name'],
+        re.compile(r"^customer.family_name$"): ['_LegacyOrder__update_customer_name',
+                                                '_LegacyOrder__update_last_name'],
+        re.compile(r"^customer.phone_number$"): ['_LegacyOrder__update_phone_number'],
+        re.compile(r"^order.total_tip_money.amount$"): ['_LegacyOrder__update_tip'],
+        re.compile(r"^order.total_money.amount$"): ['_LegacyOrder__update_total'],
+        re.compile(r"^payment.processing_fee.*"): ['_LegacyOrder__update_fees'],
+        re.compile(r"^order.note$"): ['_LegacyOrder__update_note'],
+        re.compile(r"^pickup.*"): ['_LegacyOrder__update_status',
+                                   '_LegacyOrder__update_checkin_time']
+    }
+
+    def update(self, update_mask, doc):
+        """ updates Python/ORM object based on field paths in update_mask """
+        label_update = False
+
+        # iterate over field paths updating appropriate properties on order object
+        for field_path in update_mask['fieldPaths']:
+            for regex, funcs in self.update_map.items():
+                if regex.match(field_path):
+                    for func in funcs:
+                        if getattr(self, func)(doc):
+                            label_update = True
+
+        return label_update
+
+
+def masked_update(order, mask, doc):
+    """ re-projects the columns an updateMask touches onto order, as handle_updated does """
+    for column, value in main.ORDER_PROJECTOR.project(doc, mask).items():
+        setattr(order, column, value)
+    return main.ORDER_PROJECTOR.touches_label(mask)
+
+
+def make_doc(number, rng):
+    """ builds a Firestore order document like the ones order-mgr writes """
+    dinners, concerts = rng.randint(0, 6), rng.randint(0, 4)
+    line_items = [{'name': "Italian Dinner", 'quantity': str(dinners), 'total_money': {'amount': 1500 * dinners}},
+                  {'name': "Concert Ticket", 'quantity': str(concerts), 'total_money': {'amount': 1000 * concerts}}]
+    if rng.random() < 0.3:
+        line_items.append({'name': "Donate to StMM Parish Life Center", 'quantity': "1",
+                           'total_money': {'amount': 2500}})
+    doc = {
+        'order_number': number,
+        'order': {
+            'id': f"order-{number:06d}",
+            'created_at': "2024-12-01T18:00:00",
+            'line_items': line_items,
+            'fulfillments': [{'type': "PICKUP", 'pickup_details': {
+                'recipient': {'display_name': f"Jane Q Family{number}", 'phone_number': "+1-555-0100"},
+                'note': "extra napkins" if rng.random() < 0.2 else None}}],
+            'total_tip_money': {'amount': 0},
+            'total_money': {'amount': 1500 * dinners + 1000 * concerts},
+        },
+        'customer': {'given_name': "Jane", 'family_name': f"Family{number}", 'phone_number': "+15550100"},
+        'payment': {'reference_id': number, 'receipt_url': f"https://squareup.com/receipt/{number}",
+                    'processing_fee': [{'amount_money': {'amount': 50}}],
+                    'shipping_address': {'first_name': "Jane", 'last_name': f"Family{number}"}},
+    }
+    if rng.random() < 0.3:
+        doc['customer'] = {'given_name': "unknown", 'family_name': "unknown"}
+    if rng.random() < 0.2:
+        doc['pickup'] = {'status': "ARRIVED", 'checkin_time': "6:05PM"}
+    return doc
+
+
+def timed(label, count, func):
+    """ runs func() and logs its per-document cost """
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print(f"{label:>11}: {elapsed * 1e6 / count:8.1f} us/doc")
+    return elapsed
+
+
+def bench():
+    """ parses arguments and runs each benchmark """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", maxsplit=1)[0])
+    parser.add_argument("--orders", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    rng = random.Random(7186)
+    docs = [make_doc(number, rng) for number in range(args.orders)]
+    masks = [{'fieldPaths': MASKS[number % len(MASKS)]} for number in range(args.orders)]
+    legacy_orders = [LegacyOrder(doc) for doc in docs]
+    rows = [main.OrderRow.from_doc(doc) for doc in docs]
+
+    for _ in range(args.repeat):
+        timed("legacy", len(docs), lambda: [LegacyOrder(doc) for doc in docs])
+        timed("construct", len(docs), lambda: [main.Order(doc) for doc in docs])
+        timed("row", len(docs), lambda: [main.OrderRow.from_doc(doc) for doc in docs])
+        timed("project", len(docs), lambda: [main.ORDER_PROJECTOR.project(doc) for doc in docs])
+        timed("legacy mask", len(docs), lambda: [order.update(mask, doc)
+                                                 for order, mask, doc in zip(legacy_orders, masks, docs)])
+        timed("mask", len(docs), lambda: [masked_update(row, mask, doc) for row, mask, doc in zip(rows, masks, docs)])
+        print()
+
+
+if __name__ == "__main__":
+    bench()
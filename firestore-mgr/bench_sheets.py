@@ -0,0 +1,100 @@
+""" Benchmarks the cost of locating and updating an order's row in the Google Sheet.
+
+    Runs against FakeSheetsBackend, which counts API requests and cells read, so the numbers
+    are a proxy for Sheets API traffic and quota rather than real network latency. Compares:
+     - scan:   read the whole sheet and filter by id for every update (what the shillelagh
+               query did)
+     - column: read the id column on every flush
+     - index:  SheetRowIndex built from one read of the id column, kept current on append
+
+    usage: python bench_sheets.py [--sizes 500 2000 5000] [--updates 200]
+"""
+
+import argparse
+import random
+import time
+
+from sheets_sync import FakeSheetsBackend, SheetsWriter
+
+COLUMNS = ["id", "created_at", "label_number", "square_order_number", "receipt_url",
+           "pickup_window", "customer_name", "last_name", "phone_number", "concert", "dinner",
+           "donations", "tip", "total", "fees", "note", "status", "checkin_time", "label_url"]
+
+
+def make_row(number):
+    """ builds a plausible sheet row for order number `number` """
+    row = {column: f"{column}-{number}" for column in COLUMNS}
+    row["id"] = f"order-{number:06d}"
+    return row
+
+
+def make_sheet(size):
+    """ builds a fake sheet already holding `size` orders """
+    sheet = FakeSheetsBackend(header=COLUMNS)
+    sheet.rows.extend([make_row(number)[column] for column in COLUMNS] for number in range(size))
+    sheet.requests = 0
+    sheet.cells_read = 0
+    return sheet
+
+
+def scan_update(sheet, row):
+    """ the old path: pull every row, filter by id, then write the matching row """
+    for number, values in enumerate(sheet.read_rows(), start=2):
+        if values[0] == row["id"]:
+            sheet.batch_update([(number, [row[column] for column in COLUMNS])])
+            return
+
+
+class ColumnWriter(SheetsWriter):
+    """ SheetsWriter that rebuilds its row index from the id column on every flush """
+
+    def flush(self, blocking=True):
+        self.index.invalidate()
+        return super().flush(blocking)
+
+
+def run(strategy, size, updates):
+    """ applies `updates` single-row updates to a sheet of `size` rows; returns stats """
+    sheet = make_sheet(size)
+    rng = random.Random(size)
+    rows = [make_row(rng.randrange(size)) for _ in range(updates)]
+    writer = None
+    if strategy != "scan":
+        writer_class = ColumnWriter if strategy == "column" else SheetsWriter
+        writer = writer_class(sheet, COLUMNS, max_rows=1, log=lambda *args: None)
+
+    start = time.perf_counter()
+    for row in rows:
+        if writer is None:
+            scan_update(sheet, row)
+        else:
+            writer.enqueue(row)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "strategy": strategy,
+        "rows": size,
+        "requests/update": sheet.requests / updates,
+        "cells read/update": sheet.cells_read / updates,
+        "us/update": elapsed / updates * 1e6,
+    }
+
+
+def main():
+    """ runs every strategy at every size and prints a table """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", maxsplit=1)[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[500, 2000, 5000])
+    parser.add_argument("--updates", type=int, default=200)
+    args = parser.parse_args()
+
+    header = ["strategy", "rows", "requests/update", "cells read/update", "us/update"]
+    print("".join(f"{column:>20}" for column in header))
+    for size in args.sizes:
+        for strategy in ("scan", "column", "index"):
+            stats = run(strategy, size, args.updates)
+            print("".join(f"{stats[column]:>20.1f}" if isinstance(stats[column], float)
+                          else f"{stats[column]:>20}" for column in header))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+""" The check-in code printed on each label: a QR code holding the Square order id and a short
+    token signed with LABEL_TOKEN_SECRET, "<order id>.<token>".
+
+    Scanning it at the door sends the code to sql-mgr's print function, which checks the token
+    with the same secret and goes straight to the order and its label, with no lookup by name.
+    The token keeps anyone who knows an order id from checking it in or printing its label. Without
+    a secret configured, labels carry no code.
+"""
+
+import base64
+import functools
+import hashlib
+import hmac
+import os
+
+import segno
+
+LABEL_TOKEN_SECRET = os.environ.get('LABEL_TOKEN_SECRET', '')
+MODULE_PX = 5  # CSS px per QR module on the PDF label (about 1.3mm)
+ZPL_MAGNIFICATION = 5  # printer dots per QR module on the ZPL label (about 0.6mm)
+
+
+def token(order_id, secret=None) -> str:
+    """ the first 72 bits of the HMAC-SHA256 of the order id, in 12 URL-safe characters """
+    digest = hmac.new((secret or LABEL_TOKEN_SECRET).encode("utf-8"), order_id.encode("utf-8"), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest[:9]).decode("ascii")
+
+
+def payload(order):
+    """ what the order's QR code holds, or None if labels carry no code """
+    order_id = getattr(order, 'id', None)
+    if not LABEL_TOKEN_SECRET or not order_id:
+        return None
+    return f"{order_id}.{token(order_id)}"
+
+
+@functools.lru_cache(maxsize=256)
+def qr_code(data):
+    """ the QR code for data at error correction level M, whose 15% redundancy survives smudges
+    and creases without growing the symbol much """
+    return segno.make_qr(data, error='m', boost_error=False)
+
+
+def matrix(data):
+    """ the QR code's modules, row by row from the top, True for dark ones (no quiet zone) """
+    return [[bool(module) for module in row] for row in qr_code(data).matrix]
+
+
+def image(order):
+    """ (SVG data URI, size in CSS px) of the order's QR code for the label template, or None """
+    data = payload(order)
+    if data is None:
+        return None
+    code = qr_code(data)
+    return code.svg_data_uri(scale=MODULE_PX, border=0), code.symbol_size(border=0)[0] * MODULE_PX
@@ -3,36 +3,47 @@
     It reads the document and:
      - creates a label/printout for the order and stores it in GCS
      - adds a row to CloudSQL table
+     - queues the row to be written behind to the Google Sheet
 """
 # pylint: disable=redefined-outer-name,unused-argument,no-member
 
 # TODO: dynamically scan Jinja2 template to extract required fields and compare
 #       to changes to determine if we need to re-generate label
 
-import copy
+import contextlib
 import contextvars
 from datetime import datetime
 import enum
+import functools
 import json
 import os
-import re
+import threading
+import time
 
 import jinja2
 
-from sqlalchemy import create_engine
-from sqlalchemy import Column, DateTime, Integer, String, Float, Enum, Text
+from sqlalchemy import create_engine, func
+from sqlalchemy import Column, DateTime, Integer, String, Float, Enum, Text, Index
+from sqlalchemy.dialects.mysql import insert as mysql_insert
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 
-from weasyprint import HTML, CSS
-
 from google.cloud import storage, firestore
 
+import checkin_code
+import pdf_label
+import profiler
+from projection import FIELDS, OrderState, Projector, load_catalog
+from sheets_sync import GoogleSheetsBackend, SheetsWriter
+import zpl_label
+
 GCS_BUCKET = os.environ['GCS_BUCKET']
 GOOGLE_SHEET_URL = os.environ['GOOGLE_SHEET_URL']
+EVENT_DATE = os.environ['EVENT_DATE']
 
-# Instantiates a client
+# Instantiates clients once per instance; both are safe to share across concurrent invocations
 client = storage.Client()
+fs_client = firestore.Client()
 
 ctx_id = contextvars.ContextVar("square_order_id", default="")
 
@@ -52,19 +63,127 @@ def log(message, *args, **kwargs):
     print(json.dumps(structured_json))
 
 
-class OrderState(enum.Enum):
-    """ OrderState docstring """
-    PLACED = 1
-    ARRIVED = 2
-    CANCELLED = 3
+def trace_stage(trace, stage, started):
+    """ records the completion of a pipeline stage in the order's trace context and logs the
+    stage's latency, and the latency since the webhook was received, for trace_report.py """
+    now = time.time()
+    trace['stages'][stage] = now
+    log("%s stage complete", stage, trace_stage={
+        "trace_id": trace['id'], "order_id": trace['order_id'], "stage": stage,
+        "stage_ms": round((now - started) * 1000, 1),
+        "since_received_ms": round((now - trace['received_at']) * 1000, 1)})
+    return trace
+
+
+# where spans around external calls are exported: "" records nothing, "stdout" logs one entry
+# per call and "file:<path>" appends them as JSON lines, for offline analysis
+SPAN_EXPORTER = os.environ.get('SPAN_EXPORTER', '')
+
+
+def log_span(record):
+    """ exports a span as a structured log entry """
+    log("%s took %.1fms", record['name'], record['duration_ms'], span=record)
+
+
+def file_span_exporter(path):
+    """ an exporter appending spans to path, one JSON object per line """
+    lock = threading.Lock()
+
+    def export(record):
+        line = json.dumps(record, default=str) + "\n"
+        with lock, open(path, "a", encoding="utf-8") as spans:
+            spans.write(line)
+    return export
+
+
+def span_exporter_for(setting):
+    """ the exporter a SPAN_EXPORTER setting names, or None """
+    if not setting:
+        return None
+    if setting == "stdout":
+        return log_span
+    if setting.startswith("file:"):
+        return file_span_exporter(setting.removeprefix("file:"))
+    raise ValueError(f"unknown SPAN_EXPORTER {setting!r}")
+
+
+span_exporter = span_exporter_for(SPAN_EXPORTER)
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """ times the external call made in the block and exports its name, attributes, duration,
+    outcome (an exception's name, unless the block set one) and order id; the block may add the
+    payload size as 'bytes' to the dict it is given. Without an exporter nothing is timed """
+    record = {"name": name, **attributes}
+    if span_exporter is None:
+        yield record
+        return
+    record.update(order_id=ctx_id.get(), outcome="ok", started_at=time.time())
+    start = time.perf_counter()
+    try:
+        yield record
+    except BaseException as err:
+        record['outcome'] = type(err).__name__
+        raise
+    finally:
+        record['duration_ms'] = round((time.perf_counter() - start) * 1000, 2)
+        span_exporter(record)
+
+
+# entry points are profiled on request or for PROFILE_FRACTION of invocations; see profiler.py
+profiled = profiler.ProfileHook(log=log)
 
 
 Base = declarative_base()
 
+ORDER_PROJECTOR = Projector(FIELDS, log=log)
+
 
-class Order(Base):  # pylint: disable=too-many-instance-attributes
+def orders_table_name(event_date: str) -> str:
+    """ each event gets its own orders table, e.g. 2024-12-06 -> orders_2024_12_06 """
+    return f"orders_{event_date.replace('-', '_')}"
+
+
+class OrderColumns:
+    """ conversions shared by Order and OrderRow, which both expose the columns of the orders
+    table as attributes """
+    __slots__ = ()
+
+    def sql_row(self) -> dict:
+        """ returns the order as a dict of column name -> value for a Core insert, applying
+        column defaults to fields the projection left unset (as an ORM insert would) """
+        row = {}
+        for column in self.__table__.columns:
+            value = getattr(self, column.name)
+            if value is None and column.default is not None:
+                value = column.default.arg
+            row[column.name] = value
+        return row
+
+    def sheets_row(self) -> dict:
+        """ returns the order as a dict of column name -> cell value for the Google Sheet """
+        row = {}
+        for column in self.__table__.columns:
+            value = getattr(self, column.name)
+            if isinstance(value, datetime):
+                value = value.strftime("%Y-%m-%d %H:%M:%S")
+            elif isinstance(value, enum.Enum):
+                value = value.name
+            row[column.name] = value
+        return row
+
+
+class Order(OrderColumns, Base):  # pylint: disable=too-many-instance-attributes
     """ Order docstring """
-    __tablename__ = 'orders'  # TODO: add event date into table name to provide separation
+    __tablename__ = orders_table_name(EVENT_DATE)
+    # secondary indexes for check-in lookups; TEXT columns can only be indexed on a prefix
+    __table_args__ = (
+        Index('ix_orders_last_name', 'last_name', mysql_length=32),
+        Index('ix_orders_phone_number', 'phone_number', mysql_length=16),
+        Index('ix_orders_square_order_number', 'square_order_number'),
+        Index('ix_orders_status', 'status'),
+    )
 
     id = Column(String(256), primary_key=True)
     created_at = Column(DateTime)
@@ -94,250 +213,50 @@ class Order(Base):  # pylint: disable=too-many-instance-attributes
         return f'Order {self.id} - SON {self.square_order_number} - {self.customer_name}'
 
     def __init__(self, doc: dict):
-        self.__update_id(doc)
-        self.__update_created_at(doc)
-        self.__update_label_number(doc)
-        self.__update_square_order_number(doc)
-        self.__update_receipt_url(doc)
-        self.__update_pickup_window(doc)
-        self.__update_customer_name(doc)
-        self.__update_last_name(doc)
-        self.__update_phone_number(doc)
-        self.__update_meals(doc)
-#      self.__update_drinks(doc)
-        self.__update_donations(doc)
-        self.__update_tip(doc)
-        self.__update_total(doc)
-        self.__update_fees(doc)
-        self.__update_note(doc)
-        self.__update_status(doc)
-        self.__update_checkin_time(doc)
-
-    def __update_id(self, doc):
-        self.id = doc['order']['id']  # pylint: disable=invalid-name
-        return False
+        for column, value in ORDER_PROJECTOR.project(doc).items():
+            setattr(self, column, value)
 
-    def __update_created_at(self, doc):
-        self.created_at = datetime.fromisoformat(doc['order']['created_at'])
-        return False
 
-    def __update_label_number(self, doc):
-        self.label_number = doc['order_number']
-        return False
+# every counter the catalog fills in needs a column to land in
+unmapped_counters = set(load_catalog().columns) - set(Order.__table__.columns.keys())
+if unmapped_counters:
+    raise ValueError(f"catalog counters without an Order column: {sorted(unmapped_counters)}")
 
-    def __update_square_order_number(self, doc):
-        if doc.get('payment') is not None:
-            self.square_order_number = doc['payment'].get('reference_id', doc['order_number'])
-        else:
-            self.square_order_number = doc['order_number']
-        return True
 
-    def __update_receipt_url(self, doc):
-        if doc.get('payment') is not None:
-            self.receipt_url = doc['payment']['receipt_url']
-        return False
+class OrderRow(OrderColumns):  # pylint: disable=too-few-public-methods
+    """ an order's column values as a plain slotted object, without the ORM's per-instance state
+    and attribute instrumentation; this is what the triggers project documents into and write to
+    MySQL and the Sheet, while Order remains the mapped class for the schema and queries """
+    __table__ = Order.__table__
+    __slots__ = tuple(column.name for column in Order.__table__.columns)
 
-    def __update_pickup_window(self, doc):
-        self.pickup_window = extract_pickup_time(doc['order'])
-        return False
+    def __init__(self, values: dict):
+        for name in self.__slots__:
+            setattr(self, name, values.get(name))
 
-    def __update_customer_name(self, doc):
-        given_name = doc['customer'].get('given_name')
-        family_name = doc['customer'].get('family_name')
-        if (not given_name or given_name == "unknown") or (not family_name or family_name == "unknown"):
-            if doc['order']['fulfillments'][0].get('pickup_details', None):
-                display_name = \
-                    doc['order']['fulfillments'][0]['pickup_details']['recipient'].get('display_name')
-                if display_name:
-                    name_tokens = display_name.split(" ")
-                    given_name = " ".join(name_tokens[:-1])
-                    family_name = name_tokens[-1]
-            elif doc.get('payment') is not None:
-                given_name = doc['payment']['shipping_address']['first_name']
-                family_name = doc['payment']['shipping_address']['last_name']
-        self.customer_name = f"{given_name} {family_name}".title()
-        return True
-
-    def __update_last_name(self, doc):
-        family_name = doc['customer'].get('family_name')
-        if (not family_name or family_name == "unknown"):
-            if doc['order']['fulfillments'][0].get('pickup_details', None):
-                display_name = \
-                    doc['order']['fulfillments'][0]['pickup_details']['recipient'].get('display_name')
-                if display_name:
-                    name_tokens = display_name.split(" ")
-                    family_name = name_tokens[-1]
-            elif doc.get('payment') is not None:
-                family_name = doc['payment']['shipping_address']['last_name']
-        self.last_name = family_name.title()
-        return False
-
-    def __update_phone_number(self, doc):
-        phone_number = doc['customer'].get('phone_number')
-        if not phone_number and doc['order'].get('fulfillments') is not None and doc['order']['fulfillments'][0].get('pickup_details', None):
-            phone_number = \
-                doc['order']['fulfillments'][0]['pickup_details']['recipient'].get('phone_number')
-        self.phone_number = phone_number.replace("+", "").replace("-", "") if phone_number is not None else ""
-        return True
-
-    def __update_meals(self, doc):
-#        self.jambalaya, self.pastalaya, self.kids_meals = \
-        self.concert, self.dinner = \
-            extract_meal_counts(doc['order'])
-        return True
-
-#  def __update_drinks(self, doc):
-#      self.drinks = extract_drinks(doc['order'])
-#      return True
-
-    def __update_donations(self, doc):
-        self.donations = extract_donations(doc['order'])
-        return False
+    @classmethod
+    def from_doc(cls, doc: dict):
+        """ projects a Firestore order document into a row """
+        return cls(ORDER_PROJECTOR.project(doc))
 
-    def __update_tip(self, doc):
-        self.tip = doc['order']['total_tip_money']['amount'] / 100
-        return False
-
-    def __update_total(self, doc):
-        self.total = doc['order']['total_money']['amount'] / 100
-        return True
-
-    def __update_fees(self, doc):
-        try:
-            self.fees = doc['payment']['processing_fee'][0]['amount_money']['amount'] / 100
-        except Exception as e:
-            log("exception determining fees: %s", e)
-        return False
-
-    def __update_note(self, doc):
-        note = doc['order'].get('note')
-        if not note and doc['order'].get('fulfillments') is not None and doc['order']['fulfillments'][0].get('pickup_details', None):
-            note = doc['order']['fulfillments'][0]['pickup_details'].get('note')
-        self.note = note
-        return True
-
-    def __update_status(self, doc):
-        try:
-            self.status = OrderState[doc['pickup']['status']]
-        except Exception:
-            self.status = OrderState.PLACED
-        return False
-
-    def __update_checkin_time(self, doc):
-        try:
-            self.checkin_time = doc['pickup']['checkin_time']
-        except Exception:
-            self.checkin_time = None
-        return False
-
-    update_map = {
-        re.compile(r"^order.id$"): ['_Order__update_id'],
-        re.compile(r"^order.created_at$"): ['_Order__update_created_at'],
-        re.compile(r"^order_number$"): ['_Order__update_label_number'],
-        re.compile(r"^payment.reference_id$"): ['_Order__update_square_order_number'],
-        re.compile(r"^payment.receipt_url$"): ['_Order__update_receipt_url'],
-        re.compile(r"^order.line_items.*"): ['_Order__update_pickup_window',
-                                             '_Order__update_meals'], # remove trailing ]
-#                                           '_Order__update_donations',
-#                                           '_Order__update_drinks'],
-        re.compile(r"^order.fulfillments$"): ['_Order__update_customer_name',
-                                              '_Order__update_last_name',
-                                              '_Order__update_note'],
-        re.compile(r"^customer.given_name$"): ['_Order__update_customer_name'],
-        re.compile(r"^customer.family_name$"): ['_Order__update_customer_name',
-                                                '_Order__update_last_name'],
-        re.compile(r"^customer.phone_number$"): ['_Order__update_phone_number'],
-        re.compile(r"^order.total_tip_money.amount$"): ['_Order__update_tip'],
-        re.compile(r"^order.total_money.amount$"): ['_Order__update_total'],
-        re.compile(r"^payment.processing_fee.*"): ['_Order__update_fees'],
-        re.compile(r"^order.note$"): ['_Order__update_note'],
-        re.compile(r"^pickup.*"): ['_Order__update_status',
-                                   '_Order__update_checkin_time']
-    }
+    def __repr__(self):
+        return f'OrderRow {self.id} - SON {self.square_order_number} - {self.customer_name}'
 
-    def update(self, update_mask, context):
-        """ updates Python/ORM object based on field paths in update_mask """
-        label_update = False
-
-        doc = fetch_document_from_firestore(context)
-        # iterate over field paths updating appropriate properties on order object
-        for field_path in update_mask['fieldPaths']:
-            for regex, funcs in self.update_map.items():
-                if regex.match(field_path):
-                    for func in funcs:
-                        if getattr(self, func)(doc):
-                            label_update = True
-
-        return label_update
-
-
-def extract_pickup_time(order) -> str:
-    """ extracts the earliest pickup time from an order"""
-#    min_pickup_time = ""
-#    for line_item in order['line_items']:
-#        if (line_item['name'] == "Jambalaya Meal" or line_item['name'] == "Pasta-laya Meal") and line_item['variation_name']:
-#            if min_pickup_time == "" or line_item['variation_name'] < min_pickup_time:
-#                min_pickup_time = line_item['variation_name']
-#
-#    if min_pickup_time == "":
-#        min_pickup_time = "5:00PM-6:00PM Serving"
-#
-#    return min_pickup_time
-    return "6:00PM-6:15PM Serving"
-
-
-def extract_meal_counts(order):
-    """ This extracts the count of each type of meal (adult / kids)"""
-#    jambalaya = 0
-#    pastalaya = 0
-#    kids = 0
-    concert = 0
-    dinner = 0
-
-    for line_item in order['line_items']:
-        if line_item['name'] == "Concert and Dinner":
-            concert += int(line_item['quantity'])
-            dinner += int(line_item['quantity'])
-        elif line_item['name'] == "Concert Ticket":
-            concert += int(line_item['quantity'])
-        elif line_item['name'] == "Italian Dinner":
-            dinner += int(line_item['quantity'])
-
-    return concert, dinner
-
-
-def extract_drinks(order):
-    """ This extracts a list of KVPs of type of beer and quantity """
-    beers = 0
-#    for line_item in order['line_items']:
-#        if line_item['name'] == "Drink Ticket (Beer or Wine)":
-#            beers += int(line_item['quantity'])
-#        elif line_item['name'] == "Brüeprint Draft Beer Ticket":
-#            if not beers.get("Draft"):
-#                beers["Draft"] = 0
-#            beers["Draft"] += int(line_item['quantity'])
-
-    return beers
-
-
-def extract_donations(order):
-    """ This extracts the total amount of donations made"""
-    donations = 0.0
-
-    for line_item in order['line_items']:
-#        if line_item['name'] == "Donate to support individuals with intellectual disabilities":
-        if line_item['name'] == "Donate to StMM Parish Life Center":
-            donations += line_item['total_money']['amount'] / 100
-
-    return donations
 
 db_user = os.environ["DB_USER"]
 db_pass = os.environ["DB_PASS"]
 db_name = os.environ["DB_NAME"]
 db_host = os.environ["DB_HOST"]
 db_port = os.environ["DB_PORT"]
+# one pool per instance, sized for the function's per-instance concurrency; pre-ping and recycle
+# avoid handing out connections that CloudSQL closed while the instance sat idle
 mysql_engine = create_engine(
-    f'mysql+pymysql://{db_user}:{db_pass}@{db_host}:{db_port}/{db_name}'
+    f'mysql+pymysql://{db_user}:{db_pass}@{db_host}:{db_port}/{db_name}',
+    pool_size=int(os.environ.get("DB_POOL_SIZE", "5")),
+    max_overflow=int(os.environ.get("DB_POOL_MAX_OVERFLOW", "2")),
+    pool_timeout=float(os.environ.get("DB_POOL_TIMEOUT", "10")),
+    pool_recycle=int(os.environ.get("DB_POOL_RECYCLE", "1800")),
+    pool_pre_ping=True,
 )
 #db_socket_dir = os.environ.get("DB_SOCKET_DIR", "/cloudsql")
 #instance_connection_name = os.environ["INSTANCE_CONNECTION_NAME"]
@@ -346,24 +265,58 @@ mysql_engine = create_engine(
 #    f'unix_socket={db_socket_dir}/{instance_connection_name}'
 #)
 
-sheets_engine = create_engine("shillelagh://",
-                              adapters=["gsheetsapi"],
-                              adapter_kwargs={
-                                    "gsheetsapi": {
-                                        "app_default_credentials": True,
-                                        "catalog": {
-                                            Order.__tablename__: GOOGLE_SHEET_URL
-                                        }
-                                    }
-                              })
-
+# each invocation opens its own session from this factory (see mysql_session_scope)
 mysql_sessionmaker = sessionmaker(bind=mysql_engine)
-mysql_session = mysql_sessionmaker()
 
-sheets_sessionmaker = sessionmaker(bind=sheets_engine)
-sheets_session = sheets_sessionmaker()
+schema_lock = threading.Lock()
+schema_ready = threading.Event()
 
 
+def ensure_schema():
+    """ creates the orders table if needed; runs at most once per instance """
+    if schema_ready.is_set():
+        return
+    with schema_lock:
+        if not schema_ready.is_set():
+            Base.metadata.create_all(mysql_engine, checkfirst=True)
+            schema_ready.set()
+
+
+def mysql_session_scope():
+    """ returns a new session for a single invocation, to be used as a context manager. The
+    transaction is committed when the block exits cleanly, rolled back otherwise, and the
+    connection is returned to the pool either way.
+    """
+    ensure_schema()
+    return mysql_sessionmaker.begin()
+
+
+def upsert_orders(orders):
+    """ writes orders to MySQL in a single multi-row INSERT ... ON DUPLICATE KEY UPDATE
+    statement built from their column mappings, so create and update triggers are idempotent and
+    may arrive in either order. A missing label_url never overwrites the one already stored.
+    """
+    ensure_schema()
+    table = Order.__table__
+    statement = mysql_insert(table).values([order.sql_row() for order in orders])
+    statement = statement.on_duplicate_key_update({
+        column.name: func.coalesce(statement.inserted.label_url, table.c.label_url)
+        if column.name == 'label_url' else statement.inserted[column.name]
+        for column in table.columns if column.name != 'id'
+    })
+    with span("mysql.upsert", rows=len(orders)), mysql_engine.begin() as connection:
+        connection.execute(statement)
+
+
+# rows are written to the Google Sheet asynchronously; MySQL remains the system of record
+sheets_writer = SheetsWriter(GoogleSheetsBackend(GOOGLE_SHEET_URL),
+                             [column.name for column in Order.__table__.columns],
+                             max_rows=int(os.environ.get("SHEETS_FLUSH_ROWS", "25")),
+                             max_seconds=float(os.environ.get("SHEETS_FLUSH_SECONDS", "10")),
+                             log=log, span=span).register_atexit()
+
+
+@profiled
 def handle_created(data, context):
     """ This is called when a new document is added to Firestore. Unfortunately the view
         passed in under data['value'] is not easily converted to a Python dict, so we
@@ -371,69 +324,83 @@ def handle_created(data, context):
         race condition in that we read a more up to date version of the document than was
         initially created but we take that risk knowingly here.
     """
+    started = time.time()
+    # rows queued by earlier invocations may be overdue, as nothing flushes between requests
+    sheets_writer.maybe_flush()
 
     doc = fetch_document_from_firestore(context)
 
-    # Create Order object
-    order = Order(doc)
+    # Project the document into an order row
+    order = OrderRow.from_doc(doc)
     ctx_id.set(order.id)
 
-    # Create label pdf
-    pdf_bytes = create_label(order)
+    # Create label pdf, store to GCS, get URL, update order object
+    create_and_store_label(order)
+    # the order is printable from here on, which ends the trace begun by square-webhook
+    if doc.get('trace'):
+        trace_stage(doc['trace'], "label", started)
 
-    # Store to GCS, get URL, update order object
-    order.label_url = store_label_to_gcs(pdf_bytes, order)
+    # Commit to mysql
+    upsert_orders([order])
 
-    sheets_order = copy.deepcopy(order)
+    # Queue for write-behind to sheets
+    sheets_writer.enqueue(order.sheets_row())
 
-    # Commit to mysql
-    mysql_session.add(order)
-    order.__table__.create(mysql_engine, checkfirst=True)
-    mysql_session.commit()
 
-    # Commit to sheets
-    sheets_order.__table__.create(sheets_engine, checkfirst=True)
-    sheets_session.add(sheets_order)
-    sheets_session.commit()
+# per-instance counts of update invocations and of those that touched no mapped column
+update_stats = {'invocations': 0, 'short_circuited': 0}
+update_stats_lock = threading.Lock()
 
 
+@profiled
 def handle_updated(data, context):
     """ This fires when a firestore document has been updated (either manually or due to a Square
     Webhook order.updated event firing and updating our local copy)
     """
+    started = time.time()
     log("handle_update entered: %s", context)
+    sheets_writer.maybe_flush()
 
-    # try fetching existing order from mysql
     order_id = data['value']['fields']['order']['mapValue']['fields']['id']['stringValue']
     ctx_id.set(order_id)
 
     log(f"update requested with mask {data['updateMask']}", request=data)
-    order = mysql_session.query(Order).filter_by(id=order_id).one_or_none()
 
-    if not order:
-        log("requested to update a record in CloudSQL that we couldn't find")
-        mysql_session.close()
-        handle_created(data, context)
+    # most updates (e.g. sql-mgr recording print_times) change nothing that is mapped to a MySQL
+    # column or Sheets cell; those are done before any I/O
+    short_circuit = not ORDER_PROJECTOR.fields_for(data['updateMask'])
+    with update_stats_lock:
+        update_stats['invocations'] += 1
+        update_stats['short_circuited'] += short_circuit
+        stats = dict(update_stats)
+    if short_circuit:
+        log("update changes no mapped columns, skipping", **stats)
         return
 
-    # recreate label pdf if needed (check for update to name, order counts, phone #, total, beers)
-    if order.update(data['updateMask'], context):
-        log("update requires new label to be generated")
-        # Create label pdf
-        pdf_bytes = create_label(order)
+    # project the current document; no need to read the existing row since the upsert below
+    # inserts it if the create trigger hasn't landed yet (which will then create the label)
+    doc = fetch_document_from_firestore(context)
+    order = OrderRow.from_doc(doc)
 
-        # Store to GCS, get URL, update order object
-        order.label_url = store_label_to_gcs(pdf_bytes, order)
+    # recreate label pdf if needed (check for update to name, order counts, phone #, total);
+    # the order was just projected in full, so only the mask's effect on the label is needed
+    if ORDER_PROJECTOR.touches_label(data['updateMask']):
+        log("update requires new label to be generated")
+        # Create label pdf, store to GCS, get URL, update order object
+        create_and_store_label(order)
+        # only an update that brought a new trace (i.e. came through square-webhook) continues it
+        if doc.get('trace') and any(path.startswith("trace.") for path in data['updateMask']['fieldPaths']):
+            trace_stage(doc['trace'], "label", started)
 
     # Commit updated order to mysql
-    mysql_session.commit()
-
-    # Commit updated order to sheets
-    sheets_order = sheets_session.query(Order).filter_by(id=order_id).one_or_none()
-    sheets_order.update(data['updateMask'], context)
-    sheets_order.label_url = order.label_url
+    upsert_orders([order])
 
-    sheets_session.commit()
+    # Queue updated order for write-behind to sheets, leaving the label_url cell alone if the
+    # label wasn't regenerated
+    sheets_row = order.sheets_row()
+    if order.label_url is None:
+        del sheets_row['label_url']
+    sheets_writer.enqueue(sheets_row)
 
 
 def fetch_document_from_firestore(context):
@@ -444,10 +411,10 @@ def fetch_document_from_firestore(context):
     collection_path = path_parts[0]
     document_path = '/'.join(path_parts[1:])
 
-    fs_client = firestore.Client()
     doc = fs_client.collection(collection_path).document(document_path)
 
-    doc_snap = doc.get()
+    with span("firestore.get", document="order"):
+        doc_snap = doc.get()
 
     if doc_snap.exists:
         return doc_snap.to_dict()
@@ -455,33 +422,104 @@ def fetch_document_from_firestore(context):
     raise KeyError(f"could not find {context.resource} in Firestore")
 
 
+template_env = jinja2.Environment(loader=jinja2.FileSystemLoader(searchpath="./"))
+template_env.globals['checkin_image'] = checkin_code.image
+
+
+# "auto" writes labels straight to PDF with pdf_label while the templates match its built-in
+# layout and with WeasyPrint otherwise; "direct" or "weasyprint" forces one or the other
+LABEL_RENDERER = os.environ.get('LABEL_RENDERER', 'auto')
+# labels are stored in GCS and published whole to the printers, so by default they are written
+# compactly: compressed streams, subsetted fonts without hinting and no unused resources; set to
+# 0 for uncompressed PDFs when debugging label output
+LABEL_PDF_COMPACT = os.environ.get('LABEL_PDF_COMPACT', '1') == '1'
+# also write each label as ZPL next to its PDF, for printers that speak it natively
+LABEL_ZPL = os.environ.get('LABEL_ZPL', '0') == '1'
+
+
+@functools.lru_cache(maxsize=1)
+def direct_labels():
+    """ whether labels are rendered by the direct PDF writer rather than WeasyPrint """
+    if LABEL_RENDERER != 'auto':
+        return LABEL_RENDERER == 'direct'
+    if not pdf_label.layout_matches():
+        log("label templates differ from the built-in layout; rendering labels with WeasyPrint")
+        return False
+    return True
+
+
+@functools.lru_cache(maxsize=1)
+def label_stylesheets():
+    """ parses the label stylesheets once per process rather than on every render, which also
+    saves fetching Bootstrap from its CDN for each label """
+    from weasyprint import CSS  # pylint: disable=import-outside-toplevel
+    return [CSS('label.css'),
+            CSS(url="https://cdn.jsdelivr.net/npm/bootstrap@5.1.3/dist/css/bootstrap.min.css")]
+
+
+def render_with_weasyprint(template_name, target=None, **context):
+    """ lays out a label template with WeasyPrint, writing the PDF to target or returning it;
+    WeasyPrint is only imported (and its memory spent) once a label actually needs it """
+    from weasyprint import HTML  # pylint: disable=import-outside-toplevel
+    output_text = template_env.get_template(template_name).render(beers={}, **context)
+    return HTML(string=output_text).write_pdf(target=target, stylesheets=label_stylesheets(),
+                                              uncompressed_pdf=not LABEL_PDF_COMPACT, full_fonts=False,
+                                              hinting=False, optimize_images=LABEL_PDF_COMPACT)
+
+
 def create_label(order):
     """ create label for given order """
-    template_loader = jinja2.FileSystemLoader(searchpath="./")
-    template_env = jinja2.Environment(loader=template_loader)
-    template_file = "label_template.html"
-    template = template_env.get_template(template_file)
-
-    output_text = template.render(order=order, beers={})
+    with span("label.render") as render:
+        pdf_bytes = pdf_label.render([order], compress=LABEL_PDF_COMPACT) if direct_labels() else None
+        render['renderer'] = "direct"
+        if pdf_bytes is None:
+            pdf_bytes = render_with_weasyprint("label_template.html", order=order)
+            render['renderer'] = "weasyprint"
+        render['bytes'] = len(pdf_bytes)
+    return pdf_bytes
+
+
+def write_label_sheet(orders, file_name):
+    """ renders every order onto its own page of a single PDF and streams it to GCS as file_name
+
+    All labels are laid out in one pass, so the per-document overhead (parsing the stylesheets,
+    font setup, PDF assembly) is paid once rather than once per order, and the PDF is written
+    straight into a resumable upload instead of being held twice in memory.
+    """
+    pdf_bytes = pdf_label.render(orders, compress=LABEL_PDF_COMPACT) if direct_labels() else None
+    blob = client.bucket(GCS_BUCKET).blob(f"{EVENT_DATE}/{file_name}")
+    log("uploading %s labels to GCS bucket as %s", len(orders), blob.name)
+    with span("gcs.upload", labels=len(orders)) as upload, \
+            blob.open("wb", content_type='application/pdf') as target:
+        if pdf_bytes is not None:
+            target.write(pdf_bytes)
+            upload['bytes'] = len(pdf_bytes)
+        else:
+            render_with_weasyprint("label_sheet.html", target=target, orders=orders)
+    return blob.self_link
 
-    html_renderer = HTML(string=output_text)
 
-    return html_renderer.write_pdf(stylesheets=[
-        CSS('label.css'),
-        "https://cdn.jsdelivr.net/npm/bootstrap@5.1.3/dist/css/bootstrap.min.css"])
+def create_and_store_label(order):
+    """ renders the order's label, stores it in GCS and sets order.label_url; with LABEL_ZPL the
+    ZPL version is stored alongside it, under the same name but with a .zpl extension """
+    order.label_url = store_label_to_gcs(create_label(order), order)
+    if LABEL_ZPL:
+        store_label_to_gcs(zpl_label.render(order), order, extension="zpl", content_type="application/x-zpl")
 
 
-def store_label_to_gcs(pdf_bytes, order):
-    """ writes PDF bytes to GCS bucket, naming file by:
+def store_label_to_gcs(pdf_bytes, order, extension="pdf", content_type='application/pdf'):
+    """ writes PDF bytes (or another label format) to GCS bucket, naming file by:
 
     "last_name - square_order_number.pdf"
+
+    The upload overwrites any existing object of the same name, so this is a single request;
+    the bucket and blob handles are built locally without fetching their metadata first.
     """
-    bucket = client.get_bucket(GCS_BUCKET)
+    bucket = client.bucket(GCS_BUCKET)
     # create filename
-    file_name = f"{os.environ['EVENT_DATE']}/{order.last_name} - {order.square_order_number}.pdf"
+    file_name = f"{EVENT_DATE}/{order.last_name} - {order.square_order_number}.{extension}"
     log("uploading label file to GCS bucket as %s", file_name)
-    blob = bucket.get_blob(file_name)
-    if not blob:
-        blob = bucket.blob(file_name)
-    blob.upload_from_string(pdf_bytes, content_type='application/pdf')
+    blob = bucket.blob(file_name)
+    with span("gcs.upload", content_type=content_type, bytes=len(pdf_bytes)):
+        blob.upload_from_string(pdf_bytes, content_type=content_type)
     return blob.self_link
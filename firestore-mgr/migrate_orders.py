@@ -0,0 +1,75 @@
+""" Moves orders out of the legacy shared `orders` table into the per-event table for EVENT_DATE.
+
+    Creates the per-event table (with its check-in lookup indexes) if needed, adds any indexes
+    missing from an existing per-event table, then copies the rows created in the given window
+    with INSERT IGNORE ... SELECT, so it can be re-run safely and never clobbers rows the
+    function has already written. The legacy table is left untouched.
+
+    Needs the same environment variables as the cloud function, e.g.:
+
+        env $(cat .env) python migrate_orders.py --since 2024-11-01 --until 2024-12-07
+"""
+# pylint: disable=redefined-outer-name,unused-argument,no-member
+
+import argparse
+from datetime import datetime
+
+from sqlalchemy import MetaData, func, inspect, insert, select
+
+import main
+
+LEGACY_TABLE = "orders"
+
+
+def ensure_indexes():
+    """ creates any of the Order indexes that the per-event table doesn't have yet """
+    existing = {index['name'] for index in inspect(main.mysql_engine).get_indexes(main.Order.__tablename__)}
+    for index in main.Order.__table__.indexes:
+        if index.name not in existing:
+            main.log("creating index %s", index.name)
+            index.create(main.mysql_engine)
+
+
+def migrate():
+    """ parses arguments and copies the matching legacy rows into the per-event table """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", maxsplit=1)[0])
+    parser.add_argument("--source-table", default=LEGACY_TABLE,
+                        help="table to copy orders from")
+    parser.add_argument("--since", type=datetime.fromisoformat,
+                        help="copy orders created at or after this time")
+    parser.add_argument("--until", type=datetime.fromisoformat,
+                        help="copy orders created before this time")
+    parser.add_argument("--all", action="store_true",
+                        help="copy every order in the source table regardless of created_at")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="only report how many rows would be copied")
+    args = parser.parse_args()
+    if not args.all and args.since is None:
+        parser.error("--since is required unless --all is given")
+
+    main.ensure_schema()
+    ensure_indexes()
+
+    target = main.Order.__table__
+    source = target.to_metadata(MetaData(), name=args.source_table)
+    source.indexes.clear()
+    columns = [column.name for column in target.columns]
+
+    query = select(*[source.c[name] for name in columns])
+    if not args.all:
+        query = query.where(source.c.created_at >= args.since)
+        if args.until is not None:
+            query = query.where(source.c.created_at < args.until)
+
+    with main.mysql_engine.begin() as connection:
+        matching = connection.execute(select(func.count()).select_from(query.subquery())).scalar()
+        if args.dry_run:
+            main.log("%s rows in %s would be copied into %s", matching, args.source_table, target.name)
+            return
+        result = connection.execute(insert(target).prefix_with("IGNORE").from_select(columns, query))
+        main.log("copied %s of %s matching rows from %s into %s (the rest already existed)",
+                 result.rowcount, matching, args.source_table, target.name)
+
+
+if __name__ == "__main__":
+    migrate()
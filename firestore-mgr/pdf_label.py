@@ -0,0 +1,313 @@
+""" Writes order labels straight to PDF, without going through HTML/CSS layout.
+
+    label_template.html (through label_body.html) and label.css describe a fixed design: a two by
+    two table of order details, a rule, a table of concert/dinner ticket counts with an optional
+    note below it, another rule and, when labels carry one, the check-in QR code (checkin_code).
+    This module reproduces that design as WeasyPrint lays it out with Bootstrap, using PDF
+    drawing operators and the standard Helvetica fonts (which PDF viewers and printers supply
+    themselves, so nothing is embedded). Their metrics are embedded below, so producing a label
+    is string formatting rather than a layout pass.
+
+    It only applies while the templates are the ones it was written against (layout_matches())
+    and to orders whose text fits on one line per cell; otherwise render() returns None and the
+    caller falls back to WeasyPrint.
+"""
+
+import functools
+import hashlib
+import unicodedata
+import zlib
+
+import checkin_code
+
+# template files whose content the layout below reproduces; see layout_matches()
+LAYOUT_FILES = ("label_template.html", "label_body.html", "label_sheet.html", "label.css")
+KNOWN_LAYOUT_DIGEST = "b2dcbdd99a97db52701ff72ef51b81406c14bd66ce8001883695ec29903a32c1"
+
+# Adobe AFM advance widths (1/1000 em) for the printable ASCII range, space (32) to tilde (126)
+HELVETICA_WIDTHS = [
+    278, 278, 355, 556, 556, 889, 667, 191, 333, 333, 389, 584, 278, 333, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 278, 278, 584, 584, 584, 556,
+    1015, 667, 667, 722, 722, 667, 611, 778, 722, 278, 500, 667, 556, 833, 722, 778,
+    667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 278, 278, 278, 469, 556,
+    333, 556, 556, 500, 556, 556, 278, 556, 556, 222, 222, 500, 222, 833, 556, 556,
+    556, 556, 333, 500, 278, 556, 500, 722, 500, 500, 500, 334, 260, 334, 584,
+]
+HELVETICA_BOLD_WIDTHS = [
+    278, 333, 474, 556, 556, 889, 722, 238, 333, 333, 389, 584, 278, 333, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 333, 333, 584, 584, 584, 611,
+    975, 722, 722, 722, 722, 667, 611, 778, 722, 278, 556, 722, 611, 833, 722, 778,
+    667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 333, 278, 333, 584, 556,
+    333, 556, 611, 556, 611, 556, 333, 611, 611, 278, 278, 556, 278, 889, 611, 611,
+    611, 611, 389, 556, 333, 611, 556, 778, 556, 556, 500, 389, 280, 389, 584,
+]
+
+# PDF resource name, base font and widths; the oblique faces share their upright widths
+FONTS = {
+    'regular': ("F1", "Helvetica", HELVETICA_WIDTHS),
+    'bold': ("F2", "Helvetica-Bold", HELVETICA_BOLD_WIDTHS),
+    'bold-italic': ("F3", "Helvetica-BoldOblique", HELVETICA_BOLD_WIDTHS),
+}
+# vertical metrics (em) of Arial/Liberation Sans, which browsers use for Helvetica text
+ASCENT, DESCENT = 0.905, 0.212
+UNDERLINE_OFFSET, UNDERLINE_THICKNESS = 0.1, 0.05
+
+# geometry in CSS px, as WeasyPrint lays out an A4 page with its default 75px margin
+PAGE_WIDTH_PX, PAGE_HEIGHT_PX = 793.7, 1122.5
+PAGE_WIDTH_PT, PAGE_HEIGHT_PT = 595.28, 841.89
+MARGIN = 75
+CONTAINER_PADDING = 12  # Bootstrap .container horizontal padding
+CELL_PADDING = 8  # Bootstrap .table cell padding
+TABLE_MARGIN = 16  # Bootstrap .table bottom margin, collapsing with the <hr> top margin
+LINE_HEIGHT = 1.5
+CODE_MARGIN = 20  # .checkinCode top margin, which the <hr> bottom margin collapses into
+
+BODY_SIZE, TITLE_SIZE, VALUE_SIZE = 16, 24, 192
+TEXT_COLOR = (0.129, 0.145, 0.161)  # Bootstrap body colour, #212529
+MUTED_COLOR = (0.424, 0.459, 0.490)  # caption colour, #6c757d
+BORDER_COLOR = (0.871, 0.886, 0.902)  # table cell borders, #dee2e6
+RULE_COLOR = (0.782, 0.786, 0.790)  # <hr>: the body colour at 25% opacity
+
+
+@functools.lru_cache(maxsize=1)
+def layout_matches(searchpath="./"):
+    """ True when the label templates on disk are the ones this module reproduces """
+    digest = hashlib.sha256()
+    for name in LAYOUT_FILES:
+        with open(f"{searchpath}{name}", "rb") as layout_file:
+            digest.update(layout_file.read())
+    return digest.hexdigest() == KNOWN_LAYOUT_DIGEST
+
+
+def char_width(char, widths):
+    """ advance width of one character in 1/1000 em; accented letters use their base letter """
+    code = ord(unicodedata.normalize("NFD", char)[0])
+    if 32 <= code <= 126:
+        return widths[code - 32]
+    return 556
+
+
+def text_width(text, font, size):
+    """ width of text in px when set in the given font at the given size """
+    widths = FONTS[font][2]
+    return sum(char_width(char, widths) for char in text) * size / 1000
+
+
+def pdf_string(text):
+    """ encodes text as a PDF literal string in WinAnsiEncoding, or None if it can't be """
+    try:
+        encoded = text.encode("cp1252")
+    except UnicodeEncodeError:
+        return None
+    return b"(" + encoded.replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)") + b")"
+
+
+def collapse(value):
+    """ renders a template value the way HTML displays it: as Jinja prints it, whitespace collapsed """
+    return " ".join(str(value).split())
+
+
+def pdf_number(value, places=2):
+    """ formats a number for a content stream as briefly as possible, e.g. 12.50 -> 12.5 """
+    text = (b"%.*f" % (places, value)).rstrip(b"0").rstrip(b".")
+    return text if text not in (b"", b"-") else b"0"
+
+
+class Page:
+    """ accumulates drawing operators for one page, in CSS px with the origin at the top left """
+
+    def __init__(self):
+        # scale px to pt and flip the y axis so that y grows down the page as in CSS
+        self.ops = [b"0.75 0 0 -0.75 0 %s cm" % pdf_number(PAGE_HEIGHT_PT)]
+        self.fits = True
+        self.fonts = set()
+        self.color = None
+
+    def fill(self, color):
+        """ sets the fill colour, only emitting the operator when it changes """
+        if color != self.color:
+            self.ops.append(b"%s %s %s rg" % tuple(pdf_number(component, 3) for component in color))
+            self.color = color
+
+    def rect(self, x, y, width, height, color):
+        """ fills a rectangle """
+        self.fill(color)
+        self.ops.append(b"%s %s %s %s re f" % tuple(pdf_number(value) for value in (x, y, width, height)))
+
+    def text(self, x, baseline, text, font, size, color=TEXT_COLOR, underline=False):
+        """ sets one line of text with its baseline at the given y """
+        encoded = pdf_string(text)
+        if encoded is None:
+            self.fits = False
+            return
+        self.fonts.add(font)
+        self.fill(color)
+        self.ops.append(b"BT /%s %d Tf 1 0 0 -1 %s %s Tm %s Tj ET"
+                        % (FONTS[font][0].encode(), size, pdf_number(x), pdf_number(baseline), encoded))
+        if underline:
+            self.rect(x, baseline + UNDERLINE_OFFSET * size, text_width(text, font, size),
+                      UNDERLINE_THICKNESS * size, color)
+
+    def image_mask(self, x, y, modules, module_size, color):
+        """ paints the True cells of a grid of modules as module_size squares from (x, y): a
+        1-bit image mask, so a QR code costs a bit per module rather than a rectangle each """
+        self.fill(color)
+        bits = ("".join("1" if dark else "0" for dark in row) for row in modules)
+        # each row is padded out to whole bytes
+        rows = b"".join(int(row.ljust(-(-len(row) // 8) * 8, "0"), 2).to_bytes(-(-len(row) // 8), "big")
+                        for row in bits)
+        width, height = len(modules[0]) * module_size, len(modules) * module_size
+        self.ops.append(b"q %s 0 0 -%s %s %s cm BI /W %d /H %d /IM true /BPC 1 /D [1 0] /F /AHx ID %s> EI Q"
+                        % (pdf_number(width), pdf_number(height), pdf_number(x), pdf_number(y + height),
+                           len(modules[0]), len(modules), rows.hex().encode()))
+
+    def content(self):
+        """ the page's content stream """
+        return b"\n".join(self.ops)
+
+
+def column_widths(max_content, available):
+    """ auto table layout when everything fits on one line: each column gets its max-content
+    width plus a share of the spare width proportional to it; None if the cells would wrap """
+    total = sum(max_content)
+    if total > available:
+        return None
+    return [width + (available - total) * width / total for width in max_content]
+
+
+def baseline(line_top, size):
+    """ y of the baseline of a line box starting at line_top """
+    return line_top + (LINE_HEIGHT - ASCENT - DESCENT) * size / 2 + ASCENT * size
+
+
+def draw_details(page, order, top, left, width):
+    """ the two by two table of order details; returns the y of its bottom edge """
+    cells = [[f"Name: {collapse(order.customer_name)}", f"Phone: {collapse(order.phone_number)}"],
+             [f"Order #: {collapse(order.square_order_number)}", f"Total: ${order.total:,.2f}"]]
+    widths = column_widths([max(text_width(row[column], 'regular', TITLE_SIZE) for row in cells)
+                            + 2 * CELL_PADDING for column in range(2)], width)
+    if widths is None:
+        page.fits = False
+        return top
+    row_height = 2 * CELL_PADDING + LINE_HEIGHT * TITLE_SIZE
+    for number, row in enumerate(cells):
+        row_top = top + number * (row_height + 1)
+        page.text(left + CELL_PADDING, baseline(row_top + CELL_PADDING, TITLE_SIZE), row[0], 'regular', TITLE_SIZE)
+        page.text(left + widths[0] + CELL_PADDING, baseline(row_top + CELL_PADDING, TITLE_SIZE), row[1],
+                  'regular', TITLE_SIZE)
+    # the cell borders are drawn after the text so the fill colour only changes once
+    for number in range(len(cells)):
+        page.rect(left, top + (number + 1) * row_height + number, width, 1, BORDER_COLOR)
+    return top + len(cells) * (row_height + 1)
+
+
+def draw_tickets(page, order, top, left, width):
+    """ the concert/dinner ticket counts with the optional note below; returns its bottom y """
+    headers = ["Concert Tickets", "Dinner Tickets"]
+    values = [collapse(count) if count > 0 else "" for count in (order.concert, order.dinner)]
+    widths = column_widths([max(text_width(headers[column], 'bold-italic', TITLE_SIZE),
+                                text_width(values[column], 'bold', VALUE_SIZE)) + 2 * CELL_PADDING
+                            for column in range(2)], width)
+    note = f"Note: {collapse(order.note)}" if order.note else None
+    if widths is None or (note and text_width(note, 'regular', BODY_SIZE) > width - 2 * CELL_PADDING):
+        page.fits = False
+        return top
+    divider = left + widths[0]
+
+    if note:
+        # the caption comes first in the markup, so Bootstrap also rules off the top of the header
+        page.rect(left, top, width, 2, TEXT_COLOR)
+        top += 2
+    header_height = 2 * CELL_PADDING + LINE_HEIGHT * TITLE_SIZE
+    for column, text in enumerate(headers):
+        column_left = left if column == 0 else divider
+        page.text(column_left + (widths[column] - text_width(text, 'bold-italic', TITLE_SIZE)) / 2,
+                  baseline(top + CELL_PADDING, TITLE_SIZE), text, 'bold-italic', TITLE_SIZE)
+    page.rect(divider, top, 1, header_height, TEXT_COLOR)
+    top += header_height
+    page.rect(left, top, width, 2, TEXT_COLOR)  # Bootstrap rules off the tbody from the thead
+    top += 2
+
+    value_height = 2 * CELL_PADDING + (LINE_HEIGHT * VALUE_SIZE if any(values) else 0)
+    for column, text in enumerate(values):
+        if text:
+            column_left = left if column == 0 else divider
+            page.text(column_left + (widths[column] - text_width(text, 'bold', VALUE_SIZE)) / 2,
+                      baseline(top + CELL_PADDING, VALUE_SIZE), text, 'bold', VALUE_SIZE)
+    page.rect(divider, top, 1, value_height, TEXT_COLOR)
+    page.rect(left, top + value_height, width, 1, BORDER_COLOR)
+    top += value_height + 1
+
+    if note:
+        page.text(left, baseline(top + CELL_PADDING, BODY_SIZE), note, 'regular', BODY_SIZE,
+                  color=MUTED_COLOR, underline=True)
+        top += 2 * CELL_PADDING + LINE_HEIGHT * BODY_SIZE
+    return top
+
+
+def draw_label(order):
+    """ lays out one order's label on a page; None if it needs anything beyond the fast path """
+    page = Page()
+    left = MARGIN + CONTAINER_PADDING
+    width = PAGE_WIDTH_PX - 2 * left
+    top = draw_details(page, order, MARGIN, left, width)
+    top += TABLE_MARGIN
+    page.rect(left, top, width, 1, RULE_COLOR)
+    top += 1 + TABLE_MARGIN
+    top = draw_tickets(page, order, top, left, width)
+    top += TABLE_MARGIN
+    page.rect(left, top, width, 1, RULE_COLOR)
+    top += 1
+    data = checkin_code.payload(order)
+    if data is not None:
+        page.image_mask(left, top + CODE_MARGIN, checkin_code.matrix(data), checkin_code.MODULE_PX, (0, 0, 0))
+    return page if page.fits else None
+
+
+def write_pdf(pages, compress=True):
+    """ assembles a PDF document from the pages; with compress the content streams are
+    Flate-compressed, and either way only the fonts the pages use are referenced """
+    used = [name for name in FONTS if any(name in page.fonts for page in pages)]
+    font_ids = {name: 3 + number for number, name in enumerate(used)}
+    page_ids = [3 + len(used) + 2 * number for number in range(len(pages))]
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [%s] /Count %d /MediaBox [0 0 %s %s] >>"
+        % (b" ".join(b"%d 0 R" % page_id for page_id in page_ids), len(page_ids),
+           pdf_number(PAGE_WIDTH_PT), pdf_number(PAGE_HEIGHT_PT)),
+    ]
+    for name in used:
+        objects.append(b"<< /Type /Font /Subtype /Type1 /BaseFont /%s /Encoding /WinAnsiEncoding >>"
+                       % FONTS[name][1].encode())
+    for page_id, page in zip(page_ids, pages):
+        fonts = b"".join(b"/%s %d 0 R" % (FONTS[name][0].encode(), font_ids[name])
+                         for name in used if name in page.fonts)
+        objects.append(b"<< /Type /Page /Parent 2 0 R /Resources << /Font << %s >> >> /Contents %d 0 R >>"
+                       % (fonts, page_id + 1))
+        content = page.content()
+        if compress:
+            content = zlib.compress(content, 9)
+            objects.append(b"<< /Length %d /Filter /FlateDecode >>\nstream\n%s\nendstream"
+                           % (len(content), content))
+        else:
+            objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(content), content))
+
+    output = bytearray(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(output))
+        output += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(output)
+    output += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    output += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    output += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(output)
+
+
+def render(orders, compress=True):
+    """ renders the orders' labels, one per page, or returns None if any of them can't be done
+    on the fast path and the whole document should be rendered by WeasyPrint instead """
+    pages = [draw_label(order) for order in orders]
+    if not pages or None in pages:
+        return None
+    return write_pdf(pages, compress=compress)
@@ -0,0 +1,64 @@
+""" Renders the labels for many orders into one multi-page PDF for pre-printing before the event.
+
+    Selects the orders for EVENT_DATE from MySQL (by default only those still PLACED, i.e. the
+    pre-paid orders that haven't checked in), sorts them and lays them all out in a single
+    WeasyPrint pass, one label per page, streaming the PDF to the GCS bucket next to the
+    per-order labels.
+
+    Needs the same environment variables as the cloud function and must be run from this
+    directory (the templates and stylesheet are loaded relative to it), e.g.:
+
+        env $(cat .env) python print_labels.py --sort last_name
+"""
+# pylint: disable=redefined-outer-name,unused-argument,no-member
+
+import argparse
+import time
+
+import main
+
+SORT_KEYS = {
+    'label_number': (main.Order.label_number,),
+    'last_name': (main.Order.last_name, main.Order.customer_name, main.Order.label_number),
+}
+
+
+def select_orders(sort, statuses):
+    """ returns the matching orders, detached from their session, in print order """
+    with main.mysql_session_scope() as session:
+        query = session.query(main.Order).order_by(*SORT_KEYS[sort])
+        if statuses:
+            query = query.filter(main.Order.status.in_(statuses))
+        orders = query.all()
+        session.expunge_all()
+    return orders
+
+
+def print_labels():
+    """ parses arguments, renders the label sheet and uploads it """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", maxsplit=1)[0])
+    parser.add_argument("--sort", choices=sorted(SORT_KEYS), default='label_number',
+                        help="order in which labels are printed")
+    parser.add_argument("--status", action="append", choices=[state.name for state in main.OrderState],
+                        help="only print orders in this state (repeatable; default PLACED)")
+    parser.add_argument("--all", action="store_true",
+                        help="print every order regardless of its state")
+    parser.add_argument("--output",
+                        help="object name within the event folder (default labels-<sort>.pdf)")
+    args = parser.parse_args()
+
+    statuses = [] if args.all else [main.OrderState[name] for name in args.status or ['PLACED']]
+    orders = select_orders(args.sort, statuses)
+    if not orders:
+        main.log("no orders to print")
+        return
+
+    start = time.perf_counter()
+    url = main.write_label_sheet(orders, args.output or f"labels-{args.sort}.pdf")
+    elapsed = time.perf_counter() - start
+    main.log("rendered %s labels in %.1fs (%.1f labels/s) to %s", len(orders), elapsed,
+             len(orders) / elapsed, url)
+
+
+if __name__ == "__main__":
+    print_labels()
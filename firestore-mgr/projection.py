@@ -0,0 +1,303 @@
+""" Projects Firestore order documents into order rows.
+
+    Every column of the orders table is described once, in FIELDS: how to compute it from the
+    document, which update mask paths change it and whether it is printed on the label. A
+    Projector compiles that spec into a single pass over a document. The parts of the document
+    several fields read (the pickup recipient, the fallback customer name) are resolved once per
+    document by DocView, and one set of projected values feeds the MySQL row, the Sheets row and
+    the label.
+"""
+from datetime import datetime
+import enum
+import functools
+import json
+import os
+import re
+import types
+import typing
+
+
+CATALOG_PATH = os.environ.get('CATALOG_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                           "catalog.json"))
+
+
+class OrderState(enum.Enum):
+    """ OrderState docstring """
+    PLACED = 1
+    ARRIVED = 2
+    CANCELLED = 3
+
+
+def extract_pickup_time(order) -> str:
+    """ extracts the earliest pickup time from an order"""
+#    min_pickup_time = ""
+#    for line_item in order['line_items']:
+#        if (line_item['name'] == "Jambalaya Meal" or line_item['name'] == "Pasta-laya Meal") and line_item['variation_name']:
+#            if min_pickup_time == "" or line_item['variation_name'] < min_pickup_time:
+#                min_pickup_time = line_item['variation_name']
+#
+#    if min_pickup_time == "":
+#        min_pickup_time = "5:00PM-6:00PM Serving"
+#
+#    return min_pickup_time
+    return "6:00PM-6:15PM Serving"
+
+
+def extract_drinks(order):
+    """ This extracts a list of KVPs of type of beer and quantity """
+    beers = 0
+#    for line_item in order['line_items']:
+#        if line_item['name'] == "Drink Ticket (Beer or Wine)":
+#            beers += int(line_item['quantity'])
+#        elif line_item['name'] == "Brüeprint Draft Beer Ticket":
+#            if not beers.get("Draft"):
+#                beers["Draft"] = 0
+#            beers["Draft"] += int(line_item['quantity'])
+
+    return beers
+
+
+class Catalog:
+    """ maps Square line items to the order counters (columns) they add to.
+
+    The catalog file lists the menu's line items; each entry matches on any of its Square
+    catalog variation ids (catalog_object_id) or else on its name, and adds its quantity or its
+    total in dollars, times a multiplier, to each of the counters it names, e.g.
+
+        {"name": "Concert and Dinner", "variation_ids": ["..."], "quantity": {"concert": 1, "dinner": 1}}
+        {"name": "Donation", "variation_ids": ["..."], "money": {"donations": 1}}
+
+    Adding a menu item, or a counter column to Order, is then a catalog change rather than code.
+    """
+
+    def __init__(self, entries):
+        self.columns = []
+        steps_by_entry = []
+        for entry in entries:
+            steps = []
+            for kind in ("quantity", "money"):
+                for column, multiplier in entry.get(kind, {}).items():
+                    if column not in self.columns:
+                        self.columns.append(column)
+                    steps.append((self.columns.index(column), multiplier, kind == "money"))
+            steps_by_entry.append((entry, tuple(steps)))
+        money_columns = {index for _, steps in steps_by_entry for index, _, money in steps if money}
+        self.zero = [0.0 if index in money_columns else 0 for index in range(len(self.columns))]
+        self.by_id = {variation_id: steps for entry, steps in steps_by_entry
+                      for variation_id in entry.get("variation_ids", [])}
+        self.by_name = {entry["name"]: steps for entry, steps in steps_by_entry if entry.get("name")}
+
+    def count(self, line_items, log=print) -> list:
+        """ one pass over the line items, returning the counters in the order of self.columns """
+        counters = list(self.zero)
+        for line_item in line_items:
+            steps = self.by_id.get(line_item.get('catalog_object_id')) or self.by_name.get(line_item.get('name'))
+            if steps is None:
+                log("line item %s (%s) is not in the catalog", line_item.get('name'),
+                    line_item.get('catalog_object_id'))
+                continue
+            for index, multiplier, money in steps:
+                if money:
+                    counters[index] += line_item['total_money']['amount'] / 100 * multiplier
+                else:
+                    counters[index] += int(line_item['quantity']) * multiplier
+        return counters
+
+
+@functools.lru_cache(maxsize=None)
+def load_catalog(path=CATALOG_PATH) -> Catalog:
+    """ reads the catalog file, once per instance """
+    with open(path, encoding="utf-8") as catalog_file:
+        return Catalog(json.load(catalog_file)["line_items"])
+
+
+def is_unknown(name) -> bool:
+    """ Square fills in "unknown" for names a customer didn't give """
+    return not name or name == "unknown"
+
+
+class DocView:  # pylint: disable=too-few-public-methods
+    """ an order document plus the lookups that several fields share, each resolved at most once """
+
+    def __init__(self, doc: dict, log=print):
+        self.doc = doc
+        self.order = doc['order']
+        self.customer = doc['customer']
+        self.payment = doc.get('payment')
+        self.log = log
+        # the pickup details of the order's first fulfillment, if any
+        fulfillments = self.order.get('fulfillments')
+        self.pickup_details = fulfillments[0].get('pickup_details') if fulfillments else None
+        self._recipient_name = DocView
+
+    @property
+    def recipient_name(self):
+        """ (given, family) name of whoever picks the order up: split from the pickup recipient's
+        display name, else taken from the shipping address; None if neither is available """
+        if self._recipient_name is DocView:
+            self._recipient_name = None
+            if self.pickup_details:
+                display_name = self.pickup_details['recipient'].get('display_name')
+                if display_name:
+                    name_tokens = display_name.split(" ")
+                    self._recipient_name = " ".join(name_tokens[:-1]), name_tokens[-1]
+            elif self.payment is not None:
+                address = self.payment['shipping_address']
+                self._recipient_name = address['first_name'], address['last_name']
+        return self._recipient_name
+
+
+def customer_names(view):
+    """ customer_name and last_name; where the customer record's names are unknown the
+    recipient's name is used (for customer_name, if either part is unknown) """
+    given_name = view.customer.get('given_name')
+    family_name = last_name = view.customer.get('family_name')
+    if view.recipient_name is not None:
+        if is_unknown(given_name) or is_unknown(family_name):
+            given_name, family_name = view.recipient_name
+        if is_unknown(last_name):
+            last_name = view.recipient_name[1]
+    return f"{given_name} {family_name}".title(), last_name.title()
+
+
+def square_order_number(view):
+    """ the number Square shows the customer, falling back on our own order number """
+    if view.payment is not None:
+        return view.payment.get('reference_id', view.doc['order_number'])
+    return view.doc['order_number']
+
+
+def line_item_counters(view):
+    """ the catalog's counters (concert and dinner tickets, donations, ...) in one pass over the
+    line items; a lone counter is returned as a single column value """
+    counters = load_catalog().count(view.order['line_items'], view.log)
+    return counters[0] if len(counters) == 1 else counters
+
+
+def phone_number(view):
+    """ the customer's phone number, else the pickup recipient's, as digits """
+    number = view.customer.get('phone_number')
+    if not number and view.pickup_details:
+        number = view.pickup_details['recipient'].get('phone_number')
+    return number.replace("+", "").replace("-", "") if number is not None else ""
+
+
+def fees(view):
+    """ Square's processing fee, else 0 (the column's default) if the payment has none """
+    try:
+        return view.payment['processing_fee'][0]['amount_money']['amount'] / 100
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        view.log("exception determining fees: %s", e)
+        return 0.0
+
+
+def note(view):
+    """ the order note, else the pickup note """
+    text = view.order.get('note')
+    if not text and view.pickup_details:
+        text = view.pickup_details.get('note')
+    return text
+
+
+def status(view):
+    """ the pickup status; orders that haven't been picked up are PLACED """
+    try:
+        return OrderState[view.doc['pickup']['status']]
+    except Exception:  # pylint: disable=broad-exception-caught
+        return OrderState.PLACED
+
+
+def checkin_time(view):
+    """ when the order was checked in, if it has been """
+    try:
+        return view.doc['pickup']['checkin_time']
+    except Exception:  # pylint: disable=broad-exception-caught
+        return None
+
+
+class Field(typing.NamedTuple):
+    """ one or more columns computed together from an order document """
+    columns: tuple
+    paths: tuple  # update mask field paths (regexes) that change the columns
+    on_label: bool  # whether the columns are printed on the label
+    extract: typing.Callable
+
+
+FIELDS = [
+    Field(('id',), (r"^order.id$",), True, lambda view: view.order['id']),  # in the check-in code
+    Field(('created_at',), (r"^order.created_at$",), False,
+          lambda view: datetime.fromisoformat(view.order['created_at'])),
+    Field(('label_number',), (r"^order_number$",), False, lambda view: view.doc['order_number']),
+    Field(('square_order_number',), (r"^payment.reference_id$",), True, square_order_number),
+    Field(('receipt_url',), (r"^payment.receipt_url$",), False,
+          lambda view: view.payment['receipt_url'] if view.payment is not None else None),
+    Field(('pickup_window',), (r"^order.line_items.*",), False, lambda view: extract_pickup_time(view.order)),
+    Field(('customer_name', 'last_name'),
+          (r"^order.fulfillments$", r"^customer.given_name$", r"^customer.family_name$"), True, customer_names),
+    Field(('phone_number',), (r"^customer.phone_number$",), True, phone_number),
+    Field(tuple(load_catalog().columns), (r"^order.line_items.*",), True, line_item_counters),
+    Field(('tip',), (r"^order.total_tip_money.amount$",), False,
+          lambda view: view.order['total_tip_money']['amount'] / 100),
+    Field(('total',), (r"^order.total_money.amount$",), True, lambda view: view.order['total_money']['amount'] / 100),
+    Field(('fees',), (r"^payment.processing_fee.*",), False, fees),
+    Field(('note',), (r"^order.note$", r"^order.fulfillments$"), True, note),
+    Field(('status',), (r"^pickup.*",), False, status),
+    Field(('checkin_time',), (r"^pickup.*",), False, checkin_time),
+]
+
+
+class Projector:
+    """ a field spec compiled into a single-pass extractor from order documents to column values """
+
+    def __init__(self, fields, log=print):
+        self.fields = list(fields)
+        self.columns = [column for field in self.fields for column in field.columns]
+        self.label_columns = [column for field in self.fields if field.on_label for column in field.columns]
+        self.paths = [(re.compile(path), field) for field in self.fields for path in field.paths]
+        self.log = log
+        self._masks = {}
+        self._all = self._compile(self.fields)
+
+    @staticmethod
+    def _compile(fields):
+        """ flattens fields into (extract, column, columns) steps; column is None for fields that
+        produce several columns at once """
+        return [(field.extract, field.columns[0] if len(field.columns) == 1 else None, field.columns)
+                for field in fields]
+
+    def _match(self, update_mask):
+        """ (fields, compiled steps, touches label) for the field paths in update_mask; masks
+        repeat a lot, so the matching is done once per distinct set of field paths """
+        field_paths = tuple(update_mask['fieldPaths'])
+        match = self._masks.get(field_paths)
+        if match is None:
+            matched = {id(field) for regex, field in self.paths
+                       if any(regex.match(field_path) for field_path in field_paths)}
+            fields = [field for field in self.fields if id(field) in matched]
+            match = (fields, self._compile(fields), any(field.on_label for field in fields))
+            self._masks[field_paths] = match
+        return match
+
+    def fields_for(self, update_mask) -> list:
+        """ the fields (in spec order) that any of the field paths in update_mask change """
+        return self._match(update_mask)[0]
+
+    def touches_label(self, update_mask) -> bool:
+        """ whether any of the fields that update_mask changes are printed on the label """
+        return self._match(update_mask)[2]
+
+    def project(self, doc: dict, update_mask=None) -> dict:
+        """ projects doc into a dict of column name -> value; with update_mask, only the
+        columns of the fields it changes are projected """
+        view = DocView(doc, self.log)
+        values = {}
+        for extract, column, columns in self._all if update_mask is None else self._match(update_mask)[1]:
+            if column is not None:
+                values[column] = extract(view)
+            else:
+                values.update(zip(columns, extract(view)))
+        return values
+
+    def label_context(self, values: dict):
+        """ the projected values the label template and label writers read, as attributes """
+        return types.SimpleNamespace(**{column: values.get(column) for column in self.label_columns})
@@ -0,0 +1,66 @@
+""" Reconciles the Google Sheet against the MySQL orders table.
+
+    Streams every order from MySQL, compares per-row content hashes with the sheet and writes
+    only the differing cells in one batched update (appending orders missing from the sheet).
+    It only reads from MySQL and never deletes sheet rows, so it is safe to run during the event.
+
+    Needs the same environment variables as the cloud function, e.g.:
+
+        env $(cat .env) python reconcile.py --dry-run
+"""
+# pylint: disable=redefined-outer-name,unused-argument,no-member
+
+import argparse
+
+import main
+from sheets_sync import Reconciler
+
+
+def stream_orders(batch_size):
+    """ yields every order in MySQL as a sheet row dict without loading them all at once """
+    session = main.mysql_sessionmaker()
+    try:
+        for order in session.query(main.Order).yield_per(batch_size):
+            yield order.sheets_row()
+    finally:
+        session.close()
+
+
+def refetch_orders(order_ids):
+    """ re-reads the given orders from MySQL right before their cells are written """
+    session = main.mysql_sessionmaker()
+    try:
+        return [order.sheets_row()
+                for order in session.query(main.Order).filter(main.Order.id.in_(order_ids))]
+    finally:
+        session.close()
+
+
+def reconcile():
+    """ parses arguments, runs the reconciliation and prints a report """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", maxsplit=1)[0])
+    parser.add_argument("--dry-run", action="store_true",
+                        help="compare and report, but don't write to the sheet")
+    parser.add_argument("--batch-size", type=int, default=500,
+                        help="rows fetched per round trip from MySQL")
+    parser.add_argument("--page-size", type=int, default=1000,
+                        help="rows fetched per request from the sheet")
+    args = parser.parse_args()
+
+    reconciler = Reconciler(main.sheets_writer.backend,
+                            [column.name for column in main.Order.__table__.columns],
+                            log=main.log)
+    stats = reconciler.run(stream_orders(args.batch_size),
+                           refetch=refetch_orders,
+                           dry_run=args.dry_run,
+                           page_size=args.page_size)
+    main.log("reconciled %s rows in %.1fs (%.0f rows/s): %s differing, %s cells written, "
+             "%s rows appended, %s rows only in sheet%s",
+             stats["rows_checked"], stats["seconds"], stats["rows_per_second"],
+             stats["rows_differing"], stats["cells_written"], stats["rows_appended"],
+             stats["rows_only_in_sheet"], " (dry run)" if args.dry_run else "",
+             stats=stats)
+
+
+if __name__ == "__main__":
+    reconcile()
@@ -0,0 +1,132 @@
+""" Re-renders and re-uploads every label for EVENT_DATE, e.g. after label_template.html or
+    label.css changed mid-event.
+
+    Orders are streamed from MySQL, rendered in a process pool (WeasyPrint is CPU bound and
+    single threaded) and uploaded to GCS from a thread pool. Each order id is appended to a state
+    file once its label is uploaded, so an interrupted run picks up where it left off; pass
+    --restart to start over. Progress and throughput are logged as it goes.
+
+    Needs the same environment variables as the cloud function and must be run from this
+    directory (the template and stylesheet are loaded relative to it), e.g.:
+
+        env $(cat .env) python regenerate_labels.py --workers 8
+"""
+# pylint: disable=redefined-outer-name,unused-argument,no-member
+
+import argparse
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+import os
+import time
+
+import main
+import zpl_label
+
+
+def stream_orders(batch_size, skip):
+    """ yields every order for the event as a plain (picklable) dict, skipping ids in skip """
+    session = main.mysql_sessionmaker()
+    try:
+        for order in session.query(main.Order).order_by(main.Order.label_number).yield_per(batch_size):
+            if order.id not in skip:
+                yield order.sql_row()
+    finally:
+        session.close()
+
+
+def init_renderer():
+    """ runs once in each worker process: drop the MySQL connections inherited from the parent
+    without closing them, as the parent is still streaming orders over one of them """
+    main.mysql_engine.dispose(close=False)
+
+
+def render_label(row):
+    """ runs in a worker process: renders the label for one order """
+    return row, main.create_label(main.ORDER_PROJECTOR.label_context(row))
+
+
+def upload_label(row, pdf_bytes):
+    """ runs in an upload thread: stores the label (and its ZPL version, if enabled) and records a
+    changed label_url """
+    order = main.ORDER_PROJECTOR.label_context(row)
+    label_url = main.store_label_to_gcs(pdf_bytes, order)
+    if main.LABEL_ZPL:
+        main.store_label_to_gcs(zpl_label.render(order), order, extension="zpl", content_type="application/x-zpl")
+    if label_url != row['label_url']:
+        table = main.Order.__table__
+        with main.mysql_engine.begin() as connection:
+            connection.execute(table.update().where(table.c.id == row['id']).values(label_url=label_url))
+        main.sheets_writer.enqueue({'id': row['id'], 'label_url': label_url})
+    return row['id']
+
+
+def rendered(pool, rows, window):
+    """ yields (row, pdf_bytes) as renders complete, keeping at most `window` renders queued so
+    orders are streamed from MySQL rather than loaded all at once """
+    futures = set()
+    for row in rows:
+        futures.add(pool.submit(render_label, row))
+        if len(futures) >= window:
+            done, futures = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    for future in futures:
+        yield future.result()
+
+
+def regenerate():
+    """ parses arguments and regenerates all outstanding labels """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", maxsplit=1)[0])
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="label rendering processes")
+    parser.add_argument("--uploaders", type=int, default=8,
+                        help="concurrent GCS uploads")
+    parser.add_argument("--state", default=f"regenerate_labels-{main.EVENT_DATE}.state",
+                        help="file recording the order ids already done")
+    parser.add_argument("--restart", action="store_true",
+                        help="ignore the state file and regenerate every label")
+    parser.add_argument("--progress-every", type=int, default=25,
+                        help="log progress after this many labels")
+    args = parser.parse_args()
+
+    if args.restart and os.path.exists(args.state):
+        os.remove(args.state)
+    done_ids = set()
+    if os.path.exists(args.state):
+        with open(args.state, encoding="utf-8") as state:
+            done_ids = {line.strip() for line in state if line.strip()}
+        main.log("resuming: %s labels already regenerated", len(done_ids))
+
+    window = args.workers * 2
+    completed = 0
+    start = time.perf_counter()
+
+    def record(futures, state):
+        nonlocal completed
+        for future in futures:
+            state.write(future.result() + "\n")
+            completed += 1
+            if completed % args.progress_every == 0:
+                elapsed = time.perf_counter() - start
+                main.log("regenerated %s labels in %.1fs (%.1f labels/s)", completed, elapsed,
+                         completed / elapsed)
+        state.flush()
+
+    with open(args.state, "a", encoding="utf-8") as state, \
+            ProcessPoolExecutor(max_workers=args.workers, initializer=init_renderer) as renderers, \
+            ThreadPoolExecutor(max_workers=args.uploaders) as uploaders:
+        uploads = set()
+        for row, pdf_bytes in rendered(renderers, stream_orders(500, done_ids), window):
+            uploads.add(uploaders.submit(upload_label, row, pdf_bytes))
+            if len(uploads) >= window:
+                done, uploads = wait(uploads, return_when=FIRST_COMPLETED)
+                record(done, state)
+        record(wait(uploads).done, state)
+
+    main.sheets_writer.flush()
+    elapsed = time.perf_counter() - start
+    main.log("regenerated %s labels in %.1fs (%.1f labels/s); %s were already done", completed,
+             elapsed, completed / elapsed if elapsed else 0.0, len(done_ids))
+
+
+if __name__ == "__main__":
+    regenerate()
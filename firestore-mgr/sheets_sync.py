@@ -0,0 +1,619 @@
+""" Write-behind synchronization of order rows to the Google Sheet.
+
+    MySQL is the system of record; the sheet is a convenience view for volunteers. Rather than
+    committing to the Sheets API on every trigger, rows are queued per order id and flushed as
+    one batched range update once either SHEETS_FLUSH_ROWS rows are pending or the oldest
+    pending row is SHEETS_FLUSH_SECONDS old.
+
+    Those thresholds are checked inline, at the start of every invocation and on every enqueue,
+    but the invocation that finds them reached doesn't wait on the Sheets API if another is
+    already flushing, and a failed flush isn't retried inline until a backoff has passed.
+    Nothing flushes reliably once the instance goes quiet: the timer may never run while Cloud
+    Functions throttles the CPU between requests, and atexit hooks aren't run when the instance
+    is shut down. Rows still queued then reach the sheet with the instance's next invocation, or
+    not at all if it is reclaimed first; reconcile.py is the backstop that brings the sheet back
+    in line with MySQL.
+"""
+# pylint: disable=redefined-outer-name,unused-argument,no-member
+
+import atexit
+import contextlib
+from datetime import datetime
+import hashlib
+import re
+import threading
+import time
+
+SHEETS_SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
+SHEETS_API = "https://sheets.googleapis.com/v4/spreadsheets"
+# seconds to connect to and hear back from the Sheets API, so a hung request fails the flush
+# (and the rows are retried later) rather than holding up the invocation until it times out
+SHEETS_TIMEOUT = (5, 20)
+
+
+def no_span(name, **attributes):
+    """ the default span around sheet requests, which records nothing """
+    return contextlib.nullcontext({})
+
+
+def column_letter(index: int) -> str:
+    """ converts a zero-based column index into A1 notation (0 -> A, 26 -> AA) """
+    letters = ""
+    index += 1
+    while index > 0:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+    return letters
+
+
+class GoogleSheetsBackend:
+    """ Talks to the Sheets v4 REST API for a single tab of a spreadsheet.
+
+    The tab is identified by the gid in the sheet URL (the first tab if none is given).
+    """
+
+    def __init__(self, sheet_url: str, timeout=SHEETS_TIMEOUT):
+        match = re.search(r"/spreadsheets/d/([a-zA-Z0-9-_]+)", sheet_url)
+        if not match:
+            raise ValueError(f"could not find spreadsheet id in {sheet_url}")
+        self.spreadsheet_id = match.group(1)
+        gid = re.search(r"[#&?]gid=(\d+)", sheet_url)
+        self.gid = int(gid.group(1)) if gid else None
+        self.timeout = timeout
+        self._session = None
+        self._title = None
+
+    @property
+    def session(self):
+        """ lazily creates an authorized HTTP session using application default credentials """
+        if self._session is None:
+            import google.auth  # pylint: disable=import-outside-toplevel
+            from google.auth.transport.requests import AuthorizedSession  # pylint: disable=import-outside-toplevel
+
+            credentials, _ = google.auth.default(scopes=SHEETS_SCOPES)
+            self._session = AuthorizedSession(credentials)
+        return self._session
+
+    @property
+    def title(self):
+        """ resolves (and caches) the tab title that A1 ranges need to be qualified with """
+        if self._title is None:
+            response = self.session.get(f"{SHEETS_API}/{self.spreadsheet_id}",
+                                        params={"fields": "sheets.properties"}, timeout=self.timeout)
+            response.raise_for_status()
+            sheets = [sheet['properties'] for sheet in response.json()['sheets']]
+            for properties in sheets:
+                if self.gid is None or properties['sheetId'] == self.gid:
+                    self._title = properties['title']
+                    break
+            else:
+                raise KeyError(f"could not find tab with gid {self.gid}")
+        return self._title
+
+    def _range(self, a1_range):
+        title = self.title.replace("'", "''")
+        return f"'{title}'!{a1_range}"
+
+    def _get_values(self, a1_range):
+        response = self.session.get(
+            f"{SHEETS_API}/{self.spreadsheet_id}/values/{self._range(a1_range)}",
+            params={"valueRenderOption": "UNFORMATTED_VALUE",
+                    "dateTimeRenderOption": "FORMATTED_STRING"},
+            timeout=self.timeout)
+        response.raise_for_status()
+        return response.json().get('values', [])
+
+    def read_header(self):
+        """ returns the column names from the first row of the sheet """
+        values = self._get_values("1:1")
+        return values[0] if values else []
+
+    def write_header(self, header):
+        """ writes the column names into the first row of an empty sheet """
+        self.batch_update([(1, header)])
+
+    def read_column(self, index):
+        """ returns every value below the header in the given column """
+        letter = column_letter(index)
+        return [row[0] if row else "" for row in self._get_values(f"{letter}2:{letter}")]
+
+    def read_rows(self, first_row=2, last_row=1000000):
+        """ returns the rows between first_row and last_row (inclusive) """
+        return self._get_values(f"{first_row}:{last_row}")
+
+    def _batch_update(self, data):
+        response = self.session.post(f"{SHEETS_API}/{self.spreadsheet_id}/values:batchUpdate",
+                                     json={"valueInputOption": "USER_ENTERED", "data": data},
+                                     timeout=self.timeout)
+        response.raise_for_status()
+
+    def batch_update(self, updates):
+        """ overwrites rows, given as a list of (row_number, values) tuples, in one request; None
+        values are sent as null and leave their cell unchanged """
+        if not updates:
+            return
+        self._batch_update([
+            {"range": self._range(f"A{row_number}:{column_letter(len(values) - 1)}{row_number}"),
+             "values": [values]}
+            for row_number, values in updates])
+
+    def update_cells(self, cells):
+        """ overwrites single cells, given as a list of (row_number, column_index, value) tuples,
+        in one request """
+        if not cells:
+            return
+        self._batch_update([{"range": self._range(f"{column_letter(column)}{row_number}"),
+                             "values": [[value]]}
+                            for row_number, column, value in cells])
+
+    def append(self, rows):
+        """ appends rows after the last row of the sheet, returning the first row number written """
+        if not rows:
+            return None
+        response = self.session.post(
+            f"{SHEETS_API}/{self.spreadsheet_id}/values/{self._range('A1')}:append",
+            params={"valueInputOption": "USER_ENTERED", "insertDataOption": "INSERT_ROWS"},
+            json={"values": rows}, timeout=self.timeout)
+        response.raise_for_status()
+        updated_range = response.json()['updates']['updatedRange']
+        return int(re.search(r"!\$?[A-Z]+\$?(\d+)", updated_range).group(1))
+
+
+class FakeSheetsBackend:
+    """ In-memory stand-in for GoogleSheetsBackend, used by tests and local benchmarks.
+
+    It keeps track of the number of API requests and cells read so callers can assert on how
+    much traffic a given sync strategy would have generated against the real API.
+    """
+
+    def __init__(self, header=None):
+        self.rows = [list(header)] if header else []
+        self.requests = 0
+        self.cells_read = 0
+
+    def read_header(self):
+        """ returns the column names from the first row of the sheet """
+        self.requests += 1
+        header = list(self.rows[0]) if self.rows else []
+        self.cells_read += len(header)
+        return header
+
+    def write_header(self, header):
+        """ writes the column names into the first row of an empty sheet """
+        self.batch_update([(1, header)])
+
+    def read_column(self, index):
+        """ returns every value below the header in the given column """
+        self.requests += 1
+        self.cells_read += max(len(self.rows) - 1, 0)
+        return [row[index] if index < len(row) else "" for row in self.rows[1:]]
+
+    def read_rows(self, first_row=2, last_row=1000000):
+        """ returns the rows between first_row and last_row (inclusive) """
+        self.requests += 1
+        rows = [list(row) for row in self.rows[first_row - 1:last_row]]
+        self.cells_read += sum(len(row) for row in rows)
+        return rows
+
+    def batch_update(self, updates):
+        """ overwrites rows, given as a list of (row_number, values) tuples; None values leave
+        their cell unchanged """
+        if not updates:
+            return
+        self.requests += 1
+        for row_number, values in updates:
+            while len(self.rows) < row_number:
+                self.rows.append([])
+            row = self.rows[row_number - 1]
+            row.extend([""] * (len(values) - len(row)))
+            for column, value in enumerate(values):
+                if value is not None:
+                    row[column] = value
+
+    def update_cells(self, cells):
+        """ overwrites single cells, given as a list of (row_number, column_index, value) tuples """
+        if not cells:
+            return
+        self.requests += 1
+        for row_number, column, value in cells:
+            row = self.rows[row_number - 1]
+            row.extend([""] * (column + 1 - len(row)))
+            row[column] = value
+
+    def append(self, rows):
+        """ appends rows after the last row of the sheet, returning the first row number written """
+        if not rows:
+            return None
+        self.requests += 1
+        first_row = len(self.rows) + 1
+        self.rows.extend(["" if value is None else value for value in row] for row in rows)
+        return first_row
+
+
+class SheetRowIndex:
+    """ Maps order id -> sheet row number so updates can be written straight to their row.
+
+    The index is built from a single read of the id column the first time it is needed and is
+    then kept current as rows are appended, so flushes that only update known rows never read the
+    sheet. It only knows the rows this instance has seen, so the writer re-reads the id column
+    before appending ids that are missing from it.
+    """
+
+    def __init__(self):
+        self.rows = {}
+        self.next_row = None
+        self.loads = 0
+
+    @property
+    def loaded(self):
+        """ whether the index reflects the sheet """
+        return self.next_row is not None
+
+    def load(self, column_values):
+        """ rebuilds the index from the values of the id column (the first value is row 2) """
+        self.rows = {value: number for number, value in enumerate(column_values, start=2)
+                     if value != ""}
+        self.next_row = len(column_values) + 2
+        self.loads += 1
+
+    def invalidate(self):
+        """ forces a rebuild on next use, e.g. after rows were inserted/deleted by hand """
+        self.rows = {}
+        self.next_row = None
+
+    def get(self, key):
+        """ returns the row number for the key, or None if it is not in the sheet """
+        return self.rows.get(key)
+
+    def record_append(self, keys, first_row):
+        """ records the row numbers of keys appended contiguously starting at first_row """
+        for offset, key in enumerate(keys):
+            self.rows[key] = first_row + offset
+        self.next_row = first_row + len(keys)
+
+
+class SheetsWriter:
+    """ Queues order rows keyed by order id and flushes them to a sheet backend in batches.
+
+    Rows are dicts of column name -> cell value; enqueuing the same order id twice before a flush
+    keeps only the newest values, and a flush overwrites the existing sheet row for an order id, so
+    replaying triggers is idempotent. Existing rows are located through a SheetRowIndex.
+
+    Two locks keep the Sheets API off the path of concurrent invocations: _lock guards the queue
+    and is only held to change it, while _flush_lock is held by the one flush talking to the
+    sheet (it alone uses the header and index). After a failed flush, threshold flushes back off
+    for max_seconds, doubling with each further failure up to max_backoff.
+    """
+
+    def __init__(self, backend, columns, key="id", max_rows=25, max_seconds=10.0, max_backoff=300.0,
+                 log=print, span=no_span):
+        self.backend = backend
+        self.columns = list(columns)
+        self.key = key
+        self.max_rows = max_rows
+        self.max_seconds = max_seconds
+        self.max_backoff = max_backoff
+        self.log = log
+        self.span = span
+        self._pending = {}
+        self._oldest = None
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        self._failures = 0
+        self._retry_at = None
+        self._timer = None
+        self._header = None
+        self.index = SheetRowIndex()
+        self.flushes = 0
+        self.rows_flushed = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def enqueue(self, row: dict):
+        """ queues a row for the next flush, flushing immediately if a threshold is reached.
+        Rows may be partial; they are merged over whatever is already queued for the order id.
+        """
+        self.enqueue_many([row])
+
+    def enqueue_many(self, rows):
+        """ queues several rows (as enqueue does) under one acquisition of the lock, checking the
+        flush thresholds once for the lot """
+        with self._lock:
+            for row in rows:
+                key = row[self.key]
+                self._pending[key] = {**self._pending[key], **row} if key in self._pending else row
+            if self._pending and self._oldest is None:
+                self._oldest = time.monotonic()
+        self.maybe_flush()
+
+    def maybe_flush(self):
+        """ flushes if the row count or age threshold has been reached and no failed flush is
+        being backed off from, otherwise makes sure a timer is armed for the pending rows. If
+        another thread is already flushing, this returns rather than waiting for it. A failed
+        flush is logged rather than raised since the sheet is not the system of record; the rows
+        stay queued for the next attempt.
+        """
+        with self._lock:
+            due = self._due()
+        if due:
+            try:
+                self.flush(blocking=False)
+            except Exception as e:  # pylint: disable=broad-except
+                self.log("write-behind flush to sheets failed, will retry: %s", e)
+        with self._lock:
+            if self._pending:
+                self._schedule()
+
+    def _due(self):
+        if not self._pending:
+            return False
+        now = time.monotonic()
+        if self._retry_at is not None and now < self._retry_at:
+            return False
+        return len(self._pending) >= self.max_rows or now - self._oldest >= self.max_seconds
+
+    def _schedule(self):
+        """ arms a best-effort timer so a quiet instance may still flush its tail of rows.
+
+        Cloud Functions may throttle the CPU between invocations, so the timer can fire late or
+        not at all; the row count/age check made inline by every invocation is the flush trigger
+        that can be relied on.
+        """
+        if self._timer is not None:
+            return
+        self._timer = threading.Timer(self.max_seconds, self._timer_flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _timer_flush(self):
+        with self._lock:
+            self._timer = None
+        self.maybe_flush()
+
+    def header(self):
+        """ returns the sheet's column order, writing our columns into an empty sheet """
+        if self._header is None:
+            header = self.backend.read_header()
+            if not header:
+                header = list(self.columns)
+                self.backend.write_header(header)
+            self._header = header
+        return self._header
+
+    def to_values(self, row: dict):
+        """ lays out a row dict in the sheet's column order. A None value clears the cell, while
+        a column missing from the row is sent as null, which the Sheets API leaves untouched.
+        """
+        values = []
+        for column in self.header():
+            if column not in row:
+                values.append(None)
+            else:
+                value = row[column]
+                values.append("" if value is None else value)
+        return values
+
+    def load_index(self):
+        """ (re)builds the row index from one bulk read of the id column """
+        with self.span("sheets.read_column"):
+            self.index.load(self.backend.read_column(self.header().index(self.key)))
+        self.log("built sheet row index for %s rows", len(self.index.rows))
+
+    def flush(self, blocking=True):
+        """ writes all pending rows to the sheet: new order ids are appended in a single request,
+        existing order ids are overwritten in place in a single batched update.
+
+        Appends go first so that if they don't land where the index expects (someone added or
+        removed rows by hand) the index is rebuilt before any row is overwritten.
+
+        The pending rows are taken from the queue under _lock and written with only _flush_lock
+        held, so rows can be queued meanwhile. Unless blocking, this returns None at once if
+        another flush is in progress.
+
+        On failure the rows are put back in the queue (unless a newer row for the same order id
+        was queued in the meantime), the index is dropped, threshold flushes back off, and the
+        exception is re-raised.
+        """
+        if not self._flush_lock.acquire(blocking=blocking):
+            return None
+        try:
+            with self._lock:
+                if not self._pending:
+                    return 0
+                pending, self._pending = self._pending, {}
+                oldest, self._oldest = self._oldest, None
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+            try:
+                self._write(pending)
+            except Exception:
+                self.index.invalidate()
+                with self._lock:
+                    for key, row in pending.items():
+                        self._pending[key] = {**row, **self._pending[key]} if key in self._pending else row
+                    self._oldest = oldest if self._oldest is None else min(oldest, self._oldest)
+                    self._failures += 1
+                    self._retry_at = time.monotonic() + min(self.max_seconds * 2 ** (self._failures - 1),
+                                                            self.max_backoff)
+                raise
+            with self._lock:
+                self._failures = 0
+                self._retry_at = None
+                self.flushes += 1
+                self.rows_flushed += len(pending)
+            return len(pending)
+        finally:
+            self._flush_lock.release()
+
+    def _write(self, pending):
+        """ appends the new ids among the pending rows and overwrites the rows of the others """
+        reloaded = not self.index.loaded
+        if reloaded:
+            self.load_index()
+        new_keys = [key for key in pending if self.index.get(key) is None]
+        if new_keys and not reloaded:
+            # ids this index doesn't know may have been appended by another instance
+            # (the create and update triggers are separate deployments), so they are
+            # looked up in a fresh read of the id column before being appended
+            self.load_index()
+            new_keys = [key for key in pending if self.index.get(key) is None]
+        if new_keys:
+            expected_row = self.index.next_row
+            with self.span("sheets.append", rows=len(new_keys)):
+                first_row = self.backend.append([self.to_values(pending[key]) for key in new_keys])
+            if first_row != expected_row:
+                self.log("sheet rows moved (appended at %s, expected %s); rebuilding index",
+                         first_row, expected_row)
+                self.load_index()
+            else:
+                self.index.record_append(new_keys, first_row)
+        new_keys = set(new_keys)
+        with self.span("sheets.batch_update", rows=len(pending) - len(new_keys)):
+            self.backend.batch_update([(self.index.get(key), self.to_values(row))
+                                       for key, row in pending.items() if key not in new_keys])
+
+    def register_atexit(self):
+        """ flushes whatever is still queued when the interpreter exits normally (best effort:
+        not run when an instance is shut down with SIGTERM) """
+        atexit.register(self.flush)
+        return self
+
+
+def iter_sheet_rows(backend, page_size=1000):
+    """ yields (row_number, values) for every row below the header, reading a page at a time """
+    first_row = 2
+    while True:
+        page = backend.read_rows(first_row, first_row + page_size - 1)
+        for offset, values in enumerate(page):
+            yield first_row + offset, values
+        if len(page) < page_size:
+            return
+        first_row += page_size
+
+
+DATETIME_FORMATS = ("%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S", "%m/%d/%Y %H:%M:%S", "%m/%d/%Y %H:%M")
+
+
+def normalize_cell(value) -> str:
+    """ renders a cell value the same way whether it came from MySQL or back from the sheet,
+    which returns numbers as numbers (phone numbers included) and dates in the sheet's format
+    """
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return str(value).upper()
+    if isinstance(value, (int, float)):
+        return str(int(value)) if float(value).is_integer() else repr(float(value))
+    value = str(value)
+    for fmt in DATETIME_FORMATS:
+        try:
+            return datetime.strptime(value, fmt).isoformat()
+        except ValueError:
+            continue
+    try:
+        number = float(value)
+    except ValueError:
+        return value
+    return str(int(number)) if number.is_integer() else repr(number)
+
+
+def row_digest(values) -> bytes:
+    """ content hash over the normalized cells of a row """
+    digest = hashlib.blake2b(digest_size=16)
+    for value in values:
+        digest.update(normalize_cell(value).encode('utf-8'))
+        digest.update(b"\x1f")
+    return digest.digest()
+
+
+class Reconciler:
+    """ Repairs drift between the system of record and the sheet.
+
+    The sheet is read page by page into an id -> (row number, digest, values) map, then the
+    source rows are streamed and hashed over the shared columns. Only cells of rows whose digest
+    differs are written, in one batched update, and missing orders are appended in one request.
+    Rows that exist only in the sheet are reported but left alone.
+    """
+
+    def __init__(self, backend, columns, key="id", log=print):
+        self.backend = backend
+        self.columns = list(columns)
+        self.key = key
+        self.log = log
+        self.stats = {"rows_checked": 0, "rows_differing": 0, "rows_appended": 0,
+                      "cells_written": 0, "rows_only_in_sheet": 0, "seconds": 0.0}
+
+    def run(self, source_rows, refetch=None, dry_run=False, page_size=1000):
+        """ reconciles the sheet against source_rows, an iterable of column name -> value dicts.
+
+        refetch, if given, is called with the list of differing ids just before writing and must
+        return fresh rows for them; this keeps the window in which a concurrent trigger could be
+        overwritten with stale data as small as possible while running during the event.
+        """
+        start = time.perf_counter()
+        header = self.backend.read_header()
+        if not header:
+            raise KeyError("sheet has no header row")
+        key_index = header.index(self.key)
+        positions = [(index, column) for index, column in enumerate(header) if column in self.columns]
+
+        sheet = self.read_sheet(header, key_index, page_size)
+        differing = self.diff(source_rows, sheet, positions)
+        cells, appends = self.changes(differing, sheet, header, positions, refetch)
+
+        self.stats["cells_written"] = len(cells)
+        self.stats["rows_appended"] = len(appends)
+        if not dry_run:
+            self.backend.update_cells(cells)
+            self.backend.append(appends)
+
+        self.stats["seconds"] = time.perf_counter() - start
+        self.stats["rows_per_second"] = self.stats["rows_checked"] / max(self.stats["seconds"], 1e-9)
+        return self.stats
+
+    def read_sheet(self, header, key_index, page_size):
+        """ reads the sheet a page at a time into an id -> (row number, values) map """
+        sheet = {}
+        for row_number, values in iter_sheet_rows(self.backend, page_size):
+            values = values + [""] * (len(header) - len(values))
+            if values[key_index] != "":
+                sheet[values[key_index]] = (row_number, values)
+        return sheet
+
+    def diff(self, source_rows, sheet, positions) -> dict:
+        """ the source rows, by id, that are missing from the sheet or whose digest over the
+        shared columns differs from their sheet row's """
+        differing = {}
+        seen = set()
+        for row in source_rows:
+            self.stats["rows_checked"] += 1
+            key = row[self.key]
+            seen.add(key)
+            expected = [row.get(column) for _, column in positions]
+            found = sheet.get(key)
+            if found is None or \
+                    row_digest(expected) != row_digest([found[1][index] for index, _ in positions]):
+                differing[key] = row
+        self.stats["rows_only_in_sheet"] = len(sheet.keys() - seen)
+        return differing
+
+    def changes(self, differing, sheet, header, positions, refetch=None):
+        """ the cells to overwrite and the rows to append for the differing rows, refetched
+        first if refetch is given """
+        if differing and refetch is not None:
+            differing = {row[self.key]: row for row in refetch(list(differing))}
+
+        cells, appends = [], []
+        for key, row in differing.items():
+            found = sheet.get(key)
+            if found is None:
+                appends.append(["" if row.get(column) is None else row.get(column) for column in header])
+                continue
+            row_number, values = found
+            for index, column in positions:
+                if normalize_cell(row.get(column)) != normalize_cell(values[index]):
+                    cells.append((row_number, index, "" if row.get(column) is None else row.get(column)))
+            self.stats["rows_differing"] += 1
+        return cells, appends
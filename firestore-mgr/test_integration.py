@@ -0,0 +1,193 @@
+""" Integration tests for the firestore-mgr cloud function; these need a MySQL server reachable
+    through the DB_* environment variables. Firestore, GCS and label rendering are mocked out.
+"""
+# pylint: disable=redefined-outer-name,unused-argument,no-member
+
+from concurrent.futures import ThreadPoolExecutor
+import importlib
+import io
+import re
+import time
+import types
+from unittest import mock
+
+import pytest
+
+from sheets_sync import FakeSheetsBackend
+
+EVENT_PATH = "projects/test/databases/(default)/documents/events/2024-12-06/orders"
+
+
+@pytest.fixture(scope="module")
+def main():
+    """ imports the function module with the GCP clients mocked out """
+    with mock.patch("google.cloud.storage.Client"), mock.patch("google.cloud.firestore.Client"):
+        module = importlib.import_module("main")
+    return module
+
+
+@pytest.fixture
+def clean_db(main):
+    """ starts every test with an empty orders table and an in-memory sheet """
+    main.Base.metadata.drop_all(main.mysql_engine)
+    main.schema_ready.clear()
+    main.sheets_writer.backend = FakeSheetsBackend()
+    main.sheets_writer.index.invalidate()
+    main.sheets_writer._header = None  # pylint: disable=protected-access
+    return main
+
+
+def make_doc(order_id, number, family_name="Doe", dinners=1):
+    """ builds a Firestore order document like the one written by order-mgr """
+    return {
+        'order_number': number,
+        'order': {
+            'id': order_id,
+            'created_at': "2024-12-01T18:00:00",
+            'line_items': [{'name': "Italian Dinner", 'quantity': str(dinners),
+                            'total_money': {'amount': 1500 * dinners}}],
+            'fulfillments': [{'type': "PICKUP", 'pickup_details': {
+                'recipient': {'display_name': f"Jane {family_name}", 'phone_number': "+1-555-0100"}}}],
+            'total_tip_money': {'amount': 0},
+            'total_money': {'amount': 1500 * dinners},
+        },
+        'customer': {'given_name': "Jane", 'family_name': family_name, 'phone_number': "+15550100"},
+        'payment': {'reference_id': number, 'receipt_url': f"https://squareup.com/receipt/{order_id}",
+                    'processing_fee': [{'amount_money': {'amount': 50}}]},
+    }
+
+
+def make_context(order_id):
+    """ builds the event context passed to a Firestore-triggered function """
+    return types.SimpleNamespace(resource=f"{EVENT_PATH}/{order_id}")
+
+
+@pytest.fixture
+def mock_io(clean_db, mocker):
+    """ serves documents from a dict and records which order each label upload ran under """
+    main = clean_db
+    docs = {}
+    uploads = []
+
+    def fetch(context):
+        return docs[context.resource.rsplit('/', 1)[1]]
+
+    def store(pdf_bytes, order):
+        time.sleep(0.01)  # give the other invocations a chance to interleave
+        uploads.append((main.ctx_id.get(), order.id, pdf_bytes))
+        return f"https://storage/{order.id}.pdf"
+
+    mocker.patch.object(main, "fetch_document_from_firestore", side_effect=fetch)
+    mocker.patch.object(main, "create_label", side_effect=lambda order: order.id.encode())
+    mocker.patch.object(main, "store_label_to_gcs", side_effect=store)
+    return docs, uploads
+
+
+def test_concurrent_triggers_without_cross_talk(clean_db, mock_io):
+    """ several create and update triggers running at once in one process each see only their
+    own order, session and logging context
+    """
+    main = clean_db
+    docs, uploads = mock_io
+    order_ids = [f"order-{number}" for number in range(12)]
+    for number, order_id in enumerate(order_ids):
+        docs[order_id] = make_doc(order_id, 1000 + number, family_name=f"Family{number}")
+
+    with ThreadPoolExecutor(max_workers=6) as pool:
+        list(pool.map(lambda order_id: main.handle_created({}, make_context(order_id)), order_ids))
+
+    for number, order_id in enumerate(order_ids):
+        docs[order_id] = make_doc(order_id, 1000 + number, family_name=f"Family{number}", dinners=3)
+    updates = [{
+        'value': {'fields': {'order': {'mapValue': {'fields': {'id': {'stringValue': order_id}}}}}},
+        'updateMask': {'fieldPaths': ["order.line_items"]},
+    } for order_id in order_ids]
+
+    with ThreadPoolExecutor(max_workers=6) as pool:
+        list(pool.map(lambda update: main.handle_updated(
+            update, make_context(update['value']['fields']['order']['mapValue']['fields']['id']['stringValue'])),
+            updates))
+
+    assert all(context == order_id and pdf == order_id.encode() for context, order_id, pdf in uploads)
+    assert len(uploads) == 2 * len(order_ids)
+
+    with main.mysql_session_scope() as session:
+        orders = {order.id: order for order in session.query(main.Order)}
+        assert set(orders) == set(order_ids)
+        for number, order_id in enumerate(order_ids):
+            assert orders[order_id].last_name == f"Family{number}"
+            assert orders[order_id].dinner == 3
+            assert orders[order_id].label_url == f"https://storage/{order_id}.pdf"
+
+    main.sheets_writer.flush()
+    sheet = main.sheets_writer.backend.rows
+    assert sorted(row[0] for row in sheet[1:]) == sorted(order_ids)
+
+
+def test_schema_bootstrapped_once(clean_db, mock_io, mocker):
+    """ the table is created on the first invocation only, not on every create """
+    main = clean_db
+    docs, _ = mock_io
+    create_all = mocker.spy(main.Base.metadata, "create_all")
+    for number in range(3):
+        docs[f"order-{number}"] = make_doc(f"order-{number}", 1000 + number)
+        main.handle_created({}, make_context(f"order-{number}"))
+    assert create_all.call_count == 1
+
+
+def test_out_of_order_update_then_create(clean_db, mock_io):
+    """ an update trigger landing before the create trigger inserts the row, the create trigger
+    then fills in the label, and a later update that doesn't touch the label keeps it
+    """
+    main = clean_db
+    docs, uploads = mock_io
+    docs["order-1"] = make_doc("order-1", 1001)
+    update = {
+        'value': {'fields': {'order': {'mapValue': {'fields': {'id': {'stringValue': "order-1"}}}}}},
+        'updateMask': {'fieldPaths': ["pickup.status"]},
+    }
+
+    main.handle_updated(update, make_context("order-1"))
+    with main.mysql_session_scope() as session:
+        order = session.get(main.Order, "order-1")
+        assert order.last_name == "Doe"
+        assert order.label_url is None
+
+    main.handle_created({}, make_context("order-1"))
+    docs["order-1"]['pickup'] = {'status': "ARRIVED", 'checkin_time': "6:05PM"}
+    main.handle_updated(update, make_context("order-1"))
+    with main.mysql_session_scope() as session:
+        order = session.get(main.Order, "order-1")
+        assert order.label_url == "https://storage/order-1.pdf"
+        assert order.status == main.OrderState.ARRIVED
+        assert session.query(main.Order).count() == 1
+    assert len(uploads) == 1
+
+    main.sheets_writer.flush()
+    header, row = main.sheets_writer.backend.rows
+    assert row[header.index("label_url")] == "https://storage/order-1.pdf"
+    assert row[header.index("status")] == "ARRIVED"
+
+
+def test_label_sheet_one_page_per_order(clean_db, mocker):
+    """ the batch label sheet renders every selected order on its own page in a single PDF """
+    main = clean_db
+    main.ensure_schema()
+    with main.mysql_session_scope() as session:
+        for number, family_name in enumerate(["Smith", "Adams", "Jones"]):
+            session.add(main.Order(make_doc(f"order-{number}", 1000 + number, family_name=family_name)))
+
+    print_labels = importlib.import_module("print_labels")
+    orders = print_labels.select_orders('last_name', [main.OrderState.PLACED])
+    assert [order.last_name for order in orders] == ["Adams", "Jones", "Smith"]
+
+    target = io.BytesIO()
+    target.close = lambda: None  # keep the buffer readable after the upload "finishes"
+    blob = main.client.bucket.return_value.blob.return_value
+    blob.open.return_value.__enter__.return_value = target
+    main.write_label_sheet(orders, "labels.pdf")
+
+    main.client.bucket.return_value.blob.assert_called_with("2024-12-06/labels.pdf")
+    pdf = target.getvalue()
+    assert pdf.startswith(b"%PDF")
+    assert len(re.findall(rb"/Type\s*/Page\b", pdf)) == len(orders)
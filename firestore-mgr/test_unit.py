@@ -0,0 +1,675 @@
+""" Unit tests for the firestore-mgr cloud function """
+# pylint: disable=redefined-outer-name,unused-argument,no-member
+
+import importlib
+import json
+import pstats
+import socket
+import threading
+import time
+import types
+from unittest import mock
+
+import pytest
+
+import pdf_label
+import profiler
+from projection import FIELDS, Catalog, OrderState, Projector
+from sheets_sync import (SHEETS_TIMEOUT, FakeSheetsBackend, GoogleSheetsBackend, Reconciler, SheetsWriter,
+                         column_letter, normalize_cell)
+import zpl_label
+import checkin_code
+import trace_report
+
+COLUMNS = ["id", "customer_name", "total", "label_url"]
+# labels are stored in GCS and published whole to the printers; these budgets keep them compact
+DIRECT_LABEL_BUDGET = 1500
+DIRECT_SHEET_BUDGET_PER_LABEL = 700
+WEASYPRINT_LABEL_BUDGET = 40000  # subsetted fonts; embedding a whole font face alone exceeds this
+LABEL_ORDER = {'customer_name': "Jane Doe", 'phone_number': "+15550100", 'square_order_number': 1042,
+               'total': 1045.5, 'note': "No cheese", 'concert': 2, 'dinner': 13}
+
+
+def cdn_reachable():
+    """ whether the Bootstrap CDN the WeasyPrint label stylesheets come from can be reached """
+    try:
+        socket.create_connection(("cdn.jsdelivr.net", 443), timeout=3).close()
+    except OSError:
+        return False
+    return True
+
+
+# WeasyPrint renders labels with Bootstrap from its CDN, so those tests are skipped offline
+needs_network = pytest.mark.skipif(not cdn_reachable(), reason="needs the Bootstrap CDN")
+
+
+@pytest.fixture
+def fake_sheet():
+    """ Pytest fixture for an in-memory sheet with a header row """
+    return FakeSheetsBackend(header=COLUMNS)
+
+
+@pytest.fixture(scope="module")
+def main():
+    """ imports the function module with the GCP clients mocked out """
+    with mock.patch("google.cloud.storage.Client"), mock.patch("google.cloud.firestore.Client"):
+        module = importlib.import_module("main")
+    return module
+
+
+def make_label_order(**fields):
+    """ builds an object with the Order fields that the label shows """
+    return types.SimpleNamespace(**{**LABEL_ORDER, **fields})
+
+
+def rasterize(pdf_bytes, scale):
+    """ renders each page of a PDF to a greyscale image """
+    pdfium = pytest.importorskip("pypdfium2")
+    return [page.render(scale=scale, grayscale=True).to_pil().convert("L")
+            for page in pdfium.PdfDocument(pdf_bytes)]
+
+
+def pdf_words(pdf_bytes):
+    """ the words on each page of a PDF, in sorted order """
+    pdfium = pytest.importorskip("pypdfium2")
+    return [sorted(page.get_textpage().get_text_bounded().split()) for page in pdfium.PdfDocument(pdf_bytes)]
+
+
+def make_row(order_id, name="Jane Doe", total=10.0):
+    """ builds a sheet row dict for the given order id """
+    return {"id": order_id, "customer_name": name, "total": total, "label_url": None}
+
+
+def test_column_letter():
+    """ ensures zero-based column indexes map to A1 column letters """
+    assert column_letter(0) == "A"
+    assert column_letter(25) == "Z"
+    assert column_letter(26) == "AA"
+    assert column_letter(701) == "ZZ"
+
+
+def test_write_behind_flushes_on_row_count(fake_sheet):
+    """ rows are held until max_rows are pending, then written in one batch """
+    writer = SheetsWriter(fake_sheet, COLUMNS, max_rows=3, max_seconds=3600)
+    writer.enqueue(make_row("a"))
+    writer.enqueue(make_row("b"))
+    assert len(fake_sheet.rows) == 1
+
+    writer.enqueue(make_row("c"))
+    assert len(writer) == 0
+    assert [row[0] for row in fake_sheet.rows[1:]] == ["a", "b", "c"]
+    assert writer.flushes == 1
+
+
+def test_write_behind_flushes_on_age(fake_sheet, mocker):
+    """ rows are flushed once the oldest pending row is older than max_seconds """
+    clock = mocker.patch("sheets_sync.time.monotonic", return_value=100.0)
+    writer = SheetsWriter(fake_sheet, COLUMNS, max_rows=100, max_seconds=5)
+    writer.enqueue(make_row("a"))
+    writer.maybe_flush()
+    assert len(fake_sheet.rows) == 1
+
+    clock.return_value = 106.0
+    writer.maybe_flush()
+    assert [row[0] for row in fake_sheet.rows[1:]] == ["a"]
+
+
+def test_write_behind_enqueue_many(fake_sheet):
+    """ several rows queued at once are merged per id and checked against the thresholds once """
+    writer = SheetsWriter(fake_sheet, COLUMNS, max_rows=3, max_seconds=3600)
+    writer.enqueue_many([make_row("a"), make_row("b"), {"id": "a", "total": 12.0}])
+    assert len(writer) == 2
+    writer.enqueue_many([make_row("c"), make_row("d")])
+    assert writer.flushes == 1
+    assert [row[0] for row in fake_sheet.rows[1:]] == ["a", "b", "c", "d"]
+    assert fake_sheet.rows[1][2] == 12.0
+
+
+def test_write_behind_is_idempotent_by_order_id(fake_sheet):
+    """ replaying rows for the same order id overwrites the existing sheet row """
+    writer = SheetsWriter(fake_sheet, COLUMNS, max_rows=100, max_seconds=3600)
+    writer.enqueue(make_row("a", total=1.0))
+    writer.enqueue(make_row("a", total=2.0))
+    writer.enqueue(make_row("b"))
+    writer.flush()
+    assert len(fake_sheet.rows) == 3
+
+    writer.enqueue(make_row("a", total=3.0))
+    writer.enqueue(make_row("a", total=3.0))
+    writer.flush()
+    assert len(fake_sheet.rows) == 3
+    assert fake_sheet.rows[1] == ["a", "Jane Doe", 3.0, ""]
+
+
+def test_write_behind_writes_header_to_empty_sheet():
+    """ an empty sheet gets our column names written as its header """
+    sheet = FakeSheetsBackend()
+    writer = SheetsWriter(sheet, COLUMNS, max_rows=1)
+    writer.enqueue(make_row("a"))
+    assert sheet.rows[0] == COLUMNS
+    assert sheet.rows[1][0] == "a"
+
+
+def test_write_behind_follows_sheet_column_order():
+    """ values are laid out by the sheet's header, not by our column order """
+    sheet = FakeSheetsBackend(header=["total", "id", "notes"])
+    writer = SheetsWriter(sheet, COLUMNS, max_rows=1)
+    writer.enqueue(make_row("a", total=5.0))
+    assert sheet.rows[1] == [5.0, "a", ""]
+
+
+def test_write_behind_requeues_on_failure(fake_sheet, mocker):
+    """ a failed flush keeps rows queued without clobbering newer rows for the same order """
+    writer = SheetsWriter(fake_sheet, COLUMNS, max_rows=100, max_seconds=3600, log=mocker.Mock())
+    writer.enqueue(make_row("a", total=1.0))
+    mocker.patch.object(fake_sheet, "append", side_effect=Exception("quota exceeded"))
+    with pytest.raises(Exception):
+        writer.flush()
+    assert len(writer) == 1
+
+    mocker.stopall()
+    writer.enqueue(make_row("a", total=2.0))
+    writer.flush()
+    assert fake_sheet.rows[1:] == [["a", "Jane Doe", 2.0, ""]]
+
+
+def test_write_behind_logs_failed_threshold_flush(fake_sheet, mocker):
+    """ a flush triggered from enqueue never raises into the trigger path """
+    log = mocker.Mock()
+    writer = SheetsWriter(fake_sheet, COLUMNS, max_rows=1, max_seconds=3600, log=log)
+    mocker.patch.object(fake_sheet, "append", side_effect=Exception("quota exceeded"))
+    writer.enqueue(make_row("a"))
+    assert len(writer) == 1
+    assert "flush to sheets failed" in log.call_args[0][0]
+
+
+def test_write_behind_queues_while_flushing(fake_sheet):
+    """ rows are queued, and threshold checks return, while another thread waits on the sheet """
+    writer = SheetsWriter(fake_sheet, COLUMNS, max_rows=1, max_seconds=3600)
+    appending, release = threading.Event(), threading.Event()
+    append = fake_sheet.append
+
+    def slow_append(rows):
+        appending.set()
+        release.wait(5)
+        return append(rows)
+    fake_sheet.append = slow_append
+    flusher = threading.Thread(target=writer.enqueue, args=(make_row("a"),))
+    flusher.start()
+    assert appending.wait(5)
+
+    start = time.monotonic()
+    writer.enqueue(make_row("b"))
+    writer.maybe_flush()
+    assert time.monotonic() - start < 1
+    assert len(writer) == 1
+    release.set()
+    flusher.join()
+    writer.flush()
+    assert [row[0] for row in fake_sheet.rows[1:]] == ["a", "b"]
+
+
+def test_write_behind_backs_off_after_failure(fake_sheet, mocker):
+    """ after a failed flush, invocations don't retry it inline until the backoff has passed,
+    which doubles with each further failure """
+    clock = mocker.patch("sheets_sync.time.monotonic", return_value=100.0)
+    writer = SheetsWriter(fake_sheet, COLUMNS, max_rows=1, max_seconds=5, log=mocker.Mock())
+    mocker.patch.object(writer, "_schedule")
+    append = mocker.patch.object(fake_sheet, "append", side_effect=Exception("quota exceeded"))
+    writer.enqueue(make_row("a"))
+    writer.enqueue(make_row("b"))
+    assert append.call_count == 1
+
+    clock.return_value = 105.0
+    writer.maybe_flush()
+    assert append.call_count == 2
+    clock.return_value = 114.0
+    writer.maybe_flush()
+    assert append.call_count == 2
+
+    mocker.stop(append)
+    clock.return_value = 115.0
+    writer.maybe_flush()
+    assert [row[0] for row in fake_sheet.rows[1:]] == ["a", "b"]
+
+
+def test_sheets_requests_time_out():
+    """ every Sheets API request is made with a timeout """
+    backend = GoogleSheetsBackend("https://docs.google.com/spreadsheets/d/abc/edit#gid=0")
+    backend._session = mock.Mock()  # pylint: disable=protected-access
+    backend._title = "Orders"  # pylint: disable=protected-access
+    backend._session.get.return_value.json.return_value = {'values': [["a"]]}
+    backend._session.post.return_value.json.return_value = {'updates': {'updatedRange': "'Orders'!A5:D5"}}
+    assert backend.read_column(0) == ["a"]
+    backend.batch_update([(2, ["a"])])
+    assert backend.append([["a"]]) == 5
+    calls = backend.session.get.call_args_list + backend.session.post.call_args_list
+    assert [call.kwargs['timeout'] for call in calls] == [SHEETS_TIMEOUT] * 3
+
+
+def test_row_index_built_once(fake_sheet):
+    """ the id column is read when the instance starts and before appending ids it doesn't know;
+    flushes of known ids write straight to their rows """
+    writer = SheetsWriter(fake_sheet, COLUMNS, max_rows=1, max_seconds=3600)
+    writer.enqueue(make_row("a"))
+    writer.enqueue(make_row("b"))
+    assert writer.index.loads == 2
+    requests = fake_sheet.requests
+    writer.enqueue(make_row("a", total=5.0))
+    writer.enqueue(make_row("b", total=6.0))
+    assert writer.index.loads == 2
+    assert writer.index.get("a") == 2
+    assert writer.index.get("b") == 3
+    assert fake_sheet.requests == requests + 2
+    assert [row[2] for row in fake_sheet.rows[1:]] == [5.0, 6.0]
+
+
+def test_write_behind_is_idempotent_across_instances(fake_sheet):
+    """ the create and update triggers run on separate instances, each with its own index; an id
+    appended by one is overwritten in place by the other rather than appended twice """
+    created = SheetsWriter(fake_sheet, COLUMNS, max_rows=1, max_seconds=3600)
+    updated = SheetsWriter(fake_sheet, COLUMNS, max_rows=1, max_seconds=3600)
+    updated.enqueue(make_row("W"))
+    created.enqueue(make_row("X"))
+    updated.enqueue({**make_row("X", total=20.0), 'label_url': "https://labels/X.pdf"})
+    created.enqueue(make_row("Y"))
+    updated.enqueue(make_row("Y", total=30.0))
+    assert [row[0] for row in fake_sheet.rows[1:]] == ["W", "X", "Y"]
+    assert fake_sheet.rows[2] == ["X", "Jane Doe", 20.0, "https://labels/X.pdf"]
+    assert fake_sheet.rows[3][2] == 30.0
+
+
+def test_row_index_loads_existing_rows(fake_sheet):
+    """ a cold start indexes the rows already in the sheet """
+    fake_sheet.rows.extend([["x", "", "", ""], ["y", "", "", ""]])
+    writer = SheetsWriter(fake_sheet, COLUMNS, max_rows=1, max_seconds=3600)
+    writer.enqueue(make_row("y", total=7.0))
+    assert len(fake_sheet.rows) == 3
+    assert fake_sheet.rows[2] == ["y", "Jane Doe", 7.0, ""]
+
+
+def test_row_index_rebuilt_when_rows_move(fake_sheet):
+    """ if rows were added by hand, the index is rebuilt before any row is overwritten """
+    writer = SheetsWriter(fake_sheet, COLUMNS, max_rows=100, max_seconds=3600)
+    writer.enqueue(make_row("a"))
+    writer.flush()
+
+    fake_sheet.rows.insert(1, ["manual", "", "", ""])
+    writer.enqueue(make_row("a", total=9.0))
+    writer.enqueue(make_row("b"))
+    writer.flush()
+    assert writer.index.loads == 2
+    assert fake_sheet.rows[1] == ["manual", "", "", ""]
+    assert fake_sheet.rows[2] == ["a", "Jane Doe", 9.0, ""]
+    assert fake_sheet.rows[3][0] == "b"
+
+
+def test_normalize_cell_matches_sheet_rendering():
+    """ values read back from the sheet hash the same as the values we wrote """
+    assert normalize_cell(None) == normalize_cell("")
+    assert normalize_cell("15551234567") == normalize_cell(15551234567)
+    assert normalize_cell(10.0) == normalize_cell(10)
+    assert normalize_cell(10.5) == normalize_cell("10.5")
+    assert normalize_cell("2024-12-06 18:00:00") == normalize_cell("12/6/2024 18:00:00")
+    assert normalize_cell("Smith") != normalize_cell("Smyth")
+
+
+def test_reconcile_writes_only_differing_cells(fake_sheet):
+    """ only cells that drifted are written; missing orders are appended """
+    fake_sheet.rows.extend([["a", "Jane Doe", 10, ""],
+                            ["b", "John Doe", 5, ""],
+                            ["z", "Not In MySQL", 1, ""]])
+    source = [make_row("a"), make_row("b", name="John Smith", total=5.0), make_row("c")]
+    stats = Reconciler(fake_sheet, COLUMNS).run(iter(source), page_size=2)
+
+    assert stats["rows_checked"] == 3
+    assert stats["rows_differing"] == 1
+    assert stats["cells_written"] == 1
+    assert stats["rows_appended"] == 1
+    assert stats["rows_only_in_sheet"] == 1
+    assert fake_sheet.rows[2] == ["b", "John Smith", 5, ""]
+    assert fake_sheet.rows[3][1] == "Not In MySQL"
+    assert fake_sheet.rows[4][0] == "c"
+
+
+def test_reconcile_refetches_before_writing(fake_sheet):
+    """ differing rows are re-read from the source so a concurrent update isn't clobbered """
+    fake_sheet.rows.append(["a", "Jane Doe", 10, ""])
+
+    def refetch(ids):
+        return [make_row(order_id, total=99.0) for order_id in ids]
+    Reconciler(fake_sheet, COLUMNS).run([make_row("a", total=20.0)], refetch=refetch)
+    assert fake_sheet.rows[1] == ["a", "Jane Doe", 99.0, ""]
+
+
+def test_reconcile_dry_run(fake_sheet):
+    """ a dry run reports drift without writing to the sheet """
+    fake_sheet.rows.append(["a", "Jane Doe", 10, ""])
+    requests = fake_sheet.requests
+    stats = Reconciler(fake_sheet, COLUMNS).run([make_row("a", total=20.0)], dry_run=True)
+    assert stats["cells_written"] == 1
+    assert fake_sheet.rows[1] == ["a", "Jane Doe", 10, ""]
+    assert fake_sheet.requests == requests + 2
+
+
+def test_write_behind_partial_rows_leave_cells_alone(fake_sheet):
+    """ columns missing from a queued row keep their current value in the sheet """
+    writer = SheetsWriter(fake_sheet, COLUMNS, max_rows=100, max_seconds=3600)
+    writer.enqueue({**make_row("a"), "label_url": "https://storage/a.pdf"})
+    writer.flush()
+
+    writer.enqueue({"id": "a", "customer_name": "Jane Smith", "total": 10.0})
+    writer.flush()
+    assert fake_sheet.rows[1] == ["a", "Jane Smith", 10.0, "https://storage/a.pdf"]
+
+    writer.enqueue({**make_row("a"), "label_url": "https://storage/b.pdf"})
+    writer.enqueue({"id": "a", "customer_name": "Jane Doe", "total": 11.0})
+    writer.flush()
+    assert fake_sheet.rows[1] == ["a", "Jane Doe", 11.0, "https://storage/b.pdf"]
+
+
+def test_shipped_templates_use_direct_labels():
+    """ the direct PDF writer recognises the templates in this repo; if this fails after editing a
+    label template or label.css, update pdf_label to match and then its KNOWN_LAYOUT_DIGEST """
+    assert pdf_label.layout_matches()
+
+
+@needs_network
+def test_direct_label_matches_weasyprint(main, mocker):
+    """ the direct PDF label shows the same text as the WeasyPrint rendering of the templates and
+    differs from it in only a small fraction of pixels (mostly glyph shapes, where the fonts differ)
+    """
+    mocker.patch.object(checkin_code, "LABEL_TOKEN_SECRET", "secret")
+    for fields in [{}, {'note': None, 'concert': 0}, {'id': "order-1"}]:
+        order = make_label_order(**fields)
+        expected = main.render_with_weasyprint("label_template.html", order=order)
+        actual = pdf_label.render([order])
+        assert pdf_words(actual) == pdf_words(expected)
+
+        (expected_image,), (actual_image,) = rasterize(expected, 0.25), rasterize(actual, 0.25)
+        assert actual_image.size == expected_image.size
+        differing = sum(1 for a, b in zip(actual_image.getdata(), expected_image.getdata()) if abs(a - b) > 64)
+        assert differing / (actual_image.width * actual_image.height) < 0.05
+
+
+def test_direct_label_one_page_per_order():
+    """ a label sheet gets one page per order """
+    orders = [make_label_order(customer_name=f"Person {number}") for number in range(3)]
+    assert [" ".join(words) for words in pdf_words(pdf_label.render(orders))] == \
+        [" ".join(sorted(f"Name: Person {number} Phone: +15550100 Order #: 1042 Total: $1,045.50 "
+                         "Concert Tickets Dinner Tickets 2 13 Note: No cheese".split())) for number in range(3)]
+    # strict readers (e.g. pypdf, used to merge labels) insist on the end-of-file marker
+    assert pdf_label.render(orders).endswith(b"\n%%EOF\n")
+
+
+def test_direct_label_declines_what_it_cannot_lay_out():
+    """ text that would wrap or can't be set in the standard fonts is left to WeasyPrint """
+    assert pdf_label.render([make_label_order(customer_name="X" * 60)]) is None
+    assert pdf_label.render([make_label_order(note="very long note " * 10)]) is None
+    assert pdf_label.render([make_label_order(customer_name="李 小龍")]) is None
+    assert pdf_label.render([make_label_order(), make_label_order(customer_name="X" * 60)]) is None
+    assert pdf_label.render([make_label_order(customer_name="José Núñez")]) is not None
+
+
+def test_create_label_falls_back_to_weasyprint(main, mocker):
+    """ orders the direct writer declines are rendered by WeasyPrint instead """
+    weasyprint = mocker.patch.object(main, "render_with_weasyprint", return_value=b"%PDF-weasyprint")
+    assert main.create_label(make_label_order()).startswith(b"%PDF-1.4")
+    weasyprint.assert_not_called()
+    assert main.create_label(make_label_order(customer_name="X" * 60)) == b"%PDF-weasyprint"
+
+
+def test_label_size_budget():
+    """ compact direct labels stay within their size budgets """
+    order = make_label_order()
+    assert len(pdf_label.render([order])) <= DIRECT_LABEL_BUDGET
+    assert len(pdf_label.render([order] * 50)) <= 50 * DIRECT_SHEET_BUDGET_PER_LABEL
+    assert len(pdf_label.render([order])) < len(pdf_label.render([order], compress=False))
+
+
+@needs_network
+def test_weasyprint_label_size_budget(main):
+    """ compact labels rendered by WeasyPrint stay within their size budget """
+    assert len(main.render_with_weasyprint("label_template.html", order=make_label_order())) <= WEASYPRINT_LABEL_BUDGET
+
+
+def test_zpl_label():
+    """ the ZPL label is one printable ASCII format carrying the label fields, with ZPL control
+    characters and non-ASCII text hex-escaped rather than passed through """
+    zpl = zpl_label.render(make_label_order(customer_name="José ^Núñez", concert=0)).decode("ascii")
+    assert zpl.startswith("^XA") and zpl.endswith("^XZ")
+    assert "^CI28" in zpl
+    assert "^FDName: Jos_C3_A9 _5EN_C3_BA_C3_B1ez^FS" in zpl
+    assert "^FDTotal: $1,045.50^FS" in zpl
+    assert "^FD13^FS" in zpl and "^FD0^FS" not in zpl
+    assert "^FDNote: No cheese^FS" in zpl
+    assert "Note:" not in zpl_label.render(make_label_order(note=None)).decode("ascii")
+
+
+def test_checkin_code(mocker):
+    """ the check-in code is the order id and a token that only the secret reproduces, and
+    labels carry none without a secret """
+    assert checkin_code.token("order-1", "secret") == checkin_code.token("order-1", "secret")
+    assert checkin_code.token("order-1", "secret") != checkin_code.token("order-1", "other secret")
+    assert checkin_code.token("order-1", "secret") != checkin_code.token("order-2", "secret")
+    assert len(checkin_code.token("order-1", "secret")) == 12
+
+    mocker.patch.object(checkin_code, "LABEL_TOKEN_SECRET", "")
+    assert checkin_code.payload(make_label_order(id="order-1")) is None
+    mocker.patch.object(checkin_code, "LABEL_TOKEN_SECRET", "secret")
+    assert checkin_code.payload(make_label_order(id="order-1")) == f"order-1.{checkin_code.token('order-1', 'secret')}"
+    assert checkin_code.payload(make_label_order()) is None
+
+
+def test_checkin_code_on_labels(mocker):
+    """ the direct PDF label draws the QR code module for module, and the ZPL label has the
+    printer draw it """
+    mocker.patch.object(checkin_code, "LABEL_TOKEN_SECRET", "secret")
+    order = make_label_order(id="order-1")
+    data = checkin_code.payload(order)
+
+    # the code is what differs from the same label without one; at scale 2 a 5px module is 7.5 pixels
+    (with_code,) = rasterize(pdf_label.render([order]), 2)
+    (without_code,) = rasterize(pdf_label.render([make_label_order()]), 2)
+    differing = [(x, y) for y in range(with_code.height) for x in range(with_code.width)
+                 if with_code.getpixel((x, y)) != without_code.getpixel((x, y))]
+    left, top = min(x for x, _ in differing), min(y for _, y in differing)
+    modules = checkin_code.matrix(data)
+    assert max(x for x, _ in differing) - left == pytest.approx(len(modules) * 7.5, abs=2)
+    assert [[with_code.getpixel((int(left + (column + 0.5) * 7.5), int(top + (row + 0.5) * 7.5))) < 128
+             for column in range(len(modules))] for row in range(len(modules))] == modules
+
+    zpl = zpl_label.render(order).decode("ascii")
+    assert f"^BQN,2,{checkin_code.ZPL_MAGNIFICATION}^FDMA,{data}^FS" in zpl
+    assert "^BQ" not in zpl_label.render(make_label_order()).decode("ascii")
+
+
+def make_order_doc(**customer):
+    """ builds a Firestore order document like the ones order-mgr writes """
+    return {
+        'order_number': 1042,
+        'order': {
+            'id': "order-1", 'created_at': "2024-12-01T18:00:00",
+            'line_items': [{'name': "Concert and Dinner", 'quantity': "2", 'total_money': {'amount': 5000}},
+                           {'name': "Donate to StMM Parish Life Center", 'quantity': "1",
+                            'total_money': {'amount': 2500}}],
+            'fulfillments': [{'pickup_details': {'recipient': {'display_name': "Mary Ann Smith",
+                                                               'phone_number': "+1-555-0199"},
+                                                 'note': "pickup note"}}],
+            'total_tip_money': {'amount': 0}, 'total_money': {'amount': 7500},
+        },
+        'customer': {'given_name': "Jane", 'family_name': "Doe", 'phone_number': "+15550100", **customer},
+        'payment': {'reference_id': 77, 'receipt_url': "https://squareup.com/receipt/1",
+                    'processing_fee': [{'amount_money': {'amount': 50}}]},
+    }
+
+
+def test_projection_single_pass():
+    """ one projection yields every column, with shared lookups like the recipient's name
+    applied consistently to the columns that fall back on it """
+    projector = Projector(FIELDS)
+    values = projector.project(make_order_doc())
+    assert list(values) == projector.columns
+    assert (values['customer_name'], values['last_name'], values['phone_number']) == ("Jane Doe", "Doe", "15550100")
+    assert (values['concert'], values['dinner'], values['donations'], values['total']) == (2, 2, 25.0, 75.0)
+    assert (values['square_order_number'], values['fees'], values['note']) == (77, 0.5, "pickup note")
+    assert values['status'] == OrderState.PLACED
+
+    values = projector.project(make_order_doc(given_name="unknown", phone_number=None))
+    assert (values['customer_name'], values['last_name']) == ("Mary Ann Smith", "Doe")
+    assert values['phone_number'] == "15550199"
+    values = projector.project(make_order_doc(family_name="unknown"))
+    assert (values['customer_name'], values['last_name']) == ("Mary Ann Smith", "Smith")
+    # an order without a payment has no fee, written as the column's default of 0 as before
+    assert projector.project({**make_order_doc(), 'payment': None})['fees'] == 0.0
+
+
+def test_projection_by_update_mask():
+    """ an update mask re-projects only the columns it changes and tells whether the label does """
+    projector = Projector(FIELDS)
+    doc = make_order_doc()
+    doc['pickup'] = {'status': "ARRIVED", 'checkin_time': "6:05PM"}
+    assert projector.project(doc, {'fieldPaths': ["pickup.status", "pickup.checkin_time"]}) == \
+        {'status': OrderState.ARRIVED, 'checkin_time': "6:05PM"}
+    assert not projector.touches_label({'fieldPaths': ["pickup.status"]})
+    assert set(projector.project(doc, {'fieldPaths': ["customer.family_name"]})) == {'customer_name', 'last_name'}
+    assert projector.touches_label({'fieldPaths': ["pickup.status", "order.line_items"]})
+    assert projector.project(doc, {'fieldPaths': ["unrelated.path"]}) == {}
+
+    context = projector.label_context(projector.project(doc))
+    assert (context.customer_name, context.dinner, context.note) == ("Jane Doe", 2, "pickup note")
+
+
+def test_order_row_matches_mapped_order(main):
+    """ the slotted row the triggers use gives the same MySQL and Sheets rows as a mapped Order,
+    without carrying any ORM state """
+    doc = make_order_doc()
+    row = main.OrderRow.from_doc(doc)
+    assert row.sql_row() == main.Order(doc).sql_row()
+    assert row.sheets_row() == main.Order(doc).sheets_row()
+    assert row.label_url is None and row.sql_row()['concert'] == 2
+    assert not hasattr(row, "__dict__") and not hasattr(row, "_sa_instance_state")
+
+
+def test_catalog_counts_line_items():
+    """ line items match on their variation id before their name, add quantity or dollars times the
+    entry's multipliers, and anything not in the catalog is logged rather than counted """
+    catalog = Catalog([
+        {'name': "Concert and Dinner", 'variation_ids': ["V-COMBO"], 'quantity': {'concert': 1, 'dinner': 1}},
+        {'name': "Family Dinner", 'variation_ids': ["V-FAMILY"], 'quantity': {'dinner': 4}},
+        {'name': "Donation", 'money': {'donations': 1}},
+    ])
+    assert catalog.columns == ['concert', 'dinner', 'donations']
+    messages = []
+    counters = catalog.count([
+        {'name': "Renamed Combo", 'catalog_object_id': "V-COMBO", 'quantity': "2"},
+        {'name': "Family Dinner", 'quantity': "1"},
+        {'name': "Donation", 'quantity': "1", 'total_money': {'amount': 1250}},
+        {'name': "Raffle", 'catalog_object_id': "V-RAFFLE", 'quantity': "3"},
+    ], lambda *args: messages.append(args))
+    assert counters == [2, 6, 12.5]
+    assert messages == [("line item %s (%s) is not in the catalog", "Raffle", "V-RAFFLE")]
+    assert catalog.count([]) == [0, 0, 0.0]
+
+
+def test_invocations_flush_overdue_rows(main, fake_sheet, mocker):
+    """ rows left queued by an earlier invocation are flushed by the next one once overdue,
+    even if it returns early, without relying on the timer """
+    clock = mocker.patch("sheets_sync.time.monotonic", return_value=100.0)
+    writer = SheetsWriter(fake_sheet, COLUMNS, max_rows=100, max_seconds=5)
+    mocker.patch.object(writer, "_schedule")
+    mocker.patch.object(main, "sheets_writer", writer)
+    writer.enqueue(make_row("a"))
+    data = {'updateMask': {'fieldPaths': ["print_times"]},
+            'value': {'fields': {'order': {'mapValue': {'fields': {'id': {'stringValue': "order-1"}}}}}}}
+    main.handle_updated(data, mock.Mock())
+    assert len(fake_sheet.rows) == 1
+
+    clock.return_value = 106.0
+    main.handle_updated(data, mock.Mock())
+    assert [row[0] for row in fake_sheet.rows[1:]] == ["a"]
+
+
+def test_update_without_mapped_fields_short_circuits(main, mocker):
+    """ an update that changes no mapped column returns before reading Firestore or writing
+    MySQL and Sheets, and is counted """
+    fetch = mocker.patch.object(main, "fetch_document_from_firestore")
+    upsert = mocker.patch.object(main, "upsert_orders")
+    before = dict(main.update_stats)
+    data = {'updateMask': {'fieldPaths': ["print_times"]},
+            'value': {'fields': {'order': {'mapValue': {'fields': {'id': {'stringValue': "order-1"}}}}}}}
+    main.handle_updated(data, mock.Mock())
+    assert not fetch.called and not upsert.called
+    assert main.update_stats['short_circuited'] == before['short_circuited'] + 1
+    assert main.update_stats['invocations'] == before['invocations'] + 1
+
+
+def test_trace_report():
+    """ stage latencies are summarized once per trace and stage, from plain or gcloud log lines """
+    def entry(trace_id, stage, stage_ms, since_received_ms):
+        return {'jsonPayload': {'trace_stage': {'trace_id': trace_id, 'order_id': "order-1", 'stage': stage,
+                                                'stage_ms': stage_ms, 'since_received_ms': since_received_ms}}}
+    logs = [entry("a", "webhook", 40.0, 40.0), entry("a", "label", 900.0, 1500.0),
+            entry("b", "label", 700.0, 1200.0), entry("b", "label", 300.0, 5000.0)]
+    stage_ms, end_to_end = trace_report.summarize(trace_report.entries([json.dumps(logs)]))
+    assert stage_ms == {'webhook': [40.0], 'label': [300.0, 900.0]}
+    assert end_to_end == [1500.0, 5000.0]
+    lines = [json.dumps(log['jsonPayload']) + "\n" for log in logs] + ["not json\n"]
+    assert trace_report.summarize(trace_report.entries(lines)) == (stage_ms, end_to_end)
+    assert trace_report.percentile([1, 2, 3, 4], 0.5) == 2
+    assert trace_report.percentile([1, 2, 3, 4], 0.99) == 4
+    assert dict(trace_report.histogram([5, 30, 20000]))["<=50ms"] == 1
+
+
+def test_spans_around_external_calls(main, fake_sheet, mocker, tmp_path):
+    """ GCS uploads and sheet requests are exported as spans tied to the order, with their
+    payload size and outcome """
+    mocker.patch.object(main, "span_exporter", main.span_exporter_for(f"file:{tmp_path}/spans.jsonl"))
+    main.ctx_id.set("order-1")
+    main.store_label_to_gcs(b"%PDF-label", make_label_order(last_name="Doe"))
+    writer = SheetsWriter(fake_sheet, COLUMNS, max_rows=1, log=main.log, span=main.span)
+    writer.enqueue(make_row("a"))
+    mocker.patch.object(fake_sheet, "batch_update", side_effect=RuntimeError)
+    writer.enqueue(make_row("a", total=20.0))
+
+    spans = [json.loads(line) for line in (tmp_path / "spans.jsonl").read_text().splitlines()]
+    assert [(span['name'], span['outcome']) for span in spans] == [
+        ("gcs.upload", "ok"), ("sheets.read_column", "ok"), ("sheets.append", "ok"),
+        ("sheets.batch_update", "ok"), ("sheets.batch_update", "RuntimeError")]
+    assert spans[0]['bytes'] == 10 and spans[2]['rows'] == 1
+    assert all(span['order_id'] == "order-1" and span['duration_ms'] >= 0 for span in spans)
+    main.ctx_id.set("")
+    with pytest.raises(ValueError):
+        main.span_exporter_for("otlp")
+
+
+def test_profile_hook(tmp_path):
+    """ invocations are profiled when asked to, as collapsed stacks or pstats, and otherwise run
+    the handler untouched """
+    def busy_handler(event, context):
+        deadline = time.perf_counter() + 0.05
+        while time.perf_counter() < deadline:
+            pass
+        return "done"
+
+    messages = []
+    hook = profiler.ProfileHook(fraction=0, interval_ms=1, output=str(tmp_path), log=lambda *args: messages.append(args))
+    handler = hook(busy_handler)
+    assert handler({'attributes': {}}, None) == "done"
+    assert not list(tmp_path.iterdir())
+
+    assert handler({'attributes': {'profile': "true"}}, None) == "done"
+    [collapsed] = tmp_path.glob("busy_handler-*.collapsed")
+    stacks = dict(line.rsplit(" ", 1) for line in collapsed.read_text().splitlines())
+    assert any(stack.endswith(f";busy_handler (test_unit.py:{busy_handler.__code__.co_firstlineno})")
+               for stack in stacks)
+    assert sum(int(count) for count in stacks.values()) > 5
+    assert messages == [("wrote %s profile to %s", "busy_handler", str(collapsed))]
+
+    handler = profiler.ProfileHook(fraction=1, profile_format="pstats", output=str(tmp_path), log=print)(busy_handler)
+    assert handler(mock.Mock(headers={}), None) == "done"
+    [stats] = tmp_path.glob("busy_handler-*.pstats")
+    assert any(name == "busy_handler" for _, _, name in pstats.Stats(str(stats)).stats)
+
+    with pytest.raises(ValueError):
+        profiler.ProfileHook(profile_format="perf")
@@ -0,0 +1,95 @@
+""" Reports per-stage latency of the order pipeline from the functions' "stage complete" logs.
+
+    Each function logs a trace_stage entry as an order passes through it: "webhook" (square-webhook),
+    "order_mgr" (order-mgr), "label" (this function) and "print" (sql-mgr, per check-in, continuing
+    the trace stored on the order). stage_ms is the time spent in that function; since_received_ms
+    is the time since square-webhook received the notification (or since sql-mgr received the
+    check-in, for "print" of an order without a trace). This prints a histogram and p50/p95/p99 of
+    each, plus end-to-end latency as since_received_ms of the "label" stage.
+
+    Reads JSON log entries, one per line or as the array gcloud prints, e.g.:
+
+        gcloud logging read 'jsonPayload.trace_stage.stage:*' --freshness=1d --format=json \\
+            | python trace_report.py
+
+    For a live histogram, a log-based distribution metric on jsonPayload.trace_stage.stage_ms,
+    labelled by jsonPayload.trace_stage.stage, can be charted in Cloud Monitoring instead.
+"""
+
+import argparse
+from collections import defaultdict
+import json
+import sys
+
+BUCKETS_MS = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+PIPELINE = ["webhook", "order_mgr", "label", "print"]
+
+
+def entries(lines):
+    """ yields the trace_stage of every log entry that has one """
+    text = "".join(lines).strip()
+    if text.startswith("["):
+        records = json.loads(text)
+    else:
+        records = (json.loads(line) for line in text.splitlines() if line.strip().startswith("{"))
+    for record in records:
+        payload = record.get('jsonPayload', record)
+        if isinstance(payload.get('trace_stage'), dict):
+            yield payload['trace_stage']
+
+
+def percentile(values, fraction):
+    """ the nearest-rank percentile of sorted values """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, round(fraction * len(values)) - 1))]
+
+
+def histogram(values):
+    """ counts of values in each BUCKETS_MS bucket, as (upper bound label, count) """
+    counts = [0] * (len(BUCKETS_MS) + 1)
+    for value in values:
+        counts[next((n for n, bound in enumerate(BUCKETS_MS) if value <= bound), len(BUCKETS_MS))] += 1
+    return [(f"<={bound}ms", count) for bound, count in zip(BUCKETS_MS, counts)] + \
+           [(f">{BUCKETS_MS[-1]}ms", counts[-1])]
+
+
+def summarize(stages):
+    """ per-stage sorted stage_ms, and sorted end-to-end ms, from trace_stage entries; a trace
+    redelivered through a stage is counted once, at its latest completion """
+    latest = {}
+    for stage in stages:
+        latest[(stage['trace_id'], stage['stage'])] = stage
+    stage_ms, end_to_end = defaultdict(list), []
+    for (_, name), stage in latest.items():
+        stage_ms[name].append(stage['stage_ms'])
+        if name == "label":
+            end_to_end.append(stage['since_received_ms'])
+    return {name: sorted(values) for name, values in stage_ms.items()}, sorted(end_to_end)
+
+
+def print_distribution(title, values):
+    """ prints the count, percentiles and histogram of values """
+    print(f"{title}: {len(values)} traces, p50 {percentile(values, 0.5):.1f}ms, "
+          f"p95 {percentile(values, 0.95):.1f}ms, p99 {percentile(values, 0.99):.1f}ms")
+    widest = max((count for _, count in histogram(values)), default=0) or 1
+    for bucket, count in histogram(values):
+        print(f"  {bucket:>9} {count:6} {'#' * round(40 * count / widest)}")
+
+
+def report():
+    """ parses arguments and prints the report """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", maxsplit=1)[0])
+    parser.add_argument("logs", nargs="?", type=argparse.FileType("r", encoding="utf-8"), default=sys.stdin,
+                        help="JSON log entries (default: stdin)")
+    args = parser.parse_args()
+
+    stage_ms, end_to_end = summarize(entries(args.logs))
+    for name in PIPELINE + sorted(set(stage_ms) - set(PIPELINE)):
+        if name in stage_ms:
+            print_distribution(name, stage_ms[name])
+    print_distribution("end to end (received to label)", end_to_end)
+
+
+if __name__ == "__main__":
+    report()
@@ -0,0 +1,69 @@
+""" Writes order labels in ZPL, the native language of the Zebra label printers used at check-in.
+
+    The label carries the same fields as the PDF label (see label_body.html), check-in code
+    included, laid out for a 4x6" label at 203 dpi. A ZPL label is a few hundred bytes of text
+    that the printer draws itself, so printing one skips downloading and rasterizing a PDF on the
+    printer host.
+"""
+
+import checkin_code
+
+DOTS_PER_INCH = 203
+LABEL_WIDTH, LABEL_LENGTH = 4 * DOTS_PER_INCH, 6 * DOTS_PER_INCH
+MARGIN = 30
+COLUMN_WIDTH = (LABEL_WIDTH - 2 * MARGIN) // 2
+TITLE_HEIGHT, VALUE_HEIGHT, NOTE_HEIGHT = 36, 420, 30
+RULE = 3
+CODE_TOP = 940  # below the note's four lines, leaving a quiet zone of four modules
+
+
+def field_data(text):
+    """ escapes text for a ^FH^FD field: ZPL control characters, the escape character itself
+    and anything outside ASCII are written as _XX hex bytes of their UTF-8 encoding """
+    return "".join(char if 32 <= ord(char) < 127 and char not in "^~_"
+                   else "".join(f"_{byte:02X}" for byte in char.encode("utf-8"))
+                   for char in " ".join(str(text).split()))
+
+
+def text(x, y, value, height, width, lines=1, justify="L", bold=False):
+    """ a block of text in the scalable font, wrapped to width and at most `lines` lines """
+    char_width = height if bold else height * 4 // 5
+    return (f"^FO{x},{y}^A0N,{height},{char_width}^FB{width},{lines},0,{justify}"
+            f"^FH^FD{field_data(value)}^FS")
+
+
+def box(x, y, width, height, thickness=RULE):
+    """ a filled rule or outline """
+    return f"^FO{x},{y}^GB{width},{height},{thickness}^FS"
+
+
+def qr_code(x, y, data):
+    """ a QR code the printer draws itself (model 2, error correction level M) """
+    return f"^FO{x},{y}^BQN,2,{checkin_code.ZPL_MAGNIFICATION}^FDMA,{data}^FS"
+
+
+def render(order):
+    """ the order's label as ZPL """
+    left, right = MARGIN, MARGIN + COLUMN_WIDTH
+    width = LABEL_WIDTH - 2 * MARGIN
+    commands = ["^XA", "^CI28", f"^PW{LABEL_WIDTH}", f"^LL{LABEL_LENGTH}",
+                text(left, 30, f"Name: {order.customer_name}", TITLE_HEIGHT, COLUMN_WIDTH),
+                text(right, 30, f"Phone: {order.phone_number}", TITLE_HEIGHT, COLUMN_WIDTH),
+                text(left, 80, f"Order #: {order.square_order_number}", TITLE_HEIGHT, COLUMN_WIDTH),
+                text(right, 80, f"Total: ${order.total:,.2f}", TITLE_HEIGHT, COLUMN_WIDTH),
+                box(left, 130, width, RULE),
+                text(left, 150, "Concert Tickets", TITLE_HEIGHT, COLUMN_WIDTH, justify="C", bold=True),
+                text(right, 150, "Dinner Tickets", TITLE_HEIGHT, COLUMN_WIDTH, justify="C", bold=True),
+                box(left, 200, width, RULE),
+                box(right, 150, RULE, 620)]
+    for x, count in ((left, order.concert), (right, order.dinner)):
+        if count > 0:
+            commands.append(text(x, 280, count, VALUE_HEIGHT, COLUMN_WIDTH, justify="C", bold=True))
+    commands.append(box(left, 770, width, RULE))
+    if order.note:
+        commands.append(text(left, 790, f"Note: {order.note}", NOTE_HEIGHT, width, lines=4))
+    data = checkin_code.payload(order)
+    if data is not None:
+        commands.append(qr_code(left, CODE_TOP, data))
+    commands.append("^XZ")
+    return "\n".join(commands).encode("ascii")
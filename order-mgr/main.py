@@ -8,16 +8,21 @@
 # pylint: disable=redefined-outer-name,unused-argument,no-member
 
 import base64
+import contextlib
 import contextvars
 import json
 import os
 import re
+import threading
+import time
 
 from google.cloud import firestore
 from google.cloud.firestore_v1.base_query import FieldFilter, Or
 
 from square.client import Client
 
+import profiler
+
 firestore_client = firestore.Client()
 
 square_client = Client(
@@ -45,6 +50,93 @@ def log(message, *args, **kwargs):
     print(json.dumps(structured_json))
 
 
+def trace_stage(trace, stage, started):
+    """ records the completion of a pipeline stage in the order's trace context and logs the
+    stage's latency, and the latency since the webhook was received, for trace_report.py """
+    now = time.time()
+    trace['stages'][stage] = now
+    log("%s stage complete", stage, trace_stage={
+        "trace_id": trace['id'], "order_id": trace['order_id'], "stage": stage,
+        "stage_ms": round((now - started) * 1000, 1),
+        "since_received_ms": round((now - trace['received_at']) * 1000, 1)})
+    return trace
+
+
+# where spans around external calls are exported: "" records nothing, "stdout" logs one entry
+# per call and "file:<path>" appends them as JSON lines, for offline analysis
+SPAN_EXPORTER = os.environ.get('SPAN_EXPORTER', '')
+
+
+def log_span(record):
+    """ exports a span as a structured log entry """
+    log("%s took %.1fms", record['name'], record['duration_ms'], span=record)
+
+
+def file_span_exporter(path):
+    """ an exporter appending spans to path, one JSON object per line """
+    lock = threading.Lock()
+
+    def export(record):
+        line = json.dumps(record, default=str) + "\n"
+        with lock, open(path, "a", encoding="utf-8") as spans:
+            spans.write(line)
+    return export
+
+
+def span_exporter_for(setting):
+    """ the exporter a SPAN_EXPORTER setting names, or None """
+    if not setting:
+        return None
+    if setting == "stdout":
+        return log_span
+    if setting.startswith("file:"):
+        return file_span_exporter(setting.removeprefix("file:"))
+    raise ValueError(f"unknown SPAN_EXPORTER {setting!r}")
+
+
+span_exporter = span_exporter_for(SPAN_EXPORTER)
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """ times the external call made in the block and exports its name, attributes, duration,
+    outcome (an exception's name, unless the block set one) and order id; the block may add the
+    payload size as 'bytes' to the dict it is given. Without an exporter nothing is timed """
+    record = {"name": name, **attributes}
+    if span_exporter is None:
+        yield record
+        return
+    record.update(order_id=ctx_id.get(), outcome="ok", started_at=time.time())
+    start = time.perf_counter()
+    try:
+        yield record
+    except BaseException as err:
+        record['outcome'] = type(err).__name__
+        raise
+    finally:
+        record['duration_ms'] = round((time.perf_counter() - start) * 1000, 2)
+        span_exporter(record)
+
+
+# entry points are profiled on request or for PROFILE_FRACTION of invocations; see profiler.py
+profiled = profiler.ProfileHook(log=log)
+
+
+def event_trace(event):
+    """ the trace context square-webhook put on the message, or None for messages without one """
+    trace = (event.get('attributes') or {}).get('trace')
+    return json.loads(trace) if trace else None
+
+
+def with_trace(doc, trace, started):
+    """ completes the order-mgr stage and stores the trace in the document, where firestore-mgr
+    picks it up """
+    if trace is not None:
+        doc['trace'] = trace_stage(trace, "order_mgr", started)
+    return doc
+
+
+@profiled
 def handle_order_created(event, context):
     """ This reads the webhook message off of the pub/sub topic and then queries the Square API
     to get the detailed order, payment, and customer objects to persist in firestore.
@@ -53,6 +145,7 @@ def handle_order_created(event, context):
     message to be retried. If this method returns without raising an Exception, then the GCF
     framework will automatically ACK the message.
     """
+    started = time.time()
     log("Received pubsub message_id '%s' from 'square.order.created' topic", context.event_id)
     webhook_event = json.loads(base64.b64decode(event['data']).decode('utf-8'))
 
@@ -63,11 +156,13 @@ def handle_order_created(event, context):
         log("received create webhook for a DRAFT order, squelching")
         return
 
-    commit_to_firestore(doc)
+    commit_to_firestore(with_trace(doc, event_trace(event), started))
 
 
+@profiled
 def handle_order_updated(event, context):
     """ Webhook fires denoting that there is an update to the Square order object """
+    started = time.time()
     log("Received pubsub message_id '%s' from 'square.order.updated' topic", context.event_id)
     webhook_event = json.loads(base64.b64decode(event['data']).decode('utf-8'))
     doc = build_doc_from_event(webhook_event)
@@ -75,11 +170,13 @@ def handle_order_updated(event, context):
         log("received update webhook for a DRAFT order, squelching")
         return
 
-    update_in_firestore(doc)
+    update_in_firestore(with_trace(doc, event_trace(event), started))
 
 
+@profiled
 def handle_payment_updated(event, context):
     """ Webhook fires denoting that there is an update to a Square payment object """
+    started = time.time()
     log("Received pubsub message_id '%s' from 'square.payment.updated' topic", context.event_id)
     webhook_event = json.loads(base64.b64decode(event['data']).decode('utf-8'))
 
@@ -87,11 +184,13 @@ def handle_payment_updated(event, context):
     order_id = payment['order_id']
 
     doc = build_doc_from_event(None, order_id=order_id, payment=payment)
-    update_in_firestore(doc)
+    update_in_firestore(with_trace(doc, event_trace(event), started))
 
 
+@profiled
 def handle_customer_updated(event, context):
     """ Webhook fires denoting that there is an update to a Square customer object """
+    started = time.time()
     log("Received pubsub message_id '%s' from 'square.customer.updated' topic", context.event_id)
     webhook_event = json.loads(base64.b64decode(event['data']).decode('utf-8'))
 
@@ -101,14 +200,20 @@ def handle_customer_updated(event, context):
     # there may be two cases; one where we knew the customer_id when it was inserted
     event_ref = firestore_client.collection('events').document(os.environ['EVENT_DATE'])
     customer_id_ref = event_ref.collection('orders').where(filter=Or([FieldFilter("customer.id", "==", customer_id),FieldFilter("order.customer_id", "==", customer_id)]))
-    results = customer_id_ref.stream()
+    with span("firestore.query", collection="orders") as call:
+        results = list(customer_id_ref.stream())
+        call['documents'] = len(results)
 
     # if yes, rebuild for each of those docs
     count = 0
     for result in results:
         count += 1
         doc = build_doc_from_event(None, order_id=result.order.id, customer_id=customer_id)
-        update_in_firestore(doc)
+        # one webhook fans out to every order of the customer, each carrying its own copy
+        trace = event_trace(event)
+        if trace is not None:
+            trace['order_id'] = doc['order']['id']
+        update_in_firestore(with_trace(doc, trace, started))
 
     if count == 0:
         log("received update for customer ID %s but no documents matched", customer_id)
@@ -160,6 +265,13 @@ def build_doc_from_event(event, order_id=None, payment=None, customer_id=None):
     }
 
 
+def square_call_outcome(call, result):
+    """ records the size of a Square API response, and its status if the call failed, on its span """
+    call['bytes'] = len(result.text or "")
+    if not result.is_success():
+        call['outcome'] = f"http {result.status_code}"
+
+
 def get_square_order(order_id: str):
     """ Gets Square Order object for given id value from Square API
 
@@ -173,7 +285,9 @@ def get_square_order(order_id: str):
         'order_ids': [order_id]
     }
 
-    result = orders_api.batch_retrieve_orders(body)
+    with span("square.batch_retrieve_orders") as call:
+        result = orders_api.batch_retrieve_orders(body)
+        square_call_outcome(call, result)
     if result.is_success():
         log("Square order API response", response=result.body)
         return result.body['orders'][0]
@@ -204,7 +318,9 @@ def get_square_customer(customer_id: str):
     """
     customers_api = square_client.customers
 
-    result = customers_api.retrieve_customer(customer_id)
+    with span("square.retrieve_customer") as call:
+        result = customers_api.retrieve_customer(customer_id)
+        square_call_outcome(call, result)
     if result.is_success():
         log("Square customer API response", response=result.body)
         return result.body['customer']
@@ -267,7 +383,9 @@ def get_square_payment(payment_id: str):
     if not payment_id:
         raise Exception("asked for a None payment")
 
-    result = payments_api.get_payment(payment_id)
+    with span("square.get_payment") as call:
+        result = payments_api.get_payment(payment_id)
+        square_call_outcome(call, result)
     if result.is_success():
         log("Square payment API response", response=result.body)
         return result.body['payment']
@@ -279,17 +397,23 @@ def commit_to_firestore(doc: dict):
 
     event_ref = firestore_client.collection('events').document(os.environ['EVENT_DATE'])
     order_ref = event_ref.collection('orders').document(doc['order']['id'])
-    if order_ref.get().exists:
+    with span("firestore.get", document="order"):
+        exists = order_ref.get().exists
+    if exists:
         raise Exception("document already exists in firestore")
 
-    order_counter_ref = event_ref.get(['order_counter'])
+    with span("firestore.get", document="event"):
+        order_counter_ref = event_ref.get(['order_counter'])
     if not order_counter_ref.exists:
-        event_ref.set({"order_counter": 1000})
-    order_num_result = event_ref.update({"order_counter": firestore.Increment(1)})
+        with span("firestore.set", document="event"):
+            event_ref.set({"order_counter": 1000})
+    with span("firestore.update", document="event"):
+        order_num_result = event_ref.update({"order_counter": firestore.Increment(1)})
     doc['order_number'] = order_num_result.transform_results[0].integer_value
     # TODO: set order_number back on square order metadata field?
 
-    set_result = order_ref.set(doc)
+    with span("firestore.set", document="order"):
+        set_result = order_ref.set(doc)
     log("document committed to firestore: %s", set_result)
 
 
@@ -298,7 +422,8 @@ def update_in_firestore(doc: dict):
 
     event_ref = firestore_client.collection('events').document(os.environ['EVENT_DATE'])
     order_ref = event_ref.collection('orders').document(doc['order']['id'])
-    order_doc = order_ref.get()
+    with span("firestore.get", document="order"):
+        order_doc = order_ref.get()
     if order_doc.exists:
         update_doc = {}
 
@@ -311,7 +436,10 @@ def update_in_firestore(doc: dict):
         if not curr_customer_version or curr_customer_version > doc['customer']['version']:
             update_doc['customer'] = doc['customer']
         if len(update_doc.items()) > 0:
-            update_result = order_ref.update(update_doc)
+            if doc.get('trace') is not None:
+                update_doc['trace'] = doc['trace']
+            with span("firestore.update", document="order", fields=sorted(update_doc)):
+                update_result = order_ref.update(update_doc)
             log("updated firestore based on square update %s", update_result)
         else:
             log("skipped update since newer information is already persisted for record",
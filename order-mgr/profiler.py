@@ -0,0 +1,144 @@
+""" An on-demand profiler for single invocations of the function's entry points.
+
+    An invocation is profiled when an HTTP request carries an "X-Profile: true" header, when a
+    Pub/Sub message carries a profile=true attribute, or at random for PROFILE_FRACTION of
+    invocations (e.g. 0.01). Every other invocation pays for a comparison and a header or attribute
+    lookup.
+
+    PROFILE_FORMAT chooses the output:
+     - "collapsed" (the default): a thread samples the handler's stack every PROFILE_INTERVAL_MS
+       and writes one "frame;frame;frame count" line per distinct stack. That is the input
+       flamegraph.pl and speedscope expect, and the sampling costs the handler very little.
+     - "pstats": the handler runs under cProfile and its stats are written for pstats or
+       snakeviz. This counts every call, so it slows the handler down far more than sampling.
+
+    Profiles are written under PROFILE_OUTPUT, either a local directory (/tmp/profiles by default;
+    on Cloud Functions /tmp is in memory) or gs://bucket/prefix, as <handler>-<time>-<id>.<format>.
+
+    This file is duplicated in each function's directory, as the functions deploy independently.
+"""
+
+from collections import Counter
+import cProfile
+from datetime import datetime, timezone
+import functools
+import marshal
+import os
+import random
+import sys
+import threading
+import uuid
+
+PROFILE_FRACTION = float(os.environ.get('PROFILE_FRACTION', 0))
+PROFILE_FORMAT = os.environ.get('PROFILE_FORMAT', 'collapsed')
+PROFILE_INTERVAL_MS = float(os.environ.get('PROFILE_INTERVAL_MS', 5))
+PROFILE_OUTPUT = os.environ.get('PROFILE_OUTPUT', '/tmp/profiles')
+
+
+class StackSampler:
+    """ samples one thread's stack from a background thread and counts the distinct stacks """
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    def start(self):
+        """ starts sampling """
+        self._thread.start()
+
+    def stop(self):
+        """ stops sampling once the sample being taken is counted """
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)  # pylint: disable=protected-access
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def collapsed(self) -> bytes:
+        """ the samples in collapsed-stack format, one "root;...;leaf count" line per stack """
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common()).encode("utf-8")
+
+
+def requested(args) -> bool:
+    """ whether the invocation asks to be profiled: an HTTP request with an X-Profile header, or
+    a Pub/Sub event with a profile attribute """
+    trigger = args[0] if args else None
+    headers = getattr(trigger, 'headers', None)
+    if headers is not None:
+        return headers.get('X-Profile', '').lower() == "true"
+    if isinstance(trigger, dict):
+        return (trigger.get('attributes') or {}).get('profile', '').lower() == "true"
+    return False
+
+
+class ProfileHook:
+    """ decorates entry points so that chosen invocations are profiled """
+
+    def __init__(self, fraction=PROFILE_FRACTION, profile_format=PROFILE_FORMAT,
+                 interval_ms=PROFILE_INTERVAL_MS, output=PROFILE_OUTPUT, log=print):
+        if profile_format not in ("collapsed", "pstats"):
+            raise ValueError(f"unknown PROFILE_FORMAT {profile_format!r}")
+        self.fraction = fraction
+        self.profile_format = profile_format
+        self.interval = interval_ms / 1000
+        self.output = output
+        self.log = log
+
+    def __call__(self, handler):
+        @functools.wraps(handler)
+        def entry_point(*args, **kwargs):
+            if (self.fraction <= 0 or random.random() >= self.fraction) and not requested(args):
+                return handler(*args, **kwargs)
+            return self.profile(handler, args, kwargs)
+        return entry_point
+
+    def profile(self, handler, args, kwargs):
+        """ runs the handler under the profiler and writes out its profile, even if it raised """
+        if self.profile_format == "pstats":
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(handler, *args, **kwargs)
+            finally:
+                profile.create_stats()
+                self.write(handler.__name__, marshal.dumps(profile.stats))
+        sampler = StackSampler(threading.get_ident(), self.interval)
+        sampler.start()
+        try:
+            return handler(*args, **kwargs)
+        finally:
+            sampler.stop()
+            self.write(handler.__name__, sampler.collapsed())
+
+    def write(self, name, profile_bytes):
+        """ stores the profile under the output directory or GCS prefix; a failure is logged
+        rather than failing the invocation """
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S")
+        file_name = f"{name}-{stamp}-{uuid.uuid4().hex[:8]}.{self.profile_format}"
+        try:
+            if self.output.startswith("gs://"):
+                from google.cloud import storage  # pylint: disable=import-outside-toplevel
+                bucket_name, _, prefix = self.output.removeprefix("gs://").partition("/")
+                path = f"{prefix.rstrip('/')}/{file_name}".lstrip("/")
+                storage.Client().bucket(bucket_name).blob(path).upload_from_string(profile_bytes)
+                location = f"gs://{bucket_name}/{path}"
+            else:
+                os.makedirs(self.output, exist_ok=True)
+                location = os.path.join(self.output, file_name)
+                with open(location, "wb") as profile_file:
+                    profile_file.write(profile_bytes)
+        except Exception as err:  # pylint: disable=broad-except
+            self.log("writing the %s profile failed: %s", name, err)
+            return None
+        self.log("wrote %s profile to %s", name, location)
+        return location
@@ -0,0 +1,97 @@
+""" Benchmarks the check-in search index.
+
+    Builds an index of plausible orders (common last names, so broad prefixes match hundreds of
+    orders; phone numbers with and without the country code; some guests already checked in) and
+    times:
+     - build:  filing every order, as a rebuild from MySQL does once the rows are read
+     - search: lookups by last name, phone and order number prefix, from one character to the
+               whole key; p50, p99 and worst case
+     - cold:   the first broad lookups after a refresh re-files orders, which re-rank their nodes
+
+    Needs the same environment variables as the cloud function, and credentials for its GCS
+    bucket (main opens it on import), e.g.:
+
+        env $(cat .env) python bench_search.py --orders 3000
+"""
+
+import argparse
+from datetime import datetime, timedelta
+import gc
+import random
+import time
+
+import main
+
+LAST_NAMES = ["Smith", "Johnson", "Williams", "Brown", "Jones", "Garcia", "Miller", "Davis", "O'Brien",
+              "Rodriguez", "Martinez", "Hernandez", "Lopez", "Gonzalez", "Wilson", "Anderson", "Thomas",
+              "Taylor", "Moore", "Jackson", "Martin", "Lee", "Perez", "Thompson", "White", "Harris",
+              "Sanchez", "Clark", "Ramirez", "Lewis", "Robinson", "Walker", "Young", "Allen", "King"]
+
+
+def make_row(number, rng):
+    """ builds an orders table row like the ones firestore-mgr writes """
+    last_name = rng.choice(LAST_NAMES) + (str(rng.randint(1, 99)) if rng.random() < 0.5 else "")
+    phone = f"{rng.randint(200, 999)}555{rng.randint(0, 9999):04d}"
+    return {'id': f"order-{number:06d}", 'created_at': datetime(2024, 12, 1) + timedelta(minutes=number),
+            'square_order_number': 1000 + number, 'customer_name': f"Pat {last_name}", 'last_name': last_name,
+            'phone_number': f"1{phone}" if rng.random() < 0.5 else phone, 'concert': 0, 'dinner': 2,
+            'note': None, 'status': "ARRIVED" if rng.random() < 0.3 else None, 'checkin_time': None,
+            'label_url': f"https://labels/{number}.pdf"}
+
+
+def make_queries(rows, rng, count):
+    """ prefixes of real keys, of every length, as a volunteer types them """
+    queries = []
+    for _ in range(count):
+        row = rng.choice(rows)
+        key = rng.choice([main.search_key(row['last_name']), row['phone_number'][-10:],
+                          str(row['square_order_number'])])
+        queries.append(key[:rng.randint(1, len(key))])
+    return queries
+
+
+def percentiles(seconds):
+    """ p50, p99 and worst of the timings, in microseconds """
+    ordered = sorted(seconds)
+    return (f"p50 {ordered[len(ordered) // 2] * 1e6:7.1f} us  p99 {ordered[len(ordered) * 99 // 100] * 1e6:7.1f} us  "
+            f"max {ordered[-1] * 1e6:7.1f} us")
+
+
+def bench():
+    """ parses arguments and runs each benchmark """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", maxsplit=1)[0])
+    parser.add_argument("--orders", type=int, default=3000)
+    parser.add_argument("--queries", type=int, default=5000)
+    parser.add_argument("--limit", type=int, default=10)
+    args = parser.parse_args()
+
+    rng = random.Random(7186)
+    rows = [make_row(number, rng) for number in range(args.orders)]
+    queries = make_queries(rows, rng, args.queries)
+
+    start = time.perf_counter()
+    index = main.SearchIndex()
+    index.load(rows)
+    print(f"{'build':>7}: {(time.perf_counter() - start) * 1000:8.1f} ms for {len(rows)} orders")
+
+    # as timeit does, so the worst cases are the index's rather than the garbage collector's
+    gc.disable()
+    timings = []
+    for query in queries:
+        start = time.perf_counter()
+        index.search(query, args.limit)
+        timings.append(time.perf_counter() - start)
+    print(f"{'search':>7}: {percentiles(timings)}")
+
+    timings = []
+    for letter in "abcdefghijklmnopqrstuvwxyz123456789":
+        index.load(rng.sample(rows, 50))
+        start = time.perf_counter()
+        index.search(letter, args.limit)
+        timings.append(time.perf_counter() - start)
+    print(f"{'cold':>7}: {percentiles(timings)}")
+    gc.enable()
+
+
+if __name__ == "__main__":
+    bench()
@@ -6,21 +6,92 @@
 """
 # pylint: disable=redefined-outer-name,unused-argument,no-member
 
+import base64
+import bisect
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
 import contextvars
-from datetime import datetime
+from datetime import datetime, timedelta
+import functools
+import hashlib
+import hmac
+import io
 import json
 import os
 import re
+import threading
+import time
 import urllib.parse
+import uuid
+from zoneinfo import ZoneInfo
 
 from flask import Response, Request
+from google.api_core.exceptions import AlreadyExists, FailedPrecondition, NotFound as GoogleNotFound
+import google.auth
+import google.auth.transport.requests
 from google.cloud import storage, firestore, pubsub_v1
+from pypdf import PdfWriter
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, Text, create_engine, select
 from werkzeug.exceptions import NotFound
 
+import profiler
+
 GCS_BUCKET = os.environ['GCS_BUCKET']
 
+# what the check-in printers accept: "zpl" sends the ZPL version of a label that firestore-mgr
+# stores next to the PDF (with LABEL_ZPL set), falling back to the PDF for labels without one
+PRINT_FORMAT = os.environ.get('PRINT_FORMAT', 'pdf')
+LABEL_CONTENT_TYPES = {'pdf': "application/pdf", 'zpl': "application/x-zpl"}
+
+# the printers' topics (each printer host subscribes to one) and how jobs are spread over them:
+# "least_loaded" or "round_robin"; PRINT_STATIONS maps a check-in station to the topic of the
+# printer next to it, e.g. {"door": "print_queue_1"}
+PRINT_TOPICS = [topic.strip() for topic in os.environ.get('PRINT_TOPICS', 'print_queue').split(',') if topic.strip()]
+PRINT_ROUTING = os.environ.get('PRINT_ROUTING', 'least_loaded')
+PRINT_STATIONS = json.loads(os.environ.get('PRINT_STATIONS', '{}'))
+
+# with PRINT_CLAIM_CHECK set, print_queue messages carry a short-lived signed URL to the label
+# rather than the label itself, and the printer host fetches it from GCS
+PRINT_CLAIM_CHECK = os.environ.get('PRINT_CLAIM_CHECK', '0') == '1'
+CLAIM_CHECK_TTL = timedelta(seconds=int(os.environ.get('CLAIM_CHECK_TTL_SECONDS', 300)))
+
+# check-in codes on labels are signed with this secret, shared with firestore-mgr; scanned
+# check-ins are timed in the event's time zone
+LABEL_TOKEN_SECRET = os.environ['LABEL_TOKEN_SECRET']
+if not LABEL_TOKEN_SECRET:
+    raise ValueError("LABEL_TOKEN_SECRET is empty, so every scanned check-in code would be refused")
+EVENT_TIMEZONE = ZoneInfo(os.environ.get('EVENT_TIMEZONE', 'America/New_York'))
+
+# the check-in search index re-reads orders created since its last refresh (with some overlap,
+# as orders can land in MySQL out of order) at most every SEARCH_REFRESH_SECONDS, and is rebuilt
+# from the whole table every SEARCH_REBUILD_SECONDS. created_at is when the order was placed in
+# Square, not when its row was written, and rows carry no update time, so only the rebuild picks
+# up check-ins, renames and orders written more than SEARCH_OVERLAP after they were placed:
+# results (and the not-yet-checked-in-first ranking) can be up to SEARCH_REBUILD_SECONDS stale.
+# A rebuild reads the table without holding up searches, so it is kept short
+SEARCH_REFRESH_SECONDS = float(os.environ.get('SEARCH_REFRESH_SECONDS', 15))
+SEARCH_REBUILD_SECONDS = float(os.environ.get('SEARCH_REBUILD_SECONDS', 60))
+SEARCH_OVERLAP = timedelta(minutes=5)
+# search returns guests' names, phone numbers and notes, so the function is deployed for IAM
+# callers only; with SEARCH_TOKEN set, requests must also carry it in an X-Search-Token header
+SEARCH_TOKEN = os.environ.get('SEARCH_TOKEN', '')
+
+# label bytes kept in memory for check-in printing; labels are a few KB, so the default holds
+# thousands of them well within the function's memory
+LABEL_CACHE_BYTES = int(os.environ.get('LABEL_CACHE_BYTES', 16 * 1024 * 1024))
+# for this long after a label's generation was last read from GCS, a check-in prints the cached
+# label without asking GCS again, so a label re-rendered meanwhile may print as it was
+LABEL_CACHE_TTL_SECONDS = float(os.environ.get('LABEL_CACHE_TTL_SECONDS', 60))
+# prefetching reads the event's labels in bulk, so the public print function only does it for
+# callers sending this token in an X-Prefetch-Token header, and not at all without one
+PREFETCH_TOKEN = os.environ.get('PREFETCH_TOKEN', '')
+
 
 ctx_id = contextvars.ContextVar("square_order_id", default="")
+checkin_trace = contextvars.ContextVar("checkin_trace", default=None)
+# the traces of the orders being checked in, from their documents, which the print stage continues
+order_traces = contextvars.ContextVar("order_traces", default=())
 
 
 def log(message, *args, **kwargs):
@@ -38,9 +109,83 @@ def log(message, *args, **kwargs):
     print(json.dumps(structured_json))
 
 
+def trace_stage(trace, stage, started):
+    """ records the completion of a pipeline stage in the trace context and logs the stage's
+    latency, and the latency since the trace began, for trace_report.py """
+    now = time.time()
+    trace['stages'][stage] = now
+    log("%s stage complete", stage, trace_stage={
+        "trace_id": trace['id'], "order_id": trace['order_id'], "stage": stage,
+        "stage_ms": round((now - started) * 1000, 1),
+        "since_received_ms": round((now - trace['received_at']) * 1000, 1)})
+    return trace
+
+
+# where spans around external calls are exported: "" records nothing, "stdout" logs one entry
+# per call and "file:<path>" appends them as JSON lines, for offline analysis
+SPAN_EXPORTER = os.environ.get('SPAN_EXPORTER', '')
+
+
+def log_span(record):
+    """ exports a span as a structured log entry """
+    log("%s took %.1fms", record['name'], record['duration_ms'], span=record)
+
+
+def file_span_exporter(path):
+    """ an exporter appending spans to path, one JSON object per line """
+    lock = threading.Lock()
+
+    def export(record):
+        line = json.dumps(record, default=str) + "\n"
+        with lock, open(path, "a", encoding="utf-8") as spans:
+            spans.write(line)
+    return export
+
+
+def span_exporter_for(setting):
+    """ the exporter a SPAN_EXPORTER setting names, or None """
+    if not setting:
+        return None
+    if setting == "stdout":
+        return log_span
+    if setting.startswith("file:"):
+        return file_span_exporter(setting.removeprefix("file:"))
+    raise ValueError(f"unknown SPAN_EXPORTER {setting!r}")
+
+
+span_exporter = span_exporter_for(SPAN_EXPORTER)
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """ times the external call made in the block and exports its name, attributes, duration,
+    outcome (an exception's name, unless the block set one) and order id; the block may add the
+    payload size as 'bytes' to the dict it is given. Without an exporter nothing is timed """
+    record = {"name": name, **attributes}
+    if span_exporter is None:
+        yield record
+        return
+    record.update(order_id=ctx_id.get(), outcome="ok", started_at=time.time())
+    start = time.perf_counter()
+    try:
+        yield record
+    except BaseException as err:
+        record['outcome'] = type(err).__name__
+        raise
+    finally:
+        record['duration_ms'] = round((time.perf_counter() - start) * 1000, 2)
+        span_exporter(record)
+
+
+# entry points are profiled on request or for PROFILE_FRACTION of invocations; see profiler.py
+profiled = profiler.ProfileHook(log=log)
+
+
 # Instantiates a firestore client
 fs_client = firestore.Client()
 collection_path = f"events/{os.environ['EVENT_DATE']}/orders"
+# one marker document per order that has been checked in and printed
+checkins_path = f"events/{os.environ['EVENT_DATE']}/checkins"
 
 # Instantiates a storage client
 client = storage.Client()
@@ -53,7 +198,8 @@ def fetch_document_from_firestore(doc_id):
     # extract relevant document & collection paths
     doc = fs_client.collection(collection_path).document(doc_id)
 
-    doc_snap = doc.get()
+    with span("firestore.get", document="order"):
+        doc_snap = doc.get()
 
     if doc_snap.exists:
         return doc_snap, doc
@@ -61,74 +207,913 @@ def fetch_document_from_firestore(doc_id):
     raise KeyError(f"could not find {doc_id} in Firestore")
 
 
-def get_label_bytes(self_link):
-    """ downloads label from GCS using self_link """
-    # get path to object within bucket
-    label_ref = urllib.parse.unquote(self_link.removeprefix(
+class LabelCache:
+    """ a bounded LRU of label bytes keyed by GCS object name and generation.
+
+    A label that firestore-mgr re-renders is uploaded as a new generation of the same object, so
+    a cached entry can never be served for a label that has since changed; the old generation
+    just ages out. Finding the current generation takes a GCS metadata request, though, so the
+    generation each label was last seen at is trusted for ttl seconds (see current()).
+    """
+
+    def __init__(self, max_bytes, ttl=0.0):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        # (label name, requested format) -> (object name, generation, format, when it was read)
+        self.generations = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, name, generation):
+        """ the cached bytes for this generation of the object, or None """
+        with self.lock:
+            label_bytes = self.entries.get((name, generation))
+            if label_bytes is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end((name, generation))
+            return label_bytes
+
+    def put(self, name, generation, label_bytes):
+        """ adds label bytes, evicting the least recently used labels to stay within max_bytes """
+        if len(label_bytes) > self.max_bytes:
+            return
+        with self.lock:
+            if (name, generation) in self.entries:
+                return
+            self.entries[(name, generation)] = label_bytes
+            self.bytes += len(label_bytes)
+            while self.bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.bytes -= len(evicted)
+
+    def seen(self, label, print_format, blob, label_format):
+        """ records the generation of the object found for the label in the requested format """
+        with self.lock:
+            self.generations[(label, print_format)] = (blob.name, blob.generation, label_format, time.monotonic())
+
+    def current(self, label, print_format):
+        """ the cached bytes and format of the label in the requested format if its generation
+        was read from GCS within ttl seconds, else None """
+        with self.lock:
+            seen = self.generations.get((label, print_format))
+            if seen is None or time.monotonic() - seen[3] >= self.ttl:
+                return None
+            name, generation, label_format, _ = seen
+            label_bytes = self.entries.get((name, generation))
+            if label_bytes is None:
+                return None
+            self.hits += 1
+            self.entries.move_to_end((name, generation))
+            return label_bytes, label_format
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def stats(self) -> dict:
+        """ hit rate and size, for logging """
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0,
+                "labels": len(self.entries), "bytes": self.bytes, "max_bytes": self.max_bytes}
+
+
+label_cache = LabelCache(LABEL_CACHE_BYTES, LABEL_CACHE_TTL_SECONDS)
+
+
+class LatencyRecorder:
+    """ the latencies of the most recent requests, for percentiles """
+
+    def __init__(self, window=1000):
+        self.samples = deque(maxlen=window)
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        """ adds one request's latency """
+        with self.lock:
+            self.samples.append(seconds)
+            self.count += 1
+
+    def percentiles(self) -> dict:
+        """ p50 and p99 in milliseconds over the window, plus the number of requests seen """
+        with self.lock:
+            samples, count = list(self.samples), self.count
+        ordered = sorted(samples)
+        if not ordered:
+            return {"count": 0}
+        return {"p50": round(ordered[(len(ordered) - 1) // 2] * 1000, 1),
+                "p99": round(ordered[(len(ordered) - 1) * 99 // 100] * 1000, 1),
+                "count": count}
+
+
+checkin_latency = LatencyRecorder()
+
+
+def label_name(self_link):
+    """ the path to the label object within the bucket, from its self link """
+    return urllib.parse.unquote(self_link.removeprefix(
         "https://www.googleapis.com/storage/v1/b/kofc7186-fishfry/o/"))
-    return bucket.get_blob(label_ref).download_as_bytes()
 
 
-def send_pdf_to_topic(pdf_bytes, order_id, reprint=False):
-    """ sends PDF to print_queue topic """
+def blob_bytes(blob):
+    """ the bytes of the blob's current generation, from the cache if it holds them """
+    label_bytes = label_cache.get(blob.name, blob.generation)
+    if label_bytes is None:
+        with span("gcs.download", bytes=blob.size):
+            label_bytes = blob.download_as_bytes()
+        label_cache.put(blob.name, blob.generation, label_bytes)
+    return label_bytes
+
+
+def get_label_blob(self_link, print_format="pdf"):
+    """ the label's GCS object (metadata only) in the given format if it was stored in it;
+    returns the blob and the format it is in """
+    label_ref = label_name(self_link)
+    if print_format != "pdf":
+        with span("gcs.get_blob", format=print_format) as call:
+            blob = bucket.get_blob(f"{label_ref.removesuffix('.pdf')}.{print_format}")
+            if blob is None:
+                call['outcome'] = "not found"
+        if blob is not None:
+            return blob, print_format
+        log(f"no {print_format} label stored, sending the PDF instead")
+    with span("gcs.get_blob", format="pdf"):
+        return bucket.get_blob(label_ref), "pdf"
+
+
+def get_label_bytes(self_link, print_format="pdf"):
+    """ fetches label from GCS using self_link, in the given format if it was stored in it;
+    returns the label bytes and the format they are in. GCS isn't asked at all while the cache
+    trusts the generation it holds, and only for the object's metadata when the cache holds the
+    current generation """
+    label_ref = label_name(self_link)
+    cached = label_cache.current(label_ref, print_format)
+    if cached is not None:
+        return cached
+    blob, label_format = get_label_blob(self_link, print_format)
+    label_bytes = blob_bytes(blob)
+    label_cache.seen(label_ref, print_format, blob, label_format)
+    return label_bytes, label_format
+
+
+def prefetch_labels(names=None, print_format="pdf", workers=8):
+    """ warms the cache with the current generation of the named labels or, without names, of the
+    event's most recently written labels, stopping once the cache is full; returns the number of
+    labels downloaded """
+    if names is None:
+        with span("gcs.list_blobs"):
+            blobs = [blob for blob in client.list_blobs(GCS_BUCKET, prefix=f"{os.environ['EVENT_DATE']}/")
+                     if blob.name.endswith(f".{print_format}")]
+        blobs.sort(key=lambda blob: blob.updated, reverse=True)
+    else:
+        blobs = [blob for blob in (bucket.get_blob(name) for name in names) if blob is not None]
+
+    kept, size = [], 0
+    for blob in blobs:
+        size += blob.size or 0
+        if size > label_cache.max_bytes:
+            break
+        kept.append(blob)
+    wanted = [blob for blob in kept if (blob.name, blob.generation) not in label_cache]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for blob, label_bytes in zip(wanted, pool.map(lambda blob: blob.download_as_bytes(), wanted)):
+            label_cache.put(blob.name, blob.generation, label_bytes)
+    for blob in kept:
+        # check-ins look labels up by the PDF's name
+        label_cache.seen(f"{blob.name.removesuffix(f'.{print_format}')}.pdf", print_format, blob, print_format)
+    return len(wanted)
+
+
+class PrinterPool:
+    """ the check-in printers' topics and which of them takes the next job.
+
+    A printer's load is the number of jobs this instance sent it within the last `window`
+    seconds, a stand-in for its queue depth as printer hosts don't report back; ties go to the
+    printer whose publishes have been acknowledged fastest. A station's own printer is always
+    tried first. A printer whose publish fails is skipped for `cooldown` seconds, its jobs
+    failing over to the others.
+    """
+
+    def __init__(self, topics, routing="least_loaded", stations=None, window=60.0, cooldown=30.0):
+        self.topics = list(topics)
+        self.routing = routing
+        self.stations = stations or {}
+        self.window = window
+        self.cooldown = cooldown
+        self.sent = {topic: deque() for topic in self.topics}
+        self.ack_latency = dict.fromkeys(self.topics, 0.0)
+        self.down_until = dict.fromkeys(self.topics, 0.0)
+        self.turn = 0
+        self.lock = threading.Lock()
+
+    def load(self, topic, now=None) -> int:
+        """ jobs sent to the printer within the window """
+        now = time.monotonic() if now is None else now
+        sent = self.sent[topic]
+        while sent and sent[0] < now - self.window:
+            sent.popleft()
+        return len(sent)
+
+    def candidates(self, station=None) -> list:
+        """ the topics in the order to try them for the next job """
+        now = time.monotonic()
+        with self.lock:
+            up = [topic for topic in self.topics if self.down_until[topic] <= now]
+            if self.routing == "round_robin":
+                self.turn += 1
+                order = up[self.turn % len(up):] + up[:self.turn % len(up)] if up else []
+            else:
+                order = sorted(up, key=lambda topic: (self.load(topic, now), self.ack_latency[topic]))
+            preferred = self.stations.get(station)
+            if preferred in order:
+                order.remove(preferred)
+                order.insert(0, preferred)
+            # printers that recently failed are a last resort rather than never tried
+            return order + [topic for topic in self.topics if topic not in up]
+
+    def sent_to(self, topic, seconds):
+        """ records a job acknowledged by the topic after `seconds` """
+        with self.lock:
+            self.sent[topic].append(time.monotonic())
+            self.ack_latency[topic] = seconds if not self.ack_latency[topic] \
+                else 0.8 * self.ack_latency[topic] + 0.2 * seconds
+            self.down_until[topic] = 0.0
+
+    def failed(self, topic):
+        """ takes the topic out of rotation for the cooldown """
+        with self.lock:
+            self.down_until[topic] = time.monotonic() + self.cooldown
+
+    def stats(self) -> dict:
+        """ load and acknowledgement latency per printer, for logging """
+        now = time.monotonic()
+        with self.lock:
+            return {topic: {"load": self.load(topic, now), "ack_ms": round(self.ack_latency[topic] * 1000, 1),
+                            "down": self.down_until[topic] > now} for topic in self.topics}
+
+
+printer_pool = PrinterPool(PRINT_TOPICS, PRINT_ROUTING, PRINT_STATIONS)
+
+
+def publish_to_print_queue(data, order_id, reprint=False, station=None, **attributes):
+    """ publishes a message to a printer's topic with the son and reprint attributes the printer
+    host expects, plus any others given; the printer pool picks the topic, failing over to the
+    next printer if a publish fails.
+
+    A publish that times out may still be delivered, so it is not retried on another printer,
+    which could print the label twice; the error is raised instead. Every attempt carries the
+    same job_id (the order number and a per-request nonce) for printer hosts to drop a job they
+    have already printed """
 
     publisher = pubsub_v1.PublisherClient()
-    topic_path = publisher.topic_path(os.environ["GCP_PROJECT"], "print_queue")
 
     reprint_str = ""
     if reprint:
         reprint_str = "true"
+    trace = checkin_trace.get()
+    if trace is not None:
+        attributes['trace'] = json.dumps(trace)
+    # not the trace id, which a check-in shares with its order's earlier (and later) print jobs
+    attributes['job_id'] = f"{order_id}:{uuid.uuid4().hex}"
+    # Pub/Sub attributes must be text, and order numbers read from MySQL are ints
+    attributes = {name: str(value) for name, value in attributes.items()}
 
-    #   push onto print_queue
-    future = publisher.publish(topic_path,
-                               data=pdf_bytes,
-                               son=order_id,
-                               reprint=reprint_str)
+    error = RuntimeError("no printers available")
+    for topic in printer_pool.candidates(station):
+        topic_path = publisher.topic_path(os.environ["GCP_PROJECT"], topic)
+        start = time.perf_counter()
+        try:
+            with span("pubsub.publish", topic=topic, bytes=len(data)):
+                #   push onto the printer's queue
+                future = publisher.publish(topic_path,
+                                           data=data,
+                                           son=str(order_id),
+                                           reprint=reprint_str,
+                                           **attributes)
 
-    # this will block until the publish is complete
-    message_id = future.result(timeout=2)
-    log(f"print request on queue with message id {message_id}")
+                # this will block until the publish is complete
+                message_id = future.result(timeout=2)
+        except pubsub_v1.publisher.exceptions.TimeoutError:
+            log(f"publishing to {topic} timed out; not failing over as the job may still arrive")
+            raise
+        except Exception as err:  # pylint: disable=broad-except
+            log(f"publishing to {topic} failed, trying the next printer: {err}")
+            printer_pool.failed(topic)
+            error = err
+            continue
+        printer_pool.sent_to(topic, time.perf_counter() - start)
+        log(f"print request on queue {topic} with message id {message_id}", printers=printer_pool.stats())
+        return
+    raise error
 
 
-def handle_print(request: Request):
-    """ Prints a document """
-    reprint = request.args.get("reprint", "").lower()
-    request_json = request.get_json()
-    order_id = request_json['Data']['id']
-    ctx_id.set(order_id)
-    log("recieved print webhook", appsheet_json=request_json)
-
-    # payload.id contains the square order ID since this is reading the datastream JSON
-    firestore_doc_snap, firestore_doc = fetch_document_from_firestore(order_id)
-    firestore_dict = firestore_doc_snap.to_dict()
-    print_times = firestore_dict.get('print_times')
-    if print_times:
-        # if this is there, we've printed this doc before, skip it
-        log("doc has already been printed before, skipping", print_times=print_times)
-        return Response(status=400)
+def send_pdf_to_topic(pdf_bytes, order_id, reprint=False, print_format="pdf", station=None):
+    """ sends PDF (or a label in the printer's native language) to a printer's topic; the
+    content_type attribute tells the printer host which it is """
+    publish_to_print_queue(pdf_bytes, order_id, reprint, station, content_type=LABEL_CONTENT_TYPES[print_format])
+
+
+signing_credentials = None
+signing_lock = threading.Lock()
 
-    log("no prior printing detected, fetching label and sending to print queue")
-    if request_json['Data']['label_url']:
-        label_bytes = get_label_bytes(request_json['Data']['label_url'])
+
+def current_signing_credentials():
+    """ the function's credentials, loaded once per instance and refreshed only once their access
+    token has expired, rather than fetching a new token for every claim check """
+    global signing_credentials  # pylint: disable=global-statement
+    with signing_lock:
+        if signing_credentials is None:
+            signing_credentials, _ = google.auth.default()
+        if not signing_credentials.valid:
+            with span("auth.refresh"):
+                signing_credentials.refresh(google.auth.transport.requests.Request())
+        return signing_credentials
+
+
+def signed_label_url(blob):
+    """ a V4 signed URL to this generation of the label, valid for CLAIM_CHECK_TTL. The function's
+    credentials hold no private key, so the signature is made by the IAM signBlob API on behalf
+    of its service account (which needs roles/iam.serviceAccountTokenCreator on itself) """
+    credentials = current_signing_credentials()
+    with span("iam.sign_url"):
+        return blob.generate_signed_url(version="v4", expiration=CLAIM_CHECK_TTL, method="GET",
+                                        generation=blob.generation,
+                                        service_account_email=credentials.service_account_email,
+                                        access_token=credentials.token)
+
+
+def send_claim_check_to_topic(blob, order_id, reprint=False, print_format="pdf", station=None):
+    """ sends a claim check for the label to print_queue topic rather than the label itself: a
+    JSON body with the object's bucket, name, generation and a short-lived signed URL to fetch
+    it from. The claim_check attribute tells the printer host to fetch the label (printer hosts
+    that don't know it see the usual son/reprint/content_type attributes) """
+    claim = {"bucket": blob.bucket.name, "name": blob.name, "generation": blob.generation,
+             "url": signed_label_url(blob)}
+    publish_to_print_queue(json.dumps(claim).encode("utf-8"), order_id, reprint, station,
+                           content_type=LABEL_CONTENT_TYPES[print_format], claim_check="true")
+
+
+def handle_prefetch(request: Request, print_format):
+    """ warms this instance's label cache ahead of check-in, from the label_urls of upcoming
+    orders if the request lists them, else from the event's newest labels; callers must send
+    PREFETCH_TOKEN """
+    if not PREFETCH_TOKEN or not hmac.compare_digest(request.headers.get("X-Prefetch-Token", "").encode("utf-8"),
+                                                     PREFETCH_TOKEN.encode("utf-8")):
+        log("prefetch refused without a valid token")
+        return Response(status=403)
+    request_json = request.get_json(silent=True) or {}
+    names = None
+    if request_json.get('label_urls'):
+        names = [label_name(self_link) for self_link in request_json['label_urls']]
+        if print_format != "pdf":
+            names = [f"{name.removesuffix('.pdf')}.{print_format}" for name in names]
+    fetched = prefetch_labels(names, print_format)
+    log("prefetched %s labels", fetched, label_cache=label_cache.stats())
+    return Response(json.dumps({"prefetched": fetched, **label_cache.stats()}), status=200,
+                    mimetype="application/json")
+
+
+def send_label(request_json, reprint, print_format, station=None):
+    """ publishes the order's label (or a claim check for it) to the print queue """
+    if PRINT_CLAIM_CHECK:
+        label_blob, label_format = get_label_blob(request_json['Data']['label_url'], print_format)
+
+        send_claim_check_to_topic(label_blob,
+                                  request_json['Data']['square_order_number'],
+                                  reprint,
+                                  label_format,
+                                  station)
+    else:
+        label_bytes, label_format = get_label_bytes(request_json['Data']['label_url'], print_format)
 
         send_pdf_to_topic(label_bytes,
                           request_json['Data']['square_order_number'],
-                          reprint == "true")
-    else:
+                          reprint,
+                          label_format,
+                          station)
+        log("label sent", label_cache=label_cache.stats())
+
+
+def add_check_in(batch, order_snap, checkin_time, dt_string):
+    """ adds an order's check-in to a write batch: creating its marker in the checkins collection
+    (which fails the whole batch if it already exists) and recording pickup and print_times on
+    the order, provided it is unchanged since order_snap was read (else the batch fails too) """
+    batch.create(fs_client.collection(checkins_path).document(order_snap.id),
+                 {"print_time": dt_string, "checkin_time": checkin_time})
+    batch.update(fs_client.collection(collection_path).document(order_snap.id), {
+        "pickup": {
+            "status": "ARRIVED",
+            "checkin_time": checkin_time,
+        },
+        "print_times": [dt_string]
+    }, option=fs_client.write_option(last_update_time=order_snap.update_time))
+
+
+def continue_order_traces(order_snaps):
+    """ picks up the traces square-webhook began for the orders, which order-mgr and firestore-mgr
+    carried on in their documents, so that the print stage is reported as part of each order's
+    pipeline. A single order's trace also becomes the check-in's, sent on the print job """
+    traces = [dict(trace, stages=dict(trace.get('stages') or {}))
+              for trace in ((order_snap.to_dict() or {}).get('trace') for order_snap in order_snaps)
+              if isinstance(trace, dict) and trace.get('id')]
+    trace = checkin_trace.get()
+    if len(order_snaps) == 1 and traces and trace is not None:
+        trace.update(traces[0])
+        traces = [trace]
+    order_traces.set(traces)
+
+
+def read_orders(order_ids) -> list:
+    """ the orders' Firestore snapshots, read in one call, in the order of order_ids """
+    with span("firestore.get_all", documents=len(order_ids)):
+        snaps = {snap.id: snap for snap in fs_client.get_all(
+            [fs_client.collection(collection_path).document(order_id) for order_id in order_ids])}
+    missing = [order_id for order_id in order_ids if order_id not in snaps or not snaps[order_id].exists]
+    if missing:
+        raise KeyError(f"could not find {missing} in Firestore")
+    return [snaps[order_id] for order_id in order_ids]
+
+
+def already_printed(order_snap) -> bool:
+    """ whether the order was printed before; print_times is set by every print, including those
+    made before check-ins were claimed with markers (which such orders lack) """
+    return bool((order_snap.to_dict() or {}).get('print_times'))
+
+
+def claim_check_in(order_snaps, checkin_time):
+    """ records the check-in on the orders and claims their first print in one atomic commit; as
+    an existing marker, or an order changed since its snapshot was read (e.g. its print_times
+    set), fails the whole batch, of two volunteers scanning the same order only one gets to
+    print. Orders already printed, with or without a marker, aren't claimed. Returns whether
+    this check-in won the claim """
+    if any(already_printed(order_snap) for order_snap in order_snaps):
+        return False
+    # datetime object containing current date and time
+    now = datetime.now()
+
+    dt_string = now.strftime("%m/%d/%Y %H:%M:%S")
+    batch = fs_client.batch()
+    for order_snap in order_snaps:
+        add_check_in(batch, order_snap, checkin_time, dt_string)
+    try:
+        with span("firestore.commit", orders=len(order_snaps)):
+            batch.commit()
+    except (AlreadyExists, FailedPrecondition):
+        return False
+    except GoogleNotFound as err:
+        raise KeyError(f"could not find one of {[snap.id for snap in order_snaps]} in Firestore") from err
+    return True
+
+
+def release_check_in(order_ids):
+    """ gives up claimed prints that couldn't be sent so the next scan prints them; the guests
+    have still arrived, so the pickup status is left as it is """
+    batch = fs_client.batch()
+    for order_id in order_ids:
+        batch.delete(fs_client.collection(checkins_path).document(order_id))
+        batch.update(fs_client.collection(collection_path).document(order_id),
+                     {"print_times": firestore.DELETE_FIELD})
+    with span("firestore.commit", orders=len(order_ids)):
+        batch.commit()
+
+
+def merge_labels(labels, label_format):
+    """ joins labels into one print job: ZPL labels are self-contained and simply concatenate,
+    PDF labels become the pages of one document """
+    if label_format != "pdf":
+        return b"\n".join(labels)
+    writer = PdfWriter()
+    for label_bytes in labels:
+        writer.append(io.BytesIO(label_bytes))
+    merged = io.BytesIO()
+    writer.write(merged)
+    return merged.getvalue()
+
+
+def check_in(request_json, reprint, print_format, station=None):
+    """ claims the order's print and sends its label to the printers """
+    order_id = request_json['Data']['id']
+    if not request_json['Data']['label_url']:
         log("couldn't find label_url")
         return Response(status=400)
 
-    if reprint != "true":
-        # datetime object containing current date and time
-        now = datetime.now()
+    if reprint:
+        # payload.id contains the square order ID since this is reading the datastream JSON
+        firestore_doc_snap, _ = fetch_document_from_firestore(order_id)
+        continue_order_traces([firestore_doc_snap])
+        print_times = firestore_doc_snap.to_dict().get('print_times')
+        if print_times:
+            # if this is there, we've printed this doc before, skip it
+            log("doc has already been printed before, skipping", print_times=print_times)
+            return Response(status=400)
+        send_label(request_json, reprint, print_format, station)
+        return Response(status=200)
 
-        dt_string = now.strftime("%m/%d/%Y %H:%M:%S")
-        firestore_doc.update({
-            "pickup": {
-                "status": "ARRIVED",
-                "checkin_time": request_json['Data']['checkin_time'],
-            },
-            "print_times": [dt_string]
-        })
+    order_snaps = read_orders([order_id])
+    continue_order_traces(order_snaps)
+    if not claim_check_in(order_snaps, request_json['Data']['checkin_time']):
+        log("doc has already been printed before, skipping")
+        return Response(status=400)
 
+    log("print claimed, fetching label and sending to print queue")
+    try:
+        send_label(request_json, reprint, print_format, station)
+    except pubsub_v1.publisher.exceptions.TimeoutError:
+        log("publishing the label timed out; keeping the print claim as it may still print")
+        raise
+    except Exception:
+        log("sending label failed, releasing the print claim")
+        release_check_in([order_id])
+        raise
     return Response(status=200)
+
+
+def party_check_in(request_json, print_format, station=None):
+    """ checks in several orders (e.g. a family's) and prints all their labels as one job: the
+    labels are fetched while the orders are read in one call, the orders not yet printed are
+    claimed in one batch, and their labels are merged and published once """
+    orders = [order for order in request_json['orders'] if order.get('label_url')]
+    if len(orders) < len(request_json['orders']):
+        log("couldn't find label_url for some orders, skipping them")
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        labels = pool.map(lambda order: get_label_bytes(order['label_url'], print_format), orders)
+        order_snaps = read_orders([order['id'] for order in orders])
+        continue_order_traces(order_snaps)
+        printed = {order_snap.id for order_snap in order_snaps if already_printed(order_snap)}
+        labels = list(labels)
+        if any(label_format != print_format for _, label_format in labels):
+            # some orders have no label in the requested format; a print job needs just one
+            labels = list(pool.map(lambda order: get_label_bytes(order['label_url'], "pdf"), orders))
+            print_format = "pdf"
+
+    to_print = [(order, label_bytes) for order, (label_bytes, _) in zip(orders, labels) if order['id'] not in printed]
+    if not to_print:
+        log("every order in the party has already been printed, skipping")
+        return Response(status=400)
+    order_ids = [order['id'] for order, _ in to_print]
+    if not claim_check_in([order_snap for order_snap in order_snaps if order_snap.id not in printed],
+                          request_json['checkin_time']):
+        log("an order in the party was printed meanwhile, skipping")
+        return Response(status=400)
+
+    log("party print claimed, sending %s labels to print queue", len(to_print), order_ids=order_ids)
+    try:
+        send_pdf_to_topic(merge_labels([label_bytes for _, label_bytes in to_print], print_format),
+                          ",".join(str(order['square_order_number']) for order, _ in to_print),
+                          False,
+                          print_format,
+                          station)
+    except pubsub_v1.publisher.exceptions.TimeoutError:
+        log("publishing the labels timed out; keeping the print claims as they may still print")
+        raise
+    except Exception:
+        log("sending labels failed, releasing the print claims")
+        release_check_in(order_ids)
+        raise
+    return Response(json.dumps({"printed": order_ids, "already_printed": sorted(printed)}), status=200,
+                    mimetype="application/json")
+
+
+def verify_checkin_code(code):
+    """ the order id from a scanned check-in code, "<order id>.<token>", or None unless the token
+    is the one firestore-mgr made for that order with LABEL_TOKEN_SECRET """
+    order_id, _, token = code.strip().rpartition(".")
+    if not LABEL_TOKEN_SECRET or not order_id:
+        return None
+    digest = hmac.new(LABEL_TOKEN_SECRET.encode("utf-8"), order_id.encode("utf-8"), hashlib.sha256).digest()
+    expected = base64.urlsafe_b64encode(digest[:9]).decode("ascii")
+    return order_id if hmac.compare_digest(token.encode("utf-8"), expected.encode("ascii")) else None
+
+
+def scan_check_in(code, print_format, station=None):
+    """ checks in the order whose label was scanned: the code names the order, whose label is
+    then read from MySQL by primary key """
+    order_id = verify_checkin_code(code)
+    if order_id is None:
+        log("scanned code is not a valid check-in code", code=code)
+        return Response(status=403)
+    ctx_id.set(order_id)
+
+    with span("mysql.select", table="orders"), mysql_engine().connect() as connection:
+        row = connection.execute(
+            select(orders_table.c.label_url, orders_table.c.square_order_number)
+            .where(orders_table.c.id == order_id)).mappings().first()
+    if row is None:
+        log("scanned order is not in MySQL")
+        return Response(status=404)
+
+    checkin_time = datetime.now(EVENT_TIMEZONE).strftime("%-I:%M%p")
+    return check_in({'Data': {'id': order_id, 'label_url': row['label_url'],
+                              'square_order_number': str(row['square_order_number']),
+                              'checkin_time': checkin_time}},
+                    False, print_format, station)
+
+
+@profiled
+def handle_print(request: Request):
+    """ Prints a document; with ?code=, checks in the order whose label's QR code was scanned;
+    with ?party=true, checks in and prints several orders at once from a body of
+    {"orders": [{"id", "label_url", "square_order_number"}, ...], "checkin_time"}; with
+    ?prefetch=true, warms the label cache instead (the cache is per instance, so it is warmed
+    through the same function that prints); ?station= prefers the printer at that station """
+    reprint = request.args.get("reprint", "").lower()
+    print_format = request.args.get("format", PRINT_FORMAT).lower()
+    if print_format not in LABEL_CONTENT_TYPES:
+        print_format = "pdf"
+    station = request.args.get("station")
+    if request.args.get("prefetch", "").lower() == "true":
+        return handle_prefetch(request, print_format)
+    code = request.args.get("code")
+    party = request.args.get("party", "").lower() == "true"
+    if code:
+        ctx_id.set("")
+        log("recieved check-in code scan")
+    else:
+        request_json = request.get_json()
+        # a party spans several orders, so its logs carry none of them as the label
+        ctx_id.set("" if party else request_json['Data']['id'])
+        log("recieved print webhook", appsheet_json=request_json)
+
+    # the trace travels to the printer host on the job; it is the order's own trace once that is
+    # read from Firestore (see continue_order_traces), else one for this check-in alone
+    received = time.time()
+    trace = {"id": uuid.uuid4().hex, "received_at": received, "stages": {},
+             "order_id": ",".join(order['id'] for order in request_json['orders']) if party and not code else None}
+    checkin_trace.set(trace)
+    order_traces.set(())
+    start = time.perf_counter()
+    response = None
+    try:
+        if code:
+            response = scan_check_in(code, print_format, station)
+        elif party:
+            response = party_check_in(request_json, print_format, station)
+        else:
+            response = check_in(request_json, reprint == "true", print_format, station)
+        return response
+    finally:
+        checkin_latency.record(time.perf_counter() - start)
+        log("check-in handled", checkin_latency_ms=checkin_latency.percentiles())
+        if response is not None and response.status_code == 200:
+            for printed_trace in order_traces.get() or [trace]:
+                printed_trace['order_id'] = printed_trace['order_id'] or ctx_id.get()
+                trace_stage(printed_trace, "print", received)
+
+
+def orders_table_name(event_date: str) -> str:
+    """ each event gets its own orders table, e.g. 2024-12-06 -> orders_2024_12_06 """
+    return f"orders_{event_date.replace('-', '_')}"
+
+
+# the columns of firestore-mgr's orders table that check-in search reads
+orders_table = Table(
+    orders_table_name(os.environ['EVENT_DATE']), MetaData(),
+    Column('id', String(256), primary_key=True),
+    Column('created_at', DateTime),
+    Column('square_order_number', Integer),
+    Column('customer_name', Text),
+    Column('last_name', Text),
+    Column('phone_number', Text),
+    Column('concert', Integer),
+    Column('dinner', Integer),
+    Column('note', Text),
+    Column('status', String(32)),
+    Column('checkin_time', Text),
+    Column('label_url', Text),
+)
+
+
+# scanned check-ins and search read orders from MySQL, so a missing setting fails the deploy
+MYSQL_URL = (f"mysql+pymysql://{os.environ['DB_USER']}:{os.environ['DB_PASS']}@{os.environ['DB_HOST']}:"
+             f"{os.environ['DB_PORT']}/{os.environ['DB_NAME']}")
+
+
+@functools.lru_cache(maxsize=None)
+def mysql_engine():
+    """ the MySQL engine, created on first use so that instances that never read orders open no
+    connections """
+    return create_engine(MYSQL_URL, pool_size=2, max_overflow=0, pool_recycle=1800, pool_pre_ping=True)
+
+
+class TrieNode:  # pylint: disable=too-few-public-methods
+    """ a node of a Trie: the ids of every key below it, best first, and of the key ending here """
+    __slots__ = ("children", "ranked", "ends")
+
+    def __init__(self):
+        self.children = {}
+        self.ranked = []
+        self.ends = set()
+
+
+class Trie:
+    """ a prefix tree from keys to the ids filed under them. Every node keeps the ids of all keys
+    below it sorted by `rank`, inserting and removing in place as keys are filed, so a lookup
+    costs the length of the prefix plus the number of results wanted, however broad the prefix
+    and however recently orders were re-filed. An id's rank must not change while it is filed """
+
+    def __init__(self, rank):
+        self.root = TrieNode()
+        self.rank = rank
+
+    def add(self, key, item_id):
+        """ files item_id under key """
+        node = self.root
+        for char in key:
+            node = node.children.setdefault(char, TrieNode())
+            bisect.insort(node.ranked, item_id, key=self.rank)
+        node.ends.add(item_id)
+
+    def remove(self, key, item_id):
+        """ takes item_id out from under key """
+        rank = self.rank(item_id)
+        node = self.root
+        for char in key:
+            node = node.children.get(char)
+            if node is None:
+                return
+            position = bisect.bisect_left(node.ranked, rank, key=self.rank)
+            if position < len(node.ranked) and node.ranked[position] == item_id:
+                del node.ranked[position]
+        node.ends.discard(item_id)
+
+    def find(self, prefix):
+        """ the node for keys starting with prefix, or None """
+        node = self.root
+        for char in prefix:
+            node = node.children.get(char)
+            if node is None:
+                return None
+        return node
+
+    @staticmethod
+    def ranked(node) -> list:
+        """ the ids below node, best first """
+        return node.ranked
+
+
+def search_key(text) -> str:
+    """ folds case and drops everything but letters and digits, so "O'Brien" finds "OBrien" """
+    return "".join(char for char in str(text or "").casefold() if char.isalnum())
+
+
+class SearchIndex:
+    """ check-in lookups by last name, phone digits and Square order number prefix.
+
+    Results are ranked exact matches first, then order number, last name and phone matches,
+    then guests who haven't checked in yet before those who have, then by name.
+    """
+    FIELDS = ("square_order_number", "last_name", "phone_number")
+
+    def __init__(self):
+        self.rows = {}
+        self.keys = {}
+        self.ranks = {}
+        self.tries = {field: Trie(self.ranks.__getitem__) for field in self.FIELDS}
+        self.watermark = None
+        self.refreshed = self.rebuilt = time.monotonic()
+
+    @staticmethod
+    def index_keys(row) -> dict:
+        """ the keys the order is filed under, per field """
+        digits = "".join(char for char in str(row['phone_number'] or "") if char.isdigit())
+        phones = [digits] if digits else []
+        if len(digits) == 11 and digits.startswith("1"):
+            # US numbers are stored with their country code, which nobody types
+            phones.append(digits[1:])
+        return {
+            "square_order_number": [str(row['square_order_number'])] if row['square_order_number'] is not None else [],
+            "last_name": [search_key(row['last_name'])] if search_key(row['last_name']) else [],
+            "phone_number": phones,
+        }
+
+    def upsert(self, row):
+        """ (re)files an order """
+        row = dict(row)
+        for field, keys in self.keys.pop(row['id'], {}).items():
+            for key in keys:
+                self.tries[field].remove(key, row['id'])
+        self.rows[row['id']] = row
+        self.keys[row['id']] = self.index_keys(row)
+        self.ranks[row['id']] = (row['status'] == "ARRIVED", search_key(row['last_name']),
+                                 search_key(row['customer_name']), row['id'])
+        for field, keys in self.keys[row['id']].items():
+            for key in keys:
+                self.tries[field].add(key, row['id'])
+        if row['created_at'] is not None and (self.watermark is None or row['created_at'] > self.watermark):
+            self.watermark = row['created_at']
+
+    @staticmethod
+    def fetch(connection, since=None) -> list:
+        """ reads every order, or those created since the given time """
+        query = select(orders_table)
+        if since is not None:
+            query = query.where(orders_table.c.created_at >= since)
+        return connection.execute(query).mappings().all()
+
+    def load(self, rows):
+        """ files the orders read by fetch """
+        for row in rows:
+            self.upsert(row)
+        return len(rows)
+
+    def search(self, query, limit=10) -> list:
+        """ the best matching orders for what a volunteer typed """
+        key = search_key(query)
+        if not key:
+            return []
+        fields = self.FIELDS if key.isdigit() else ("last_name",)
+        matches = [(self.tries[field], self.tries[field].find(key)) for field in fields]
+        matches = [(trie, node) for trie, node in matches if node is not None]
+        results, seen = [], set()
+        # exact matches in field order, then prefix matches in field order
+        for candidates in ([sorted(node.ends, key=self.ranks.__getitem__) for _, node in matches]
+                           + [trie.ranked(node) for trie, node in matches]):
+            for order_id in candidates:
+                if order_id not in seen:
+                    seen.add(order_id)
+                    results.append(self.rows[order_id])
+                    if len(results) == limit:
+                        return results
+        return results
+
+
+search_index = None
+# held while the index is read or changed in place
+search_lock = threading.Lock()
+# held by the one request building a new index from scratch
+search_build_lock = threading.Lock()
+
+
+def rebuild_search_index(stale):
+    """ builds a new index from the whole table, outside search_lock, and swaps it in for the
+    stale one (None on first use) unless another request already has """
+    global search_index  # pylint: disable=global-statement
+    if search_index is not stale:
+        return
+    start = time.perf_counter()
+    index = SearchIndex()
+    with span("mysql.select", table="orders") as call, mysql_engine().connect() as connection:
+        count = call['rows'] = index.load(SearchIndex.fetch(connection))
+    with search_lock:
+        search_index = index
+    log("built search index of %s orders in %.0fms", count, (time.perf_counter() - start) * 1000)
+
+
+def current_search_index():
+    """ the search index, built on first use, refreshed with recently created orders and rebuilt
+    from scratch on their respective schedules. MySQL is read without search_lock held: while one
+    request rebuilds the index, the others keep searching the current one, and only the first
+    requests of an instance wait for an index to exist """
+    index = search_index
+    now = time.monotonic()
+    if index is None or now - index.rebuilt > SEARCH_REBUILD_SECONDS:
+        if search_build_lock.acquire(blocking=index is None):
+            try:
+                rebuild_search_index(index)
+            finally:
+                search_build_lock.release()
+        return search_index
+
+    with search_lock:
+        due = now - index.refreshed > SEARCH_REFRESH_SECONDS
+        if due:
+            index.refreshed = now
+    if due:
+        since = index.watermark - SEARCH_OVERLAP if index.watermark else None
+        with span("mysql.select", table="orders") as call, mysql_engine().connect() as connection:
+            rows = SearchIndex.fetch(connection, since)
+            call['rows'] = len(rows)
+        with search_lock:
+            count = index.load(rows)
+        log("refreshed search index with %s recent orders", count)
+    return index
+
+
+@profiled
+def handle_search(request: Request):
+    """ finds orders for check-in by last name, phone number or order number prefix, e.g.
+    ?q=smi or ?q=555 (&limit=10); results may be up to SEARCH_REBUILD_SECONDS behind MySQL """
+    if SEARCH_TOKEN and not hmac.compare_digest(request.headers.get("X-Search-Token", "").encode("utf-8"),
+                                                SEARCH_TOKEN.encode("utf-8")):
+        log("search refused without a valid token")
+        return Response(status=403)
+    query = request.args.get("q", "")
+    try:
+        limit = min(max(int(request.args.get("limit", 10)), 1), 50)
+    except ValueError:
+        return Response("limit must be a number", status=400)
+    index = current_search_index()
+    with search_lock:
+        start = time.perf_counter()
+        results = index.search(query, limit)
+        elapsed = time.perf_counter() - start
+    log("search for %r found %s orders in %.3fms", query, len(results), elapsed * 1000)
+    body = {"query": query, "search_ms": round(elapsed * 1000, 3),
+            "orders": [{**row, 'created_at': row['created_at'].isoformat() if row['created_at'] else None}
+                       for row in results]}
+    return Response(json.dumps(body), status=200, mimetype="application/json")
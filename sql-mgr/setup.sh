@@ -1,4 +1,20 @@
 #!/usr/bin/env bash
 
+# .env.yaml needs GCS_BUCKET and EVENT_DATE, LABEL_TOKEN_SECRET (as firestore-mgr's, to check
+# scanned check-in codes) and the DB_* settings firestore-mgr uses (scans read the order from MySQL)
 gcloud functions deploy print --region us-east1 --entry-point handle_print \
   --env-vars-file .env.yaml --runtime python311 --memory=128MB --trigger-http --allow-unauthenticated
+
+# check-in search, with the same .env.yaml (plus SEARCH_TOKEN to require a shared token as well). It returns guests' contact details, so it is not public: only
+# the check-in app's service account may invoke it, calling with an identity token
+gcloud functions deploy search --region us-east1 --entry-point handle_search \
+  --env-vars-file .env.yaml --runtime python311 --memory=256MB --trigger-http --no-allow-unauthenticated
+# gcloud functions add-invoker-policy-binding search --region us-east1 \
+#   --member "serviceAccount:<check-in app service account>"
+
+# warm the print function's label cache ahead of check-in (the cache is per instance, so this
+# calls the print function itself; keep a minimum instance running during the event)
+# with PREFETCH_TOKEN set in .env.yaml (prefetch is refused without it)
+# gcloud scheduler jobs create http print-prefetch --location us-east1 --schedule "*/5 * * * *" \
+#   --http-method POST --uri "https://us-east1-serverless-fish-fry.cloudfunctions.net/print?prefetch=true" \
+#   --headers "X-Prefetch-Token=<PREFETCH_TOKEN>"
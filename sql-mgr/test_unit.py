@@ -0,0 +1,558 @@
+""" Unit tests for the sql-mgr cloud function """
+# pylint: disable=redefined-outer-name,unused-argument,no-member
+
+from datetime import datetime, timedelta
+import importlib
+import importlib.util
+import io
+import json
+import os
+from unittest import mock
+
+from pypdf import PdfReader, PdfWriter
+import pytest
+
+
+@pytest.fixture(scope="module")
+def main():
+    """ imports the function module with the GCP clients mocked out """
+    with mock.patch("google.cloud.storage.Client"), mock.patch("google.cloud.firestore.Client"):
+        module = importlib.import_module("main")
+    return module
+
+
+@pytest.fixture(scope="module")
+def checkin_code():
+    """ firestore-mgr's checkin_code module, which makes the codes printed on labels """
+    pytest.importorskip("segno")
+    spec = importlib.util.spec_from_file_location(
+        "checkin_code", os.path.join(os.path.dirname(__file__), "..", "firestore-mgr", "checkin_code.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_blob(name, generation=1, content=b"label"):
+    """ builds a stand-in for a GCS blob holding content """
+    blob = mock.Mock(generation=generation, size=len(content))
+    blob.name = name
+    blob.download_as_bytes.return_value = content
+    return blob
+
+
+def test_label_cache_evicts_least_recently_used(main):
+    """ labels are evicted oldest use first to stay within max_bytes """
+    cache = main.LabelCache(max_bytes=10)
+    cache.put("a.pdf", 1, b"aaaa")
+    cache.put("b.pdf", 1, b"bbbb")
+    assert cache.get("a.pdf", 1) == b"aaaa"
+    cache.put("c.pdf", 1, b"cccc")
+    assert ("b.pdf", 1) not in cache
+    assert cache.get("a.pdf", 1) == b"aaaa" and cache.get("c.pdf", 1) == b"cccc"
+    assert cache.bytes == 8
+    cache.put("huge.pdf", 1, b"x" * 11)
+    assert ("huge.pdf", 1) not in cache and cache.bytes == 8
+
+
+def test_label_cache_keyed_by_generation(main, mocker):
+    """ a re-rendered label (a new generation of the same object) is downloaded again """
+    mocker.patch.object(main, "label_cache", main.LabelCache(max_bytes=1000))
+    old, new = make_blob("Doe - 7.pdf", 1, b"old"), make_blob("Doe - 7.pdf", 2, b"new")
+    assert main.blob_bytes(old) == b"old"
+    assert main.blob_bytes(old) == b"old"
+    assert old.download_as_bytes.call_count == 1
+    assert main.blob_bytes(new) == b"new"
+    assert main.label_cache.stats()['hits'] == 1 and main.label_cache.stats()['misses'] == 2
+
+
+def test_prefetch_labels(main, mocker):
+    """ prefetch downloads the named labels not yet cached, stopping once the cache is full """
+    mocker.patch.object(main, "label_cache", main.LabelCache(max_bytes=12))
+    blobs = {name: make_blob(name, content=b"1234") for name in ("a.pdf", "b.pdf", "c.pdf", "d.pdf")}
+    mocker.patch.object(main.bucket, "get_blob", side_effect=blobs.get)
+    main.label_cache.put("a.pdf", 1, b"1234")
+    assert main.prefetch_labels(["a.pdf", "b.pdf", "c.pdf", "d.pdf", "missing.pdf"]) == 2
+    assert not blobs["a.pdf"].download_as_bytes.called and not blobs["d.pdf"].download_as_bytes.called
+    assert main.label_cache.get("c.pdf", 1) == b"1234"
+
+
+def test_label_generation_trusted_for_ttl(main, mocker):
+    """ within the TTL a check-in prints the cached label without asking GCS; after it, GCS is
+    asked for the current generation again """
+    clock = mocker.patch.object(main.time, "monotonic", return_value=100.0)
+    mocker.patch.object(main, "label_cache", main.LabelCache(max_bytes=1000, ttl=60))
+    get_blob = mocker.patch.object(main.bucket, "get_blob", return_value=make_blob("Doe - 7.pdf", 1, b"old"))
+    self_link = "https://www.googleapis.com/storage/v1/b/kofc7186-fishfry/o/Doe%20-%207.pdf"
+    assert main.get_label_bytes(self_link) == (b"old", "pdf")
+    clock.return_value = 159.0
+    assert main.get_label_bytes(self_link) == (b"old", "pdf")
+    assert get_blob.call_count == 1
+
+    get_blob.return_value = make_blob("Doe - 7.pdf", 2, b"new")
+    clock.return_value = 160.0
+    assert main.get_label_bytes(self_link) == (b"new", "pdf")
+    assert get_blob.call_count == 2
+
+
+def test_prefetched_labels_need_no_gcs_call(main, mocker):
+    """ a check-in right after its label was prefetched is served from the cache alone """
+    mocker.patch.object(main, "label_cache", main.LabelCache(max_bytes=1000, ttl=60))
+    get_blob = mocker.patch.object(main.bucket, "get_blob", return_value=make_blob("Doe - 7.zpl", 1, b"^XA"))
+    assert main.prefetch_labels(["Doe - 7.zpl"], "zpl") == 1
+    self_link = "https://www.googleapis.com/storage/v1/b/kofc7186-fishfry/o/Doe%20-%207.pdf"
+    assert main.get_label_bytes(self_link, "zpl") == (b"^XA", "zpl")
+    assert get_blob.call_count == 1
+
+
+def test_prefetch_needs_token(main, mocker):
+    """ the public print function only prefetches for callers with PREFETCH_TOKEN """
+    prefetch = mocker.patch.object(main, "prefetch_labels", return_value=0)
+
+    def request(headers):
+        return mock.Mock(args={'prefetch': "true"}, headers=headers, get_json=mock.Mock(return_value={}))
+    assert main.handle_print(request({})).status_code == 403
+    mocker.patch.object(main, "PREFETCH_TOKEN", "s3cret")
+    assert main.handle_print(request({'X-Prefetch-Token': "guess"})).status_code == 403
+    assert not prefetch.called
+    assert main.handle_print(request({'X-Prefetch-Token': "s3cret"})).status_code == 200
+
+
+def test_signing_credentials_refreshed_only_when_expired(main, mocker):
+    """ claim checks reuse the instance's credentials, refreshing them only once they expire """
+    credentials = mock.Mock(valid=False, service_account_email="print@example.iam", token="t")
+    credentials.refresh.side_effect = lambda request: setattr(credentials, "valid", True)
+    default = mocker.patch.object(main.google.auth, "default", return_value=(credentials, "project"))
+    mocker.patch.object(main, "signing_credentials", None)
+    blob = make_blob("Doe - 7.pdf")
+    main.signed_label_url(blob)
+    main.signed_label_url(blob)
+    assert default.call_count == 1 and credentials.refresh.call_count == 1
+
+    credentials.valid = False
+    main.signed_label_url(blob)
+    assert default.call_count == 1 and credentials.refresh.call_count == 2
+    assert blob.generate_signed_url.call_args.kwargs['access_token'] == "t"
+
+
+def order_snapshot(order_id, print_times=None):
+    """ a Firestore snapshot of an order, printed at print_times if given """
+    snap = mock.Mock(id=order_id, exists=True, update_time=f"updated-{order_id}")
+    snap.to_dict.return_value = {'print_times': print_times} if print_times else {}
+    return snap
+
+
+@pytest.fixture
+def firestore_docs(main, mocker):
+    """ names Firestore documents by their path, reads orders as never printed, and hands out a
+    fresh write batch per commit """
+    mocker.patch.object(main.fs_client, "collection",
+                        side_effect=lambda path: mock.Mock(document=lambda doc_id: f"{path}/{doc_id}"))
+    mocker.patch.object(main.fs_client, "get_all",
+                        side_effect=lambda refs: [order_snapshot(ref.rpartition("/")[2]) for ref in refs])
+    mocker.patch.object(main.fs_client, "write_option", side_effect=lambda **option: option)
+    batches = []
+
+    def new_batch():
+        batches.append(mock.Mock())
+        return batches[-1]
+    mocker.patch.object(main.fs_client, "batch", side_effect=new_batch)
+    return batches
+
+
+@pytest.fixture
+def publisher(main, mocker):
+    """ the Pub/Sub publisher, with every publish acknowledged """
+    client = mocker.patch.object(main.pubsub_v1, "PublisherClient").return_value
+    client.topic_path.side_effect = lambda project, topic: topic
+    client.publish.return_value.result.return_value = "message-1"
+    return client
+
+
+def print_request(order_id="order-1", square_order_number="7"):
+    """ the body AppSheet posts to print an order's label """
+    return {'Data': {'id': order_id, 'label_url': "https://labels/Doe - 7.pdf",
+                     'square_order_number': square_order_number, 'checkin_time': "6:05PM"}}
+
+
+def test_check_in_claims_in_one_commit(main, mocker, firestore_docs, publisher):
+    """ the marker, pickup status and print time are written in one batch before printing """
+    mocker.patch.object(main, "get_label_bytes", return_value=(b"%PDF", "pdf"))
+    assert main.check_in(print_request(), False, "pdf").status_code == 200
+    [batch] = firestore_docs
+    assert batch.commit.call_count == 1
+    assert batch.create.call_args.args[0] == f"{main.checkins_path}/order-1"
+    assert batch.update.call_args.args[1]['pickup'] == {"status": "ARRIVED", "checkin_time": "6:05PM"}
+    assert batch.update.call_args.kwargs['option'] == {'last_update_time': "updated-order-1"}
+    assert publisher.publish.call_args.kwargs['son'] == "7"
+
+
+def test_check_in_printed_before_markers(main, mocker, firestore_docs, publisher):
+    """ an order printed before check-ins were claimed with markers has print_times but no
+    marker, and isn't printed again or its print_times overwritten """
+    mocker.patch.object(main, "get_label_bytes", return_value=(b"%PDF", "pdf"))
+    mocker.patch.object(main.fs_client, "get_all", return_value=[order_snapshot("order-1", ["12/06/2024 18:01:00"])])
+    assert main.check_in(print_request(), False, "pdf").status_code == 400
+    assert not firestore_docs and not publisher.publish.called
+
+
+def test_check_in_printed_meanwhile(main, mocker, firestore_docs, publisher):
+    """ an order whose print_times were set after it was read fails the claim's precondition """
+    mocker.patch.object(main, "get_label_bytes", return_value=(b"%PDF", "pdf"))
+    firestore_docs.append(mock.Mock())
+    mocker.patch.object(main.fs_client, "batch", return_value=firestore_docs[-1])
+    firestore_docs[-1].commit.side_effect = main.FailedPrecondition("order changed")
+    assert main.check_in(print_request(), False, "pdf").status_code == 400
+    assert not publisher.publish.called
+
+
+def test_scan_check_in(main, mocker, firestore_docs, publisher):
+    """ a scanned label's code checks its order in with the label and order number read from
+    MySQL, whose int order number is published as text like every other attribute """
+    mocker.patch.object(main, "LABEL_TOKEN_SECRET", "s3cret")
+    mocker.patch.object(main, "get_label_bytes", return_value=(b"%PDF", "pdf"))
+    engine = mocker.patch.object(main, "mysql_engine")
+    connection = engine.return_value.connect.return_value.__enter__.return_value
+    connection.execute.return_value.mappings.return_value.first.return_value = {
+        'label_url': "https://labels/1042.pdf", 'square_order_number': 1042}
+    code = "order-1." + main.base64.urlsafe_b64encode(
+        main.hmac.new(b"s3cret", b"order-1", main.hashlib.sha256).digest()[:9]).decode("ascii")
+
+    assert main.scan_check_in(code, "pdf").status_code == 200
+    attributes = publisher.publish.call_args.kwargs
+    assert attributes['son'] == "1042"
+    assert all(isinstance(value, str) for name, value in attributes.items() if name != "data")
+    assert main.scan_check_in("order-1.forged", "pdf").status_code == 403
+
+
+def test_verify_checkin_code_matches_labels(main, mocker, checkin_code):
+    """ the codes firestore-mgr prints on labels are the ones the print function accepts """
+    mocker.patch.object(main, "LABEL_TOKEN_SECRET", "s3cret")
+    mocker.patch.object(checkin_code, "LABEL_TOKEN_SECRET", "s3cret")
+    for order_id in ["order-1", "8H2kDsQ1fTrWbgAJxyz", "a.b.c"]:
+        code = checkin_code.payload(mock.Mock(id=order_id))
+        assert main.verify_checkin_code(code) == order_id
+        assert main.verify_checkin_code(f" {code}\n") == order_id
+    assert main.verify_checkin_code(f"order-2.{checkin_code.token('order-1')}") is None
+    assert main.verify_checkin_code(f"order-1.{checkin_code.token('order-1', 'other')}") is None
+
+
+def test_print_settings_required(main, mocker):
+    """ the print function refuses to start without the settings scanned check-ins need """
+    spec = importlib.util.spec_from_file_location("main_without_settings", main.__file__)
+    mocker.patch.dict(os.environ, {'LABEL_TOKEN_SECRET': ""})
+    with mock.patch("google.cloud.storage.Client"), mock.patch("google.cloud.firestore.Client"):
+        with pytest.raises(ValueError, match="LABEL_TOKEN_SECRET"):
+            spec.loader.exec_module(importlib.util.module_from_spec(spec))
+        mocker.patch.dict(os.environ, {'LABEL_TOKEN_SECRET': "s3cret"})
+        del os.environ['DB_HOST']
+        with pytest.raises(KeyError, match="DB_HOST"):
+            spec.loader.exec_module(importlib.util.module_from_spec(spec))
+
+
+def test_check_in_already_printed(main, mocker, firestore_docs, publisher):
+    """ an order whose marker already exists was printed by another scan and isn't printed again """
+    mocker.patch.object(main, "get_label_bytes", return_value=(b"%PDF", "pdf"))
+    firestore_docs.append(mock.Mock())
+    mocker.patch.object(main.fs_client, "batch", return_value=firestore_docs[-1])
+    firestore_docs[-1].commit.side_effect = main.AlreadyExists("marker exists")
+    assert main.check_in(print_request(), False, "pdf").status_code == 400
+    assert not publisher.publish.called
+
+
+def test_check_in_released_when_print_fails(main, mocker, firestore_docs):
+    """ a claimed print that couldn't be sent is given up so the next scan prints it """
+    mocker.patch.object(main, "send_label", side_effect=RuntimeError("no printers"))
+    with pytest.raises(RuntimeError):
+        main.check_in(print_request(), False, "pdf")
+    claim, release = firestore_docs
+    assert claim.commit.called and release.commit.called
+    release.delete.assert_called_once_with(f"{main.checkins_path}/order-1")
+    assert release.update.call_args.args[1] == {"print_times": main.firestore.DELETE_FIELD}
+
+
+def test_check_in_kept_when_publish_times_out(main, mocker, firestore_docs, publisher):
+    """ a publish that timed out may still be delivered, so its claim is kept rather than letting
+    the next scan print the label again """
+    mocker.patch.object(main, "get_label_bytes", return_value=(b"%PDF", "pdf"))
+    publisher.publish.return_value.result.side_effect = main.pubsub_v1.publisher.exceptions.TimeoutError()
+    with pytest.raises(main.pubsub_v1.publisher.exceptions.TimeoutError):
+        main.check_in(print_request(), False, "pdf")
+    [claim] = firestore_docs
+    assert claim.commit.called
+
+
+def test_latency_recorder_while_recording(main):
+    """ percentiles can be read while other requests record their latencies """
+    recorder = main.LatencyRecorder(window=100)
+    stop = main.threading.Event()
+
+    def record():
+        while not stop.is_set():
+            recorder.record(0.01)
+    threads = [main.threading.Thread(target=record) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    try:
+        for _ in range(2000):
+            recorder.percentiles()
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+    assert recorder.percentiles()['p50'] == 10.0
+
+
+def blank_pdf(pages=1):
+    """ a PDF of blank pages, standing in for a label """
+    writer = PdfWriter()
+    for _ in range(pages):
+        writer.add_blank_page(width=288, height=432)
+    pdf = io.BytesIO()
+    writer.write(pdf)
+    return pdf.getvalue()
+
+
+def test_party_check_in(main, mocker, firestore_docs, publisher, capsys):
+    """ a party prints the labels of its orders not yet printed as one merged job, claiming them
+    in one batch, and its logs aren't labelled with an earlier request's order """
+    mocker.patch.object(main, "get_label_bytes", return_value=(blank_pdf(), "pdf"))
+    mocker.patch.object(main.fs_client, "get_all", return_value=[
+        order_snapshot("order-1"), order_snapshot("order-2", ["12/06/2024 18:01:00"]), order_snapshot("order-3")])
+    request = mock.Mock(args={'party': "true"}, headers={})
+    request.get_json.return_value = {'checkin_time': "6:05PM", 'orders': [
+        {'id': f"order-{number}", 'label_url': f"https://labels/{number}.pdf", 'square_order_number': 1000 + number}
+        for number in (1, 2, 3)]}
+    main.ctx_id.set("earlier-order")
+
+    response = main.handle_print(request)
+    assert response.status_code == 200
+    assert json.loads(response.get_data()) == {"printed": ["order-1", "order-3"], "already_printed": ["order-2"]}
+    [claim] = firestore_docs
+    assert [call.args[0] for call in claim.create.call_args_list] == \
+        [f"{main.checkins_path}/order-1", f"{main.checkins_path}/order-3"]
+    publish = publisher.publish.call_args
+    assert len(PdfReader(io.BytesIO(publish.kwargs['data'])).pages) == 2
+    assert publish.kwargs['son'] == "1001,1003"
+    assert "earlier-order" not in capsys.readouterr().out
+
+
+def logged_stages(output):
+    """ the trace_stage entries among the structured log lines """
+    return [entry['trace_stage'] for entry in map(json.loads, output.splitlines()) if 'trace_stage' in entry]
+
+
+def test_check_in_continues_order_trace(main, mocker, firestore_docs, publisher, capsys):
+    """ a check-in carries on the trace stored on the order, so its print stage is reported with
+    the rest of the order's pipeline and the printer host receives it on the job """
+    mocker.patch.object(main, "get_label_bytes", return_value=(b"%PDF", "pdf"))
+    snap = order_snapshot("order-1")
+    snap.to_dict.return_value = {'trace': {"id": "event-1", "order_id": "order-1", "received_at": 1000.0,
+                                           "stages": {"webhook": 1000.1, "label": 1002.0}}}
+    mocker.patch.object(main.fs_client, "get_all", return_value=[snap])
+    request = mock.Mock(args={}, headers={})
+    request.get_json.return_value = print_request()
+    assert main.handle_print(request).status_code == 200
+
+    [stage] = logged_stages(capsys.readouterr().out)
+    assert (stage['trace_id'], stage['order_id'], stage['stage']) == ("event-1", "order-1", "print")
+    assert stage['stage_ms'] < stage['since_received_ms']
+    sent = json.loads(publisher.publish.call_args.kwargs['trace'])
+    assert sent['id'] == "event-1" and set(sent['stages']) == {"webhook", "label"}
+    assert not publisher.publish.call_args.kwargs['job_id'].endswith("event-1")
+
+
+def test_party_check_in_continues_order_traces(main, mocker, firestore_docs, publisher, capsys):
+    """ each order of a party has the print stage reported on its own trace """
+    mocker.patch.object(main, "get_label_bytes", return_value=(blank_pdf(), "pdf"))
+    snaps = [order_snapshot(f"order-{number}") for number in (1, 2)]
+    for number, snap in enumerate(snaps, start=1):
+        snap.to_dict.return_value = {'trace': {"id": f"event-{number}", "order_id": f"order-{number}",
+                                               "received_at": 1000.0, "stages": {}}}
+    mocker.patch.object(main.fs_client, "get_all", return_value=snaps)
+    request = mock.Mock(args={'party': "true"}, headers={})
+    request.get_json.return_value = {'checkin_time': "6:05PM", 'orders': [
+        {'id': f"order-{number}", 'label_url': f"https://labels/{number}.pdf", 'square_order_number': number}
+        for number in (1, 2)]}
+    assert main.handle_print(request).status_code == 200
+    assert [(stage['trace_id'], stage['stage']) for stage in logged_stages(capsys.readouterr().out)] == \
+        [("event-1", "print"), ("event-2", "print")]
+
+
+def test_printer_pool_routing(main, mocker):
+    """ jobs go to the least loaded printer (the fastest to acknowledge on ties), or in turn, with
+    a station's own printer first """
+    mocker.patch.object(main.time, "monotonic", return_value=1000.0)
+    pool = main.PrinterPool(["p1", "p2", "p3"], stations={"door": "p3"})
+    pool.sent_to("p1", 0.05)
+    pool.sent_to("p2", 0.01)
+    pool.sent_to("p2", 0.01)
+    pool.sent_to("p3", 0.02)
+    assert pool.candidates() == ["p3", "p1", "p2"]
+    assert pool.candidates("door") == ["p3", "p1", "p2"]
+    pool.sent_to("p3", 0.02)
+    assert pool.candidates() == ["p1", "p2", "p3"]
+    assert pool.candidates("door") == ["p3", "p1", "p2"]
+    main.time.monotonic.return_value = 1061.0
+    assert pool.stats()["p2"]["load"] == 0
+
+    pool = main.PrinterPool(["p1", "p2", "p3"], routing="round_robin")
+    assert [pool.candidates()[0] for _ in range(4)] == ["p2", "p3", "p1", "p2"]
+
+
+def test_printer_pool_down_and_recovery(main, mocker):
+    """ a printer whose publish failed is tried last until its cooldown is over, or until a
+    publish to it succeeds """
+    clock = mocker.patch.object(main.time, "monotonic", return_value=1000.0)
+    pool = main.PrinterPool(["p1", "p2"], cooldown=30.0)
+    pool.failed("p1")
+    assert pool.candidates() == ["p2", "p1"]
+    assert pool.stats()["p1"]["down"]
+    clock.return_value = 1031.0
+    assert pool.candidates() == ["p1", "p2"]
+    pool.failed("p1")
+    pool.sent_to("p1", 0.01)
+    assert not pool.stats()["p1"]["down"]
+
+
+def test_publish_fails_over(main, mocker, publisher):
+    """ a failed publish marks the printer down and the job goes to the next one, with the same
+    job_id on both attempts """
+    mocker.patch.object(main, "printer_pool", main.PrinterPool(["p1", "p2"]))
+    failed, sent = mock.Mock(), mock.Mock()
+    failed.result.side_effect = RuntimeError("topic not found")
+    sent.result.return_value = "message-2"
+    publisher.publish.side_effect = [failed, sent]
+    main.publish_to_print_queue(b"%PDF", "7", content_type="application/pdf")
+    first, second = publisher.publish.call_args_list
+    assert (first.args[0], second.args[0]) == ("p1", "p2")
+    assert first.kwargs['job_id'] == second.kwargs['job_id'] and first.kwargs['job_id'].startswith("7:")
+    assert main.printer_pool.stats()["p1"]["down"] and not main.printer_pool.stats()["p2"]["down"]
+
+
+def test_publish_timeout_does_not_fail_over(main, mocker, publisher):
+    """ a publish that timed out may still be delivered, so it isn't sent to another printer """
+    mocker.patch.object(main, "printer_pool", main.PrinterPool(["p1", "p2"]))
+    publisher.publish.return_value.result.side_effect = main.pubsub_v1.publisher.exceptions.TimeoutError
+    with pytest.raises(main.pubsub_v1.publisher.exceptions.TimeoutError):
+        main.publish_to_print_queue(b"%PDF", "7")
+    assert publisher.publish.call_count == 1
+
+
+def test_publish_without_printers(main, mocker, publisher):
+    """ with no printer topics, publishing raises a real error """
+    mocker.patch.object(main, "printer_pool", main.PrinterPool([]))
+    with pytest.raises(RuntimeError, match="no printers available"):
+        main.publish_to_print_queue(b"%PDF", "7")
+
+
+def order_row(number, last_name, phone="", status=None, customer_name=None):
+    """ an orders table row as check-in search reads it """
+    return {'id': f"order-{number}", 'created_at': datetime(2024, 12, 1) + timedelta(minutes=number),
+            'square_order_number': number, 'customer_name': customer_name or f"Pat {last_name}",
+            'last_name': last_name, 'phone_number': phone, 'concert': 0, 'dinner': 1, 'note': None,
+            'status': status, 'checkin_time': None, 'label_url': f"https://labels/{number}.pdf"}
+
+
+def test_trie_keeps_ranked_ids(main):
+    """ every node lists the ids below it best first, as ids are added and removed """
+    ranks = {"a": 3, "b": 1, "c": 2}
+    trie = main.Trie(ranks.__getitem__)
+    trie.add("smith", "a")
+    trie.add("smyth", "b")
+    trie.add("sm", "c")
+    assert main.Trie.ranked(trie.find("sm")) == ["b", "c", "a"]
+    assert trie.find("sm").ends == {"c"}
+    trie.remove("smyth", "b")
+    assert main.Trie.ranked(trie.find("sm")) == ["c", "a"]
+    assert main.Trie.ranked(trie.find("smy")) == []
+    assert trie.find("jones") is None
+    trie.remove("jones", "a")
+
+
+def test_search_index(main):
+    """ orders are found by last name, phone and order number prefix, exact matches first, then
+    order number, last name and phone matches, guests not yet checked in before the others """
+    index = main.SearchIndex()
+    index.load([order_row(1042, "O'Brien", "+1 (555) 010-1042"),
+                order_row(1043, "Smith", "5550101043", status="ARRIVED"),
+                order_row(1044, "Smithers", "5550101044"),
+                order_row(555, "Smith", "4125550199", customer_name="Alex Smith")])
+
+    def ids(query, limit=10):
+        return [row['id'] for row in index.search(query, limit)]
+    assert ids("obri") == ids("O'BRIEN") == ["order-1042"]
+    assert ids("smith") == ["order-555", "order-1043", "order-1044"]
+    assert ids("smith", limit=1) == ["order-555"]
+    assert ids("5550101042") == ids("15550101042") == ["order-1042"]
+    assert ids("555") == ["order-555", "order-1042", "order-1044", "order-1043"]
+    assert ids("") == ids("--") == ids("zzz") == []
+
+    index.upsert(order_row(1044, "Jones", "5550101044", status="ARRIVED"))
+    assert ids("smith") == ["order-555", "order-1043"]
+    assert ids("jon") == ["order-1044"]
+    assert ids("555") == ["order-555", "order-1042", "order-1044", "order-1043"]
+
+
+def test_search_is_sub_millisecond(main):
+    """ lookups stay well under a millisecond on an event's worth of orders, however broad the
+    prefix and right after orders are re-filed (see bench_search.py for the full benchmark) """
+    names = ["Smith", "Johnson", "Garcia", "Miller", "Davis", "Jones", "Brown", "Lee"]
+    rows = [order_row(1000 + number, names[number % len(names)] + str(number % 7), f"555{number:07d}")
+            for number in range(3000)]
+    index = main.SearchIndex()
+    index.load(rows)
+    timings = []
+    for query in ["s", "sm", "smith3", "j", "1", "12", "5", "5550001", "l", "d"] * 20:
+        index.load(rows[:5])
+        start = main.time.perf_counter()
+        index.search(query)
+        timings.append(main.time.perf_counter() - start)
+    assert sorted(timings)[len(timings) // 2] < 0.001
+
+
+@pytest.fixture
+def search_index(main, mocker):
+    """ a current search index of two orders """
+    index = main.SearchIndex()
+    index.load([order_row(1042, "Smith"), order_row(1043, "Jones")])
+    mocker.patch.object(main, "search_index", index)
+    return index
+
+
+def test_handle_search(main, mocker, search_index):
+    """ the limit is validated and clamped, and with SEARCH_TOKEN set only callers sending it are
+    answered """
+    def search(args, headers=None):
+        return main.handle_search(mock.Mock(args=args, headers=headers or {}))
+    response = search({'q': "smi", 'limit': "0"})
+    assert [row['id'] for row in json.loads(response.get_data())['orders']] == ["order-1042"]
+    assert search({'q': "smi", 'limit': "ten"}).status_code == 400
+
+    mocker.patch.object(main, "SEARCH_TOKEN", "s3cret")
+    assert search({'q': "smi"}).status_code == 403
+    assert search({'q': "smi"}, {'X-Search-Token': "guess"}).status_code == 403
+    assert search({'q': "smi"}, {'X-Search-Token': "s3cret"}).status_code == 200
+
+
+def test_search_during_rebuild(main, mocker, search_index):
+    """ while one request rebuilds a stale index from MySQL, the others search the current one
+    rather than waiting for it """
+    search_index.rebuilt -= main.SEARCH_REBUILD_SECONDS + 1
+    engine = mocker.patch.object(main, "mysql_engine")
+    with main.search_build_lock:
+        response = main.handle_search(mock.Mock(args={'q': "jon"}, headers={}))
+    assert [row['id'] for row in json.loads(response.get_data())['orders']] == ["order-1043"]
+    assert not engine.called
+
+
+def test_search_index_rebuilt_outside_lock(main, mocker, search_index):
+    """ a stale index is rebuilt from MySQL without search_lock held, then swapped in """
+    search_index.rebuilt -= main.SEARCH_REBUILD_SECONDS + 1
+
+    def fetch(connection, since=None):
+        assert not main.search_lock.locked()
+        return [order_row(1044, "Garcia")]
+    mocker.patch.object(main, "mysql_engine")
+    mocker.patch.object(main.SearchIndex, "fetch", side_effect=fetch)
+    assert main.current_search_index() is not search_index
+    assert [row['id'] for row in main.search_index.search("gar")] == ["order-1044"]
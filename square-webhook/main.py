@@ -8,10 +8,13 @@
 # pylint: disable=redefined-outer-name,unused-argument,no-member
 
 import base64
+import contextlib
 import contextvars
 import hmac
 import json
 import os
+import threading
+import time
 
 from hashlib import sha1
 from flask import Response
@@ -20,6 +23,8 @@ from werkzeug.exceptions import BadRequest, Forbidden, UnsupportedMediaType, Met
 
 from google.cloud import pubsub_v1
 
+import profiler
+
 ctx_id = contextvars.ContextVar("square_order_id", default="")
 
 
@@ -38,6 +43,78 @@ def log(message, *args, **kwargs):
     print(json.dumps(structured_json))
 
 
+def trace_stage(trace, stage, started):
+    """ records the completion of a pipeline stage in the order's trace context and logs the
+    stage's latency, and the latency since the webhook was received, for trace_report.py """
+    now = time.time()
+    trace['stages'][stage] = now
+    log("%s stage complete", stage, trace_stage={
+        "trace_id": trace['id'], "order_id": trace['order_id'], "stage": stage,
+        "stage_ms": round((now - started) * 1000, 1),
+        "since_received_ms": round((now - trace['received_at']) * 1000, 1)})
+    return trace
+
+
+# where spans around external calls are exported: "" records nothing, "stdout" logs one entry
+# per call and "file:<path>" appends them as JSON lines, for offline analysis
+SPAN_EXPORTER = os.environ.get('SPAN_EXPORTER', '')
+
+
+def log_span(record):
+    """ exports a span as a structured log entry """
+    log("%s took %.1fms", record['name'], record['duration_ms'], span=record)
+
+
+def file_span_exporter(path):
+    """ an exporter appending spans to path, one JSON object per line """
+    lock = threading.Lock()
+
+    def export(record):
+        line = json.dumps(record, default=str) + "\n"
+        with lock, open(path, "a", encoding="utf-8") as spans:
+            spans.write(line)
+    return export
+
+
+def span_exporter_for(setting):
+    """ the exporter a SPAN_EXPORTER setting names, or None """
+    if not setting:
+        return None
+    if setting == "stdout":
+        return log_span
+    if setting.startswith("file:"):
+        return file_span_exporter(setting.removeprefix("file:"))
+    raise ValueError(f"unknown SPAN_EXPORTER {setting!r}")
+
+
+span_exporter = span_exporter_for(SPAN_EXPORTER)
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """ times the external call made in the block and exports its name, attributes, duration,
+    outcome (an exception's name, unless the block set one) and order id; the block may add the
+    payload size as 'bytes' to the dict it is given. Without an exporter nothing is timed """
+    record = {"name": name, **attributes}
+    if span_exporter is None:
+        yield record
+        return
+    record.update(order_id=ctx_id.get(), outcome="ok", started_at=time.time())
+    start = time.perf_counter()
+    try:
+        yield record
+    except BaseException as err:
+        record['outcome'] = type(err).__name__
+        raise
+    finally:
+        record['duration_ms'] = round((time.perf_counter() - start) * 1000, 2)
+        span_exporter(record)
+
+
+# entry points are profiled on request or for PROFILE_FRACTION of invocations; see profiler.py
+profiled = profiler.ProfileHook(log=log)
+
+
 def validate_message(request):
     """ Validates message is well formed and has valid signature """
     if request.method != 'POST':
@@ -64,15 +141,22 @@ def validate_message(request):
     return request_json
 
 
+@profiled
 def handle_webhook(request):
     """ Validates that the webhook came from Square and triggers the order creation process.
     This function needs to return with an HTTP 200 within 3 seconds or else the webhook call will
     be retried.
     """
+    received_at = time.time()
     request_json = validate_message(request)
 
     ctx_id.set(request_json['data']['id'])
 
+    # the trace context follows the order through the pipeline: on the Pub/Sub message to
+    # order-mgr, then in the order's Firestore document for firestore-mgr
+    trace = {"id": request_json['event_id'], "order_id": request_json['data']['id'],
+             "received_at": received_at, "stages": {}}
+
     if 'Square-Initial-Delivery-Timestamp' in request.headers:
         log("Delivery time of initial notification: %s",
             request.headers.get('Square-Initial-Delivery-Timestamp'))
@@ -88,18 +172,21 @@ def handle_webhook(request):
     # put message on topic to upsert order
     publisher = pubsub_v1.PublisherClient()
     topic_path = publisher.topic_path(os.environ["GCP_PROJECT"], f"square.{request_json['type']}")
-    future = publisher.publish(topic_path, data=json.dumps(request_json).encode('utf-8'))
-
-    # this will block until the publish is complete;
-    # or raise an exception if the publish fails which should trigger Square to
-    # retry the notification
-    try:
-        message_id = future.result(timeout=2)
-        return Response(message_id, status=200)
-    except pubsub_v1.publisher.exceptions.TimeoutError as timeout:
-        raise InternalServerError(description="Timeout publishing notification") from timeout
-    except Exception as generic_ex:
-        raise InternalServerError(description="Unknown error") from generic_ex
+    data = json.dumps(request_json).encode('utf-8')
+    with span("pubsub.publish", topic=topic_path, bytes=len(data)):
+        future = publisher.publish(topic_path, data=data, trace=json.dumps(trace))
+
+        # this will block until the publish is complete;
+        # or raise an exception if the publish fails which should trigger Square to
+        # retry the notification
+        try:
+            message_id = future.result(timeout=2)
+        except pubsub_v1.publisher.exceptions.TimeoutError as timeout:
+            raise InternalServerError(description="Timeout publishing notification") from timeout
+        except Exception as generic_ex:
+            raise InternalServerError(description="Unknown error") from generic_ex
+    trace_stage(trace, "webhook", received_at)
+    return Response(message_id, status=200)
 
 
 def validate_square_signature(request):
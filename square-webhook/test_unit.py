@@ -140,6 +140,8 @@ def test_good_message(app, mock_pubsub_calls, mock_set_env_webhook_signature_key
     assert response.status_code == 200
     assert response.data == b'message_id'
     assert mock_pubsub_calls.return_value.publish.call_count == 1
+    trace = json.loads(mock_pubsub_calls.return_value.publish.call_args.kwargs['trace'])
+    assert (trace['id'], trace['order_id'], trace['stages']) == ("uuid", "12345", {})
 
 
 def test_good_message_retry(app, mock_pubsub_calls, mock_set_env_webhook_signature_key):
@@ -262,3 +264,64 @@ def test_insufficient_json_fields(app, mock_pubsub_calls, mock_set_env_webhook_s
             main.handle_webhook(flask.request)
 
         assert mock_pubsub_calls.return_value.publish.call_count == 0
+
+
+def test_publish_span(app, mock_pubsub_calls, mock_set_env_webhook_signature_key, monkeypatch,
+                      tmp_path):
+    """ tests that the publish is recorded as a span, including when it fails """
+    monkeypatch.setattr(main, "span_exporter", main.span_exporter_for(f"file:{tmp_path}/spans.jsonl"))
+    content = {
+        "merchant_id": "merchantID",
+        "data": {
+            "id": "12345",
+            "type": "order"
+        },
+        "type": "order.created",
+        "event_id": "uuid"
+    }
+    to_sign = "://functions.googlecloud.com/test_handle_webhook_valid/test_handle_webhook_valid" + \
+        json.dumps(content, sort_keys=True)
+    signature = base64.b64encode(hmac.new(KEY.encode(), to_sign.encode(), sha1).digest())
+    with app.test_request_context(method='POST',
+                                  path="/test_handle_webhook_valid",
+                                  base_url="functions.googlecloud.com",
+                                  json=content,
+                                  headers={'X-Square-Signature': signature}):
+        main.handle_webhook(flask.request)
+        mock_pubsub_calls.return_value.publish.return_value.result.side_effect = \
+            pubsub_v1.publisher.exceptions.TimeoutError
+        with pytest.raises(InternalServerError):
+            main.handle_webhook(flask.request)
+
+    spans = [json.loads(line) for line in (tmp_path / "spans.jsonl").read_text().splitlines()]
+    assert [span['outcome'] for span in spans] == ["ok", "InternalServerError"]
+    assert all(span['name'] == "pubsub.publish" and span['order_id'] == "12345" for span in spans)
+    assert spans[0]['bytes'] == len(json.dumps(content).encode('utf-8'))
+    assert spans[0]['duration_ms'] >= 0
+
+
+def test_profile_header(app, mock_pubsub_calls, mock_set_env_webhook_signature_key, monkeypatch,
+                        tmp_path):
+    """ tests that a request with an X-Profile header is profiled and others are not """
+    monkeypatch.setattr(main.profiled, "output", str(tmp_path))
+    content = {
+        "merchant_id": "merchantID",
+        "data": {
+            "id": "12345",
+            "type": "order"
+        },
+        "type": "order.created",
+        "event_id": "uuid"
+    }
+    to_sign = "://functions.googlecloud.com/test_handle_webhook_valid/test_handle_webhook_valid" + \
+        json.dumps(content, sort_keys=True)
+    signature = base64.b64encode(hmac.new(KEY.encode(), to_sign.encode(), sha1).digest())
+    for profile in ("false", "true"):
+        with app.test_request_context(method='POST',
+                                      path="/test_handle_webhook_valid",
+                                      base_url="functions.googlecloud.com",
+                                      json=content,
+                                      headers={'X-Square-Signature': signature, 'X-Profile': profile}):
+            assert main.handle_webhook(flask.request).status_code == 200
+
+    assert [path.suffix for path in tmp_path.glob("handle_webhook-*")] == [".collapsed"]